@@ -1,46 +1,80 @@
-import sys, re, os
-from BeautifulSoup import BeautifulSoup as BS
-from time import time, sleep
+import sys, re, os, threading, Queue, urlparse
+from time import sleep
 
 sys.path.append('../bibtex/')
 
-import www, bibtex, arxiv
+import settings
+import www, ratelimit, stats, aio, bibtex, arxiv, pacs
 import hphys_types as ht
 
-# Warning, this library performs pre-computation at load time:
-# import pacs
+# Where ADS is and how politely we load it. settings may override these (ads_base, ads_wait, ads_concurrency), e.g. to run against replay.py, and configure() changes them at run time.
+ADS_BASE = getattr(settings, 'ads_base', "http://adsabs.harvard.edu").rstrip('/')
+ADS_WAIT = getattr(settings, 'ads_wait', 10) # Minimum wait, in seconds, between loading two ADS resources.
+ADS_CONCURRENCY = getattr(settings, 'ads_concurrency', 1)
 
 class HTTP_Opener():
     def __init__(self):
-        self.prev_time = None
-        self.WAIT_TIME = 10 # Minimum wait, in seconds, between loading two ADS resources.
-    def open(self,url):
-        """Handles all errors by waiting 2 seconds and trying again."""
+        self.configure(ADS_BASE, ADS_WAIT, ADS_CONCURRENCY)
+    def configure(self, base, wait, concurrency=1):
+        self.host = urlparse.urlsplit(base).netloc # The rate limit applies per host:port
+        self.WAIT_TIME = wait
+        ratelimit.scheduler.add_host(self.host, self.WAIT_TIME, concurrency=concurrency)
+    def submit(self,url):
+        """Queues one attempt at url behind the ADS rate limit and returns a ratelimit.Future for (html-content, url, headers)."""
+        return ratelimit.scheduler.submit(self.host, www.fetch, url, lookup=False)
+    def submit_conditional(self,url,etag=None,last_modified=None):
+        """Queues a conditional GET of url behind the ADS rate limit and returns a ratelimit.Future for www.revalidate's result: None if the page has not changed."""
+        return ratelimit.scheduler.submit(self.host, www.revalidate, url, etag, last_modified)
+    def open(self,url,verbose=False):
+        """Handles all errors by waiting 2 seconds and trying again. Cached pages are returned without waiting. With verbose, the response headers are returned as well."""
+        hit = www.cached(url)
+        if hit: return hit if verbose else hit[:2]
         while True:
-            my_time = time()
-            if self.prev_time:
-                # If something messes with the system clock, this assert might fire:
-                assert(my_time > self.prev_time)
-                sleep(self.WAIT_TIME - min((my_time - self.prev_time), self.WAIT_TIME))
-            self.prev_time = my_time
             try: 
-                out = www.open_http(url)
-                return out
-            except:
-                print "HTTP failed"
+                out = self.submit(url).result()
+                return out if verbose else out[:2]
+            except Exception, e:
+                stats.incr(self.host, 'retries')
+                print "HTTP failed, retrying :: %s (%s)" % (url, e)
                 sleep(2)
 
 http_opener = HTTP_Opener()
 
-def author_search(first, middle, last):
-    """Given a first, middle, and last name, returns a list of ADS codes (as strings) matching the query.
-    Example inputs:
-    first="M.", middle="D.", last="Lukin"
-    first="Mikhail", middle="D.", last="Lukin"
-    first="Mikhail", middle="Deluxe", last="Lukin"
-    """
+def configure(base=None, wait=None, concurrency=None):
+    """Points the ADS functions at another server and/or changes the wait between requests and the number of requests in flight. Arguments left as None keep their value."""
+    global ADS_BASE, ADS_WAIT, ADS_CONCURRENCY
+    if base is not None: ADS_BASE = base.rstrip('/')
+    if wait is not None: ADS_WAIT = wait
+    if concurrency is not None: ADS_CONCURRENCY = concurrency
+    http_opener.configure(ADS_BASE, ADS_WAIT, ADS_CONCURRENCY)
+
+INPUT_TAG_REGEX = re.compile(r'<input\b[^>]*>', flags=re.IGNORECASE)
+TAG_ATTR_REGEX = re.compile(r'''([\w-]+)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))''')
+NEXT_PAGE_REGEX = re.compile(r'Get <a href="(.*?)">next set of references</a>')
+ATTR_ENTITY_REGEX = re.compile(r'&(#\d+|#x[0-9a-fA-F]+|\w+);')
+_XML_ENTITIES = {'amp': '&', 'lt': '<', 'gt': '>', 'quot': '"', 'apos': "'"}
+
+def _attr_entity(m):
+    x = m.group(1)
+    if x in _XML_ENTITIES: return _XML_ENTITIES[x]
+    if x.startswith('#x'): n = int(x[2:], 16)
+    elif x.startswith('#'): n = int(x[1:])
+    else: return m.group(0)
+    return chr(n) if n < 128 else unichr(n).encode('utf-8')
+
+def bibcodes_from_search(html):
+    """Returns the values of the <input type="checkbox" name="bibcode"> boxes on a page of search results, in page order. Like BeautifulSoup 3, which this replaces, it decodes character references and the XML entities (so "A&amp;A" gives "A&A") but leaves other named entities as they are."""
     out = []
+    for tag in INPUT_TAG_REGEX.findall(html):
+        if 'bibcode' not in tag: continue
+        attrs = {}
+        for m in TAG_ATTR_REGEX.finditer(tag):
+            attrs[m.group(1).lower()] = m.group(2) if m.group(2) is not None else (m.group(3) if m.group(3) is not None else m.group(4))
+        if attrs.get('type') == 'checkbox' and attrs.get('name') == 'bibcode' and 'value' in attrs:
+            out.append(ATTR_ENTITY_REGEX.sub(_attr_entity, attrs['value']))
+    return out
 
+def _search_url(first, middle, last):
     search_str = "%s, %s" % (last, first)
     if middle:
         search_str = search_str + " " + middle
@@ -48,85 +82,214 @@ def author_search(first, middle, last):
     # Search engine details:
     ## Last name must match exactly
     ## For first name: checks if either string is a prefix of the other.
-    SEARCH_BASE = "http://adsabs.harvard.edu/cgi-bin/nph-abs_connect?return_req=no_params&author=%s"
+    SEARCH_BASE = ADS_BASE + "/cgi-bin/nph-abs_connect?return_req=no_params&author=%s"
 
 
     #    FIRST_INDEX = 1
     #    MAX_WINDOW = 500
-    url = SEARCH_BASE % search_str
+    return SEARCH_BASE % search_str
+
+def _fix_search_url(url):
+    url = url.replace(" ","%20") # We do not normalize the URL because it changes ADS' behavior
+    url = url.replace('&#38;','&amp;') # To get around ADS' URL parsing
+    return url
+
+def _next_search_url(html):
+    # Get <a href="http://adsabs.harvard.edu/cgi-bin/nph-abs_connect?return_req=no_params&amp;author=Lukin,%20M.%20D.&amp;start_nr=251&amp;start_cnt=201">next set of references</a>
+    match = NEXT_PAGE_REGEX.search(html)
+    if match:
+        return match.group(1)
+    return None
+
+def author_search_iter(first, middle, last):
+    """A generator version of author_search. It yields the ADS codes (as strings) of each page of results as soon as that page has loaded, so callers can start on the first codes before the last page arrives."""
+    url = _search_url(first, middle, last)
     while url:
-        url = url.replace(" ","%20") # We do not normalize the URL because it changes ADS' behavior
-        url = url.replace('&#38;','&amp;') # To get around ADS' URL parsing
         # open_http returns html-content, url
-        html = http_opener.open(url)[0]
-        soup = BS(html)
-        nodes = soup.findAll(attrs={"type": "checkbox", "name": "bibcode"})
-        out.extend(map(lambda x: x["value"], nodes))
-        # Get <a href="http://adsabs.harvard.edu/cgi-bin/nph-abs_connect?return_req=no_params&amp;author=Lukin,%20M.%20D.&amp;start_nr=251&amp;start_cnt=201">next set of references</a>
-        match = re.search(r'Get <a href="(.*?)">next set of references</a>',html)
-        if match:
-            url = match.group(1)
-        else:
-            url = None
-    return out
+        html = http_opener.open(_fix_search_url(url))[0]
+        for code in bibcodes_from_search(html):
+            yield code
+        url = _next_search_url(html)
 
-def affiliations_from_abstract(s):
-    """Takes the text of the abstract page and returns a list of tuples of the form (Name of author, String representing affiliation)."""
-    auth_line_start = r'<tr><td nowrap valign="top" align="left"><b>Authors:</b></td><td><br></td><td align="left" valign="top">'
-    auth_line_end = r'</td></tr>'
+def author_search(first, middle, last):
+    """Given a first, middle, and last name, returns a list of ADS codes (as strings) matching the query.
+    Example inputs:
+    first="M.", middle="D.", last="Lukin"
+    first="Mikhail", middle="D.", last="Lukin"
+    first="Mikhail", middle="Deluxe", last="Lukin"
+    """
+    return list(author_search_iter(first, middle, last))
 
-    aff_line_start = r'<tr><td nowrap valign="top" align="left"><b>Affiliation:</b></td><td><br></td><td align="left" valign="top">'
-    aff_line_end = r'</td></tr>'
+PIPELINE_WORKERS = 4 # Threads running abstract_read in read_pipeline
+PIPELINE_QUEUE = 50 # Bibcodes that may wait between the source and the read stage of read_pipeline
 
-    auth_pattern = r'<a href=".*?">(.*?)</a>'
-    aff_pattern = r'([A-Z][A-Z][A-Z]?[A-Z]?)\((.*?)\)'
+_DONE = object() # Marks the end of a stage's output
 
-    # re.MULTILINE means that ^ and $ match the beginning and end of a line
-    auth_line = re.search('^' + auth_line_start + r'(.*?)' + auth_line_end, s, flags=re.MULTILINE)
+def _put(q, item, stop):
+    """Puts item on the bounded queue q, giving up if stop is set while we wait."""
+    while not stop.is_set():
+        try:
+            q.put(item, True, 1)
+            return True
+        except Queue.Full:
+            pass
+    return False
+
+def author_publications(first, middle, last, workers=PIPELINE_WORKERS, maxsize=PIPELINE_QUEUE):
+    """Yields (bibcode, Publication) for every result of an author search, through read_pipeline: abstracts are read while later result pages are still loading. Results come out in the order they finish. An abstract that cannot be read is reported and skipped; an error in the search itself is raised here."""
+    return read_pipeline(author_search_iter(first, middle, last), abstract_read, workers, maxsize)
+
+def _report_unread(code, e):
+    print "Warning: could not read abstract :: %s (%s)" % (code, e)
+
+def read_pipeline(codes, read, workers=PIPELINE_WORKERS, maxsize=PIPELINE_QUEUE, on_error=_report_unread):
+    """Yields (bibcode, read(bibcode)) for every bibcode from the iterable codes. codes is consumed by one thread and read runs on a pool of worker threads, connected by a bounded queue, so that a slow source (e.g. search result pages) and the reads overlap. Results come out in the order they finish. When read raises, on_error(bibcode, exception) is called and the bibcode is skipped; an error from codes itself is raised here."""
+    todo = Queue.Queue(maxsize)
+    results = Queue.Queue(maxsize)
+    stop = threading.Event()
+
+    def source():
+        try:
+            for code in codes:
+                if not _put(todo, code, stop): return
+        except:
+            _put(results, (None, sys.exc_info()), stop)
+        finally:
+            for i in range(workers):
+                _put(todo, _DONE, stop)
+
+    def worker():
+        while not stop.is_set():
+            try:
+                code = todo.get(True, 1)
+            except Queue.Empty:
+                continue
+            if code is _DONE: break
+            try:
+                out = read(code)
+            except Exception, e:
+                on_error(code, e)
+                continue
+            if not _put(results, (code, out), stop): return
+        _put(results, _DONE, stop)
+
+    threads = [threading.Thread(target=source)] + [threading.Thread(target=worker) for i in range(workers)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    try:
+        running = workers
+        while running:
+            item = results.get()
+            if item is _DONE:
+                running -= 1
+            elif item[0] is None:
+                exc_info = item[1]
+                raise exc_info[0], exc_info[1], exc_info[2]
+            else:
+                yield item
+    finally:
+        stop.set()
+
+# The rows of the table at the top of an abstract page look like this, all on one line:
+_ABS_ROW = r'<tr><td nowrap valign="top" align="left"><b>%s:</b></td><td><br></td><td align="left" valign="top">'
+
+# One pattern for every field we read from an abstract page, so the page is scanned once. re.MULTILINE means that ^ and $ match the beginning and end of a line.
+ABSTRACT_PAGE_REGEX = re.compile(
+    r'^(?P<authors>' + _ABS_ROW % 'Authors' + r'.*?</td></tr>)' +
+    r'|^(?P<affiliation>' + _ABS_ROW % 'Affiliation' + r'.*?</td></tr>)' +
+    r'|' + _ABS_ROW % 'PACS Keywords' + r'(?P<pacs>.*?)</td></tr>' +
+    r'|<h3 align="center">                               Abstract</h3>\n(?P<abstract>(?:.*\n)*?)<hr>',
+    re.MULTILINE)
+AUTHOR_REGEX = re.compile(r'<a href=".*?">(.*?)</a>')
+AFFILIATION_REGEX = re.compile(r'([A-Z][A-Z][A-Z]?[A-Z]?)\((.*?)\)')
+# Each author has the form "Kozlenko,&#160;D.&#160;P."
+NAME_FIX_REGEX = re.compile(r'&#160;|\.-|\xc2\xa0')
+_NAME_FIXES = {'&#160;': ' ', '.-': '. ', '\xc2\xa0': ' '}
+
+def abstract_page_fields(s):
+    """Scans the text of an abstract page once and returns a dict of the raw fields we use: 'authors' and 'affiliation' (the whole table rows), 'pacs' (the PACS keyword line) and 'abstract' (the body). Missing fields are None."""
+    out = {'authors': None, 'affiliation': None, 'pacs': None, 'abstract': None}
+    left = len(out)
+    for m in ABSTRACT_PAGE_REGEX.finditer(s):
+        k = m.lastgroup
+        if out[k] is None:
+            out[k] = m.group(k)
+            left -= 1
+            if not left: break
+    return out
 
-    # For book reviews, for instance, the author scheme is weird and uninteresting to us.
-    if not auth_line: return []
+def affiliations_from_abstract(s, fields=None):
+    """Takes the text of the abstract page and returns a list of tuples of the form (Name of author, String representing affiliation). If the page has already been through abstract_page_fields, pass its fields to skip the scan."""
+    if fields is None: fields = abstract_page_fields(s)
 
-    auths = [x for x in re.findall(auth_pattern, auth_line.group(0))]
-    # Each element of auths has the form "Kozlenko,&#160;D.&#160;P."
-    auths = map(lambda x: x.replace("&#160;"," ").replace(".-",". ").replace('\xc2\xa0',' ').split(", "), auths)
+    # For book reviews, for instance, the author scheme is weird and uninteresting to us.
+    if not fields['authors']: return []
 
+    fix = lambda m: _NAME_FIXES[m.group(0)]
     out = []
-    for a in auths:
+    for x in AUTHOR_REGEX.findall(fields['authors']):
+        a = NAME_FIX_REGEX.sub(fix, x).split(", ")
         assert(a[0]) # The last name must be non-null
         try:
             # An abundance of spaces would cause null middle names:
-            names = filter(lambda x: x, a[1].split(' '))
+            names = [y for y in a[1].split(' ') if y]
         except IndexError:
             names = []
         out.append(ht.Name({"names": names, "last": a[0]}))
     auths = out
 
-    aff_line = re.search('^' + aff_line_start + r'(.*?)' + aff_line_end, s, flags=re.MULTILINE)
-    if aff_line:
+    if fields['affiliation']:
         # The output of findall is a list of tuples iff there is more than one group in the pattern.
-        affs = [x[1] for x in re.findall(aff_pattern, aff_line.group(0))]
+        affs = [x[1] for x in AFFILIATION_REGEX.findall(fields['affiliation'])]
     else: affs = [None] * len(auths)
 
     return zip(auths,affs)
 
+PACS_PARSE_MEMO_SIZE = 20000 # Keyword strings remembered by pacs_keywords_parse. The same lines recur across many papers.
+_pacs_parse_memo = {}
+
 def pacs_keywords_parse(s):
     """ADS has a 'PACS Keywords' field that consists of a bunch of PACS names delimited by ', '. Of course, PACS names can include ', ' so this is a mess. This function returns a tuple of lists. The first list is the valid PACS codes that we could extract from the string. The second list is phrases that we ignored. This function tries to ignore as few phrases as possible."""
+    with stats.timer('pacs_keywords_parse'):
+        memo = _pacs_parse_memo.get(s)
+        if memo is None:
+            memo = _pacs_keywords_parse(s)
+            if len(_pacs_parse_memo) >= PACS_PARSE_MEMO_SIZE: _pacs_parse_memo.clear()
+            _pacs_parse_memo[s] = memo
+        else:
+            stats.incr('pacs_keywords_parse', 'memo_hits')
+        return (list(memo[0]), list(memo[1]))
+
+def _pacs_keywords_parse(s):
     units = s.split(', ')
     unitsl = len(units)
+    # Walk the trie of PACS names from each unit, so we only look at spans that really are PACS names.
+    # ends[cur] lists (start, code) for each name that covers units[start:cur].
+    trie, longest = pacs.pacs_names_trie()
+    ends = [[] for i in range(unitsl + 1)]
+    for start in range(unitsl):
+        node = trie
+        for k in range(start, min(unitsl, start + longest)):
+            node = node.get(units[k])
+            if node is None: break
+            if None in node:
+                ends[k + 1].append((start, node[None]))
+    # Any span that is not a PACS name is one ignored phrase of cost 1, however long. So the best unmatched span ending at cur starts at the cheapest earlier position. Ties go to the latest position, i.e. the shortest span.
     #[Prev, Word, Valid, Cost]
     dp = [[None, None, None, 0]]
-    for cur in range(1, len(units) + 1):
-        dp.append([None, None, None, unitsl + 1])
-        for i in range(1, cur + 1):
-            phrase = ", ".join(units[cur - i:cur])
-            candidate = pacs.PACS_NAMES.get(phrase)
-            if candidate:
-                working = [cur - i, candidate, True, dp[cur - i][-1]]
-            else:
-                working = [cur - i, phrase, False, dp[cur - i][-1] + 1]
-            if working[-1] < dp[-1][-1]:
-                dp[-1] = working
+    best_cost, best_prev = 0, 0
+    for cur in range(1, unitsl + 1):
+        working = [best_prev, None, False, best_cost + 1]
+        for prev, code in ends[cur]:
+            cost = dp[prev][-1]
+            if cost < working[-1] or (cost == working[-1] and prev > working[0]):
+                working = [prev, code, True, cost]
+        if not working[2]:
+            working[1] = ", ".join(units[working[0]:cur])
+        dp.append(working)
+        if working[-1] <= best_cost:
+            best_cost, best_prev = working[-1], cur
     codes_out = []
     phrases_out = []
     i = unitsl
@@ -140,44 +303,62 @@ def pacs_keywords_parse(s):
             if i == 0: break
     return (codes_out,phrases_out)
     
+def abstract_urls(bibcode):
+    """The URLs of the abstract page and the BibTeX of bibcode."""
+    return (ADS_BASE + "/abs/%s" % bibcode,
+            ADS_BASE + "/cgi-bin/nph-bib_query?bibcode=%s&data_type=BIBTEX" % bibcode)
+
+def abstract_fetch(bibcode, verbose=False):
+    """Loads the raw pages that abstract_parse needs. Returns (abstract page HTML, BibTeX text). With verbose, returns ((abstract page HTML, BibTeX text), [(url, body, headers)]), e.g. for keeping the validators that refresh.py sends back."""
+    urls = abstract_urls(bibcode)
+    out = [http_opener.open(x, True) for x in urls]
+    pages = (out[0][0], out[1][0])
+    if verbose:
+        return pages, [(url, x[0], x[2]) for url, x in zip(urls, out)]
+    return pages
+
 def abstract_read(bibcode):
+    with stats.timer('abstract_read'):
+        return abstract_parse(bibcode, *abstract_fetch(bibcode))
+
+def abstract_parse(bibcode, ads_abs_s, bibtex_s):
+    """Builds a Publication from the pages returned by abstract_fetch. Apart from the switched-off TRY_ flags, this does no network access, so stored pages can be re-parsed."""
+    with stats.timer('abstract_parse'):
+        return _abstract_parse(bibcode, ads_abs_s, bibtex_s)
+
+def _abstract_parse(bibcode, ads_abs_s, bibtex_s):
     TRY_EPRINT_URLS = False 
     TRY_ARXIV = False
 
-    ADS_ABS = "http://adsabs.harvard.edu/abs/%s" % bibcode
-    ADS_TO_EPRINT = "http://adsabs.harvard.edu/cgi-bin/nph-data_query?bibcode=%s&link_type=EJOURNAL" % bibcode
-    ADS_TO_ARXIV = "http://adsabs.harvard.edu/cgi-bin/nph-data_query?bibcode=%s&link_type=PREPRINT" % bibcode
-    ADS_ABS_BIBTEX = "http://adsabs.harvard.edu/cgi-bin/nph-bib_query?bibcode=%s&data_type=BIBTEX" % bibcode
+    ADS_TO_EPRINT = ADS_BASE + "/cgi-bin/nph-data_query?bibcode=%s&link_type=EJOURNAL" % bibcode
+    ADS_TO_ARXIV = ADS_BASE + "/cgi-bin/nph-data_query?bibcode=%s&link_type=PREPRINT" % bibcode
 
     out = ht.Publication()
     out.ads_bibcode = bibcode
 
-    ads_abs_s, _ = http_opener.open(ADS_ABS)
     # ads_abs_soup = BS(ads_abs_s)
 
-    authors = affiliations_from_abstract(ads_abs_s)
+    fields = abstract_page_fields(ads_abs_s)
+
+    authors = affiliations_from_abstract(ads_abs_s, fields)
     # TODO cross-reference our existing databse of authors
-    out.authors = map(lambda x: {"name": x[0], "affiliation": x[1]}, authors)
+    out.authors = [{"name": x[0], "affiliation": x[1]} for x in authors]
 
     # Get the text of the abstract
-    abs_start = r'<h3 align="center">                               Abstract</h3>\n'
-    m = re.search(abs_start + r'((.*?\n)*?)<hr>',ads_abs_s)
-    if m:
-        out.abstract = ht.HTMLString({"contents": m.group(1)})
+    if fields['abstract'] is not None:
+        out.abstract = ht.HTMLString({"contents": fields['abstract']})
 
     # Get PACS codes and keywords
     pacs_set = set()
     keywords_set = set()
 
-    pacs_line = r'<tr><td nowrap valign="top" align="left"><b>PACS Keywords:</b></td><td><br></td><td align="left" valign="top">(.*?)</td></tr>'
-    m = re.search(pacs_line,ads_abs_s)
-    if m:
-        p, k = pacs_keywords_parse(m.group(1))
+    if fields['pacs'] is not None:
+        p, k = pacs_keywords_parse(fields['pacs'])
         pacs_set.update(p)
         keywords_set.update(k)
 
     # Get some BibTeX
-    bibtex_records = bibtex.read_string(http_opener.open(ADS_ABS_BIBTEX)[0])
+    bibtex_records = bibtex.read_string(bibtex_s)
     assert len(bibtex_records) == 1
     br = bibtex_records[0]
     out.publication_type = br.entry_type
@@ -235,13 +416,25 @@ def abstract_read(bibcode):
         
     return out
 
-def arxiv_build(arxiv_id,files_path="../files"):
-    ar = arxiv.ArXivRecord(arxiv_id)
-    entry = ht.ArxivEntry({'arxiv_id': arxiv_id})
+def arxiv_build(arxiv_id,files_path="../files",all_comments=True):
+    """Builds an ArxivEntry. arxiv_id may also be an ArXivRecord, e.g. one whose Atom entry came from arxiv.prefetch_entries. Without all_comments, only the latest version's comment is recorded, which saves one abs page load per earlier version."""
+    with stats.timer('arxiv_build'):
+        ar = arxiv_id if isinstance(arxiv_id, arxiv.ArXivRecord) else arxiv.ArXivRecord(arxiv_id)
+        return _arxiv_build(ar, files_path, all_comments)
+
+def _arxiv_build(ar, files_path, all_comments):
+    entry = arxiv_parse(ar, all_comments)
+    entry.snapshots[-1].versions = ar.download(os.path.abspath(files_path))
+    return entry
+
+def arxiv_parse(ar, all_comments=True):
+    """The part of arxiv_build that reads pages: builds an ArxivEntry from an ArXivRecord, without downloading any files, so the latest snapshot has no versions. A record given its pages with use_pages, and all_comments False, makes no requests at all."""
+    entry = ht.ArxivEntry({'arxiv_id': ar.id})
     snapshots = []
-    for i in range(0,len(ar.versions())):
-        snapshots.append(ht.ArxivSnapshot({'date': ar.versions()[i], 'comment': ar.comments()[i], 'version': i + 1}))
-    snapshots[-1].versions = ar.download(os.path.abspath(files_path))
+    versions = ar.versions()
+    comments = ar.comments(all_comments)
+    for i in range(0,len(versions)):
+        snapshots.append(ht.ArxivSnapshot({'date': versions[i], 'comment': comments[i], 'version': i + 1}))
     entry.snapshots = snapshots
     submitter = ar.submitter()
     if submitter:
@@ -252,3 +445,36 @@ def arxiv_build(arxiv_id,files_path="../files"):
         entry.primary_category = c1
         entry.categories = c_all
     return entry
+
+# Coroutine versions of the functions above, for aio's event loop: run one with aio.run(), or yield it from another coroutine. Many of them can be in flight at once on one thread, within the same per-host limits as the blocking versions.
+
+async_opener = aio.AsyncOpener(http_opener, retry=2)
+
+def author_search_async(first, middle, last):
+    """Coroutine: author_search."""
+    out = []
+    url = _search_url(first, middle, last)
+    while url:
+        html = (yield async_opener.open(_fix_search_url(url)))[0]
+        out.extend(bibcodes_from_search(html))
+        url = _next_search_url(html)
+    raise aio.Return(out)
+
+def abstract_fetch_async(bibcode):
+    """Coroutine: abstract_fetch, with both pages requested at once."""
+    abs_page, bibtex_page = yield [async_opener.open(x) for x in abstract_urls(bibcode)]
+    raise aio.Return((abs_page[0], bibtex_page[0]))
+
+def abstract_read_async(bibcode):
+    """Coroutine: abstract_read."""
+    with stats.timer('abstract_read'):
+        pages = yield abstract_fetch_async(bibcode)
+        raise aio.Return(abstract_parse(bibcode, *pages))
+
+def arxiv_build_async(arxiv_id, files_path="../files", all_comments=True):
+    """Coroutine: arxiv_build. The pages are loaded on the event loop, together where they can be. The downloads stream to disk, so they run on a worker thread."""
+    with stats.timer('arxiv_build'):
+        ar = arxiv.ArXivRecord(arxiv_id)
+        yield ar.preload_async(all_comments)
+        entry = yield aio.in_thread(_arxiv_build, ar, files_path, all_comments)
+        raise aio.Return(entry)
@@ -0,0 +1,452 @@
+"""Asynchronous fetching on a single thread, for keeping many requests in flight without a thread for each.
+
+Python 2 has no asyncio, so this is a small event loop of its own on top of asyncore. Coroutines are generators that yield what they wait for:
+    def fetch_both(opener, a, b):
+        pa, pb = yield gather(opener.open(a), opener.open(b))
+        raise Return(pa[0] + pb[0])
+    run(fetch_both(ads.async_opener, url1, url2))
+A coroutine may yield a Future, another coroutine, or a list of either (waited for together); it returns a value by raising Return(value). Blocking calls go to a thread with in_thread().
+
+AsyncOpener is the counterpart of the HTTP_Opener classes in ads.py and arxiv.py. It takes its tokens from the same buckets on ratelimit.scheduler, and counts against the same per-host concurrency, so synchronous and asynchronous requests to a host share one politeness budget.
+"""
+
+import os, sys, heapq, socket, asyncore, threading, Queue, httplib, urllib2, urlparse, zlib, types, StringIO
+from collections import deque
+from time import time
+
+import settings
+import www, ratelimit, stats
+
+TIMEOUT = www.TIMEOUT
+MAX_REDIRECTS = www.MAX_REDIRECTS
+CHUNK = www.CHUNK
+THREADS = 8 # Threads that run in_thread() calls
+
+class Return(Exception):
+    """Raised by a coroutine to return a value."""
+    def __init__(self, value=None):
+        Exception.__init__(self, value)
+        self.value = value
+
+class Cancelled(Exception):
+    """The exception of a Task that was closed before it finished."""
+
+class Future():
+    """A result that will be set later, on the loop's thread. Callbacks run on the loop."""
+    def __init__(self, loop=None):
+        self.loop = loop or get_loop()
+        self._callbacks = []
+        self._done = False
+        self._result = None
+        self._exc_info = None
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        if not self._done: raise RuntimeError("Future is not done")
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def set_result(self, result):
+        if self._done: return
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exc_info):
+        """Takes the sys.exc_info() of the failure, so the traceback survives."""
+        if self._done: return
+        self._exc_info = exc_info
+        self._finish()
+
+    def add_done_callback(self, cb):
+        if self._done: self.loop.call_soon(cb, self)
+        else: self._callbacks.append(cb)
+
+    def _finish(self):
+        self._done = True
+        for cb in self._callbacks:
+            self.loop.call_soon(cb, self)
+        self._callbacks = []
+
+class Task(Future):
+    """Runs a coroutine on the loop. Its result is the coroutine's."""
+    def __init__(self, gen, loop=None):
+        Future.__init__(self, loop)
+        self._gen = gen
+        self.loop._tasks.add(self)
+        self.loop.call_soon(self._step, None, None)
+
+    def cancel(self):
+        """Closes the coroutine where it waits, so that its finally clauses run, and fails the task with Cancelled. Whatever waits on the task is not woken."""
+        if self._done: return
+        self.loop._tasks.discard(self)
+        self._done = True
+        self._exc_info = (Cancelled, Cancelled(), None)
+        self._callbacks = []
+        self._gen.close()
+
+    def _finish(self):
+        self.loop._tasks.discard(self)
+        Future._finish(self)
+
+    def _step(self, value, exc_info):
+        try:
+            if exc_info: y = self._gen.throw(*exc_info)
+            else: y = self._gen.send(value)
+        except StopIteration:
+            self.set_result(None)
+        except Return, r:
+            self.set_result(r.value)
+        except:
+            self.set_exception(sys.exc_info())
+        else:
+            try:
+                fut = wrap(y, self.loop)
+            except TypeError:
+                self.loop.call_soon(self._step, None, sys.exc_info())
+                return
+            fut.add_done_callback(self._wakeup)
+
+    def _wakeup(self, fut):
+        if fut._exc_info: self._step(None, fut._exc_info)
+        else: self._step(fut._result, None)
+
+def wrap(x, loop=None):
+    """Turns what a coroutine yielded into a Future: None (just let others run), a Future, a coroutine, or a list of those."""
+    loop = loop or get_loop()
+    if isinstance(x, Future): return x
+    if isinstance(x, types.GeneratorType): return Task(x, loop)
+    if isinstance(x, list): return gather(*x)
+    if x is None:
+        f = Future(loop)
+        loop.call_soon(f.set_result, None)
+        return f
+    raise TypeError("A coroutine yielded %r, which cannot be waited for" % (x,))
+
+def gather(*items):
+    """A Future for the list of results of several coroutines or Futures, in order. The first failure fails the whole."""
+    loop = get_loop()
+    out = Future(loop)
+    futs = [wrap(x, loop) for x in items]
+    results = [None] * len(futs)
+    left = [len(futs)]
+    if not futs:
+        loop.call_soon(out.set_result, [])
+    def done(i, f):
+        if f._exc_info:
+            out.set_exception(f._exc_info)
+            return
+        results[i] = f._result
+        left[0] -= 1
+        if left[0] == 0: out.set_result(results)
+    for i, f in enumerate(futs):
+        f.add_done_callback(lambda f, i=i: done(i, f))
+    return out
+
+def sleep(seconds):
+    loop = get_loop()
+    f = Future(loop)
+    loop.call_later(seconds, f.set_result, None)
+    return f
+
+class _Waker(asyncore.file_dispatcher):
+    """The read end of a pipe in the loop's map, so other threads can wake a loop that is waiting in select."""
+    def __init__(self, loop):
+        r, self._w = os.pipe()
+        asyncore.file_dispatcher.__init__(self, r, map=loop.map)
+        os.close(r) # file_dispatcher works on a dup
+    def wake(self):
+        try: os.write(self._w, 'x')
+        except OSError: pass
+    def writable(self):
+        return False
+    def handle_read(self):
+        try: self.recv(4096)
+        except OSError: pass
+
+class Loop():
+    """Runs callbacks, timers and asyncore sockets on one thread."""
+    def __init__(self):
+        self.map = {}
+        self._ready = deque()
+        self._timers = [] # Heap of [when, sequence, callback, args, cancelled]
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._threadsafe = deque()
+        self._waker = _Waker(self)
+        self._executor = None
+        self._tasks = set() # Tasks that have not finished
+
+    def call_soon(self, f, *args):
+        self._ready.append((f, args))
+
+    def call_later(self, delay, f, *args):
+        self._seq += 1
+        t = [time() + delay, self._seq, f, args, False]
+        heapq.heappush(self._timers, t)
+        return t
+
+    def cancel(self, timer):
+        timer[4] = True
+
+    def call_soon_threadsafe(self, f, *args):
+        with self._lock:
+            self._threadsafe.append((f, args))
+        self._waker.wake()
+
+    def in_thread(self, func, *args, **kwargs):
+        """Runs a blocking func(*args, **kwargs) on a worker thread and returns a Future for its value."""
+        if self._executor is None:
+            self._executor = Queue.Queue()
+            for i in range(THREADS):
+                t = threading.Thread(target=self._run_executor, name="aio-thread-%d" % i)
+                t.daemon = True
+                t.start()
+        fut = Future(self)
+        self._executor.put((fut, func, args, kwargs))
+        return fut
+
+    def _run_executor(self):
+        while True:
+            fut, func, args, kwargs = self._executor.get()
+            try:
+                result = func(*args, **kwargs)
+            except:
+                self.call_soon_threadsafe(fut.set_exception, sys.exc_info())
+            else:
+                self.call_soon_threadsafe(fut.set_result, result)
+
+    def run_until_complete(self, x):
+        """Runs the loop until the coroutine or Future x is done, and returns its result. Tasks that are still waiting then, e.g. the siblings of a failed gather, are cancelled, so that they give back their places on ratelimit.scheduler."""
+        fut = wrap(x, self)
+        try:
+            while not fut.done():
+                self._run_once()
+        finally:
+            self._cancel_pending()
+        return fut.result()
+
+    def _cancel_pending(self):
+        for task in list(self._tasks):
+            try:
+                task.cancel()
+            except Exception, e:
+                print "Warning: could not cancel a task (%s)" % e
+        # Their requests, timers and wake-ups are no longer wanted either.
+        for d in self.map.values():
+            if isinstance(d, _Request): d.close()
+        self._timers = []
+        self._ready.clear()
+
+    def _run_once(self):
+        with self._lock:
+            while self._threadsafe:
+                self._ready.append(self._threadsafe.popleft())
+        now = time()
+        while self._timers and (self._timers[0][0] <= now or self._timers[0][4]):
+            t = heapq.heappop(self._timers)
+            if not t[4]: self._ready.append((t[2], t[3]))
+        if self._ready:
+            timeout = 0
+        elif self._timers:
+            timeout = max(0, self._timers[0][0] - now)
+        else:
+            timeout = 30.0
+        asyncore.loop(timeout, map=self.map, count=1)
+        # Only what was ready before we started; callbacks scheduled now wait for the next round, after the sockets.
+        for i in range(len(self._ready)):
+            f, args = self._ready.popleft()
+            f(*args)
+
+_local = threading.local()
+
+def get_loop():
+    """The loop of the calling thread, made on first use."""
+    loop = getattr(_local, 'loop', None)
+    if loop is None:
+        loop = _local.loop = Loop()
+    return loop
+
+def run(x):
+    """Runs a coroutine to completion on this thread's loop and returns its value."""
+    return get_loop().run_until_complete(x)
+
+def in_thread(func, *args, **kwargs):
+    return get_loop().in_thread(func, *args, **kwargs)
+
+class _FakeSocket():
+    """Lets httplib.HTTPResponse parse a response we already hold in memory."""
+    def __init__(self, data):
+        self._data = data
+    def makefile(self, *args):
+        return StringIO.StringIO(self._data)
+
+class _Request(asyncore.dispatcher):
+    """One HTTP request on a fresh connection (Connection: close), read to the end. future gets the httplib.HTTPResponse, with its body read into .body.
+
+    Connections are not kept alive, so each request pays for its own TCP handshake, unlike those that go through www.POOL. Against sites that make us wait seconds between requests this costs little, and it keeps the loop free of connection state."""
+    def __init__(self, loop, host, port, path, headers, future, timeout=TIMEOUT):
+        asyncore.dispatcher.__init__(self, map=loop.map)
+        self.loop = loop
+        self.future = future
+        h = dict(headers)
+        h['Host'] = host if port == 80 else "%s:%d" % (host, port)
+        h['Connection'] = 'close'
+        self._out = "GET %s HTTP/1.1\r\n%s\r\n" % (path, ''.join(["%s: %s\r\n" % x for x in h.items()]))
+        self._in = []
+        self._timer = loop.call_later(timeout, self._timeout)
+        try:
+            # getaddrinfo blocks, but only for as long as the resolver takes; the answers are usually cached by the system.
+            family, socktype, proto, _, addr = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0]
+            self.create_socket(family, socktype)
+            self.connect(addr)
+        except:
+            self._fail(sys.exc_info())
+
+    def _timeout(self):
+        try: raise socket.timeout("timed out")
+        except socket.timeout: self._fail(sys.exc_info())
+
+    def _fail(self, exc_info):
+        self.loop.cancel(self._timer)
+        # There is no socket to close if resolving or creating it is what failed
+        if self.socket is not None: self.close()
+        self.future.set_exception(exc_info)
+
+    def writable(self):
+        return not self.connected or bool(self._out)
+
+    def handle_connect(self):
+        pass
+
+    def handle_write(self):
+        sent = self.send(self._out)
+        self._out = self._out[sent:]
+
+    def handle_read(self):
+        data = self.recv(CHUNK)
+        if data: self._in.append(data)
+
+    def handle_close(self):
+        self.loop.cancel(self._timer)
+        self.close()
+        if self.future.done(): return
+        try:
+            res = httplib.HTTPResponse(_FakeSocket(''.join(self._in)))
+            res.begin()
+            res.body = res.read()
+        except:
+            self.future.set_exception(sys.exc_info())
+            return
+        self.future.set_result(res)
+
+    def handle_error(self):
+        self._fail(sys.exc_info())
+
+def _request_blocking(url, headers, gzip):
+    res = www.POOL.request(url, headers, gzip)
+    try:
+        return res.read(), res.geturl(), dict(res.info().items())
+    finally:
+        res.close()
+
+def request(url, headers, gzip=True):
+    """Coroutine: GETs url, following redirects, and returns (body, final url, headers dict). Raises urllib2.HTTPError for error statuses, like www.POOL.request. https goes through www on a worker thread."""
+    loop = get_loop()
+    for i in range(MAX_REDIRECTS + 1):
+        parts = urlparse.urlsplit(url)
+        if parts.scheme == 'https':
+            raise Return((yield loop.in_thread(_request_blocking, url, headers, gzip)))
+        path = parts.path or '/'
+        if parts.query: path += '?' + parts.query
+        h = dict(headers)
+        if gzip: h['Accept-Encoding'] = 'gzip'
+        fut = Future(loop)
+        _Request(loop, parts.hostname, parts.port or 80, path, h, fut)
+        res = yield fut
+        out_headers = dict(res.msg.items())
+        if res.status in (301, 302, 303, 307) and res.getheader('location'):
+            url = urlparse.urljoin(url, res.getheader('location'))
+            continue
+        if res.status >= 400:
+            raise urllib2.HTTPError(url, res.status, res.reason, res.msg, None)
+        body = res.body
+        if gzip and out_headers.get('content-encoding', '').lower() == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+            del out_headers['content-encoding']
+        raise Return((body, url, out_headers))
+    raise urllib2.HTTPError(url, res.status, "Too many redirects", res.msg, None)
+
+def fetch(url, user_agent=settings.user_agent):
+    """Coroutine: the network half of www.fetch. Records the same stats, and stores the response in the cache, the recorder and the archive if they are on."""
+    host = urlparse.urlsplit(url).hostname
+    stats.incr(host, 'requests')
+    t = time()
+    try:
+        s, final_url, headers = yield request(url, {'User-Agent': user_agent})
+    except:
+        stats.incr(host, 'errors')
+        raise
+    stats.observe(host, 'network', time() - t)
+    stats.observe(host, 'bytes', len(s))
+    if www.CACHE is not None:
+        www.CACHE.put(url, s, final_url, headers)
+    if www.RECORDER is not None:
+        www.RECORDER.put(url, s, final_url, headers)
+    if www.ARCHIVE is not None:
+        www.ARCHIVE.put(url, s)
+    raise Return((s, final_url, headers))
+
+class AsyncOpener():
+    """Opens URLs for one of the HTTP_Opener objects of ads.py or arxiv.py, under the same host rules. With retry set, a failed request is retried every retry seconds, like the ADS opener; otherwise the error is raised, like the arXiv one."""
+    def __init__(self, opener, retry=None):
+        self.opener = opener
+        self.retry = retry
+
+    def _user_agent(self):
+        return getattr(self.opener, 'user_agent', settings.user_agent)
+
+    def open(self, url, verbose=False):
+        """Coroutine: returns (html-content, url), or with verbose (html-content, url, headers). Cached pages are returned without waiting."""
+        out = www.cached(url)
+        while not out:
+            try:
+                out = yield self.submit(url)
+            except Exception, e:
+                if self.retry is None:
+                    print "HTTP failed"
+                    print url
+                    raise
+                stats.incr(self.opener.host, 'retries')
+                print "HTTP failed, retrying :: %s (%s)" % (url, e)
+                yield sleep(self.retry)
+        raise Return(out if verbose else out[:2])
+
+    def submit(self, url):
+        """Coroutine: one attempt at url once the host's rate limit allows it. Returns (html-content, url, headers)."""
+        host = self.opener.host
+        t = time()
+        loop = get_loop()
+        place = Future(loop)
+        wake = lambda: loop.call_soon_threadsafe(place.set_result, None)
+        if ratelimit.scheduler.acquire(host, wake):
+            place.set_result(None)
+        try:
+            yield place
+        except GeneratorExit:
+            # Cancelled in the queue. If the place was handed over meanwhile, it goes back.
+            if not ratelimit.scheduler.withdraw(host, wake):
+                ratelimit.scheduler.release(host)
+            raise
+        try:
+            while True:
+                d = ratelimit.scheduler.take_token(host)
+                if d <= 0: break
+                yield sleep(d)
+            stats.observe(host, 'wait', time() - t)
+            out = yield fetch(url, self._user_agent())
+        finally:
+            ratelimit.scheduler.release(host)
+        raise Return(out)
@@ -0,0 +1,237 @@
+"""An append-only archive of every raw page fetched from ADS and arXiv, so that publications can be re-parsed without re-crawling.
+
+Switch it on with www.archive_enable(PageArchive(path)): every page that fetch returns, from the network or from the HTTP cache, is then added, with the time it was returned. A body that is already archived only costs a record. Pages are kept forever, so a URL may have many fetches.
+
+Files in the archive directory:
+    pages.dat  zlib-compressed bodies, appended one after another. A body is stored once, however many fetches returned it (they are keyed by SHA-1).
+    pages.url  the URLs, appended one after another
+    pages.idx  one fixed-size record per fetch, in fetch order: SHA-1 of the URL, SHA-1 of the body, fetch time, and where the body and the URL are
+    pages.key  (SHA-1 of the URL, fetch time, record number) for the records at the time of the last reindex(), sorted, so that it can be memory-mapped and searched by bisection without being read in
+Records added since the last reindex() are looked up in memory. Run reindex() (or python archive.py reindex) after a crawl to fold them in.
+
+Usage, from src/:
+    python archive.py stats [--path ../archive]
+    python archive.py reindex [--path ../archive]
+    python archive.py get URL [--path ../archive]
+"""
+
+import os, sys, mmap, zlib, struct, hashlib, threading, argparse
+from time import time
+
+ARCHIVE = "../archive"
+READ_RECORDS = 4096 # Records read at a time when streaming pages.idx
+
+# Notes on this module:
+# Each write appends to pages.dat and pages.url before it appends the record that points at them, so a crash can only leave unreferenced bytes at the ends of those files, which are harmless. A partial record at the end of pages.idx is dropped when the archive is next opened.
+# Readers in other processes (reparse.py) open the archive as it stands when they start.
+
+_RECORD = struct.Struct('<20s20sdQIQI') # url sha1, body sha1, fetched, body offset, body length, url offset, url length
+_KEY = struct.Struct('<20sdQ') # url sha1, fetched, record number
+
+def _url_key(url):
+    return hashlib.sha1(url).digest()
+
+class PageArchive():
+    def __init__(self, path=ARCHIVE, readonly=False):
+        self.path = path
+        self.readonly = readonly
+        if not readonly and not os.path.isdir(path):
+            os.makedirs(path)
+        self._lock = threading.Lock()
+        mode = 'rb' if readonly else 'a+b'
+        self._dat = open(os.path.join(path, 'pages.dat'), mode)
+        self._url = open(os.path.join(path, 'pages.url'), mode)
+        idx_path = os.path.join(path, 'pages.idx')
+        if not readonly and os.path.exists(idx_path):
+            size = os.path.getsize(idx_path)
+            if size % _RECORD.size:
+                # A record cut short by a crash. What it pointed at may be incomplete too.
+                f = open(idx_path, 'r+b')
+                f.truncate(size - size % _RECORD.size)
+                f.close()
+        self._idx = open(idx_path, mode)
+        self._bodies = None # body sha1 -> (offset, length), built on the first put
+        self._open_keys()
+
+    def _open_keys(self):
+        """Maps pages.key and reads the records added since into _recent. Caller holds the lock, or is __init__."""
+        keys = None
+        nkeys = 0
+        key_path = os.path.join(self.path, 'pages.key')
+        if os.path.exists(key_path) and os.path.getsize(key_path):
+            f = open(key_path, 'rb')
+            keys = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            f.close()
+            nkeys = len(keys) // _KEY.size
+        recent = {} # url sha1 -> [(fetched, record number)] for records that pages.key does not cover
+        for n, rec in self._iter_raw(nkeys):
+            recent.setdefault(rec[0], []).append((rec[2], n))
+        old = getattr(self, '_keys', None)
+        self._keys, self._nkeys, self._recent = keys, nkeys, recent
+        if old is not None: old.close()
+
+    def __len__(self):
+        self._idx.flush()
+        return os.fstat(self._idx.fileno()).st_size // _RECORD.size
+
+    def put(self, url, body, fetched=None):
+        """Adds a fetch of url that returned body, at fetched (by default, now). Returns its record number."""
+        if self.readonly: raise IOError("Archive %s is open read-only" % self.path)
+        if fetched is None: fetched = time()
+        digest = hashlib.sha1(body).digest()
+        key = _url_key(url)
+        with self._lock:
+            if self._bodies is None:
+                self._bodies = dict([(rec[1], (rec[3], rec[4])) for (n, rec) in self._iter_raw(0)])
+            where = self._bodies.get(digest)
+            if where is None:
+                data = zlib.compress(body)
+                self._dat.seek(0, 2)
+                where = self._bodies[digest] = (self._dat.tell(), len(data))
+                self._dat.write(data)
+                self._dat.flush()
+            self._url.seek(0, 2)
+            url_at = self._url.tell()
+            self._url.write(url)
+            self._url.flush()
+            self._idx.seek(0, 2)
+            n = self._idx.tell() // _RECORD.size
+            self._idx.write(_RECORD.pack(key, digest, fetched, where[0], where[1], url_at, len(url)))
+            self._idx.flush()
+            self._recent.setdefault(key, []).append((fetched, n))
+        return n
+
+    def record(self, n):
+        """Returns (url, fetched, body sha1 in hex) for record n."""
+        rec = self._read_record(n)
+        return self._read_url(rec), rec[2], rec[1].encode('hex')
+
+    def body(self, n):
+        """Returns the body of record n."""
+        rec = self._read_record(n)
+        return self._read_body(rec)
+
+    def fetches(self, url):
+        """Returns [(fetched, record number)] for every fetch of url, oldest first."""
+        key = _url_key(url)
+        out = []
+        # Under the lock, so that reindex cannot close the map or swap _recent halfway through
+        with self._lock:
+            keys, nkeys = self._keys, self._nkeys
+            if keys is not None:
+                lo, hi = 0, nkeys
+                while lo < hi:
+                    mid = (lo + hi) // 2
+                    if keys[mid * _KEY.size:mid * _KEY.size + 20] < key: lo = mid + 1
+                    else: hi = mid
+                i = lo
+                while i < nkeys:
+                    k, fetched, n = _KEY.unpack_from(keys, i * _KEY.size)
+                    if k != key: break
+                    out.append((fetched, n))
+                    i += 1
+            out.extend(self._recent.get(key, []))
+        out.sort()
+        return out
+
+    def get(self, url, at=None):
+        """Returns the body of the latest fetch of url, or of the latest at or before the time at, or None if there is none."""
+        found = None
+        for fetched, n in self.fetches(url):
+            if at is not None and fetched > at: break
+            found = n
+        if found is None: return None
+        return self.body(found)
+
+    def iter_records(self, start=0):
+        """Yields (record number, url, fetched, body sha1 in hex) for every fetch, in fetch order, without reading any bodies."""
+        for n, rec in self._iter_raw(start):
+            yield n, self._read_url(rec), rec[2], rec[1].encode('hex')
+
+    def iter_pages(self, start=0, urls=None):
+        """Yields (record number, url, fetched, body) for every fetch in fetch order, or only for those whose url urls(url) accepts. One body is held at a time."""
+        for n, rec in self._iter_raw(start):
+            url = self._read_url(rec)
+            if urls is not None and not urls(url): continue
+            yield n, url, rec[2], self._read_body(rec)
+
+    def reindex(self):
+        """Rewrites pages.key to cover every record. Returns the number of records."""
+        if self.readonly: raise IOError("Archive %s is open read-only" % self.path)
+        with self._lock:
+            keys = [(rec[0], rec[2], n) for (n, rec) in self._iter_raw(0)]
+            keys.sort()
+            key_path = os.path.join(self.path, 'pages.key')
+            # Write-then-rename, so that readers that have the old file mapped keep a consistent view.
+            tmp = key_path + '.tmp'
+            f = open(tmp, 'wb')
+            for k in keys:
+                f.write(_KEY.pack(*k))
+            f.close()
+            os.rename(tmp, key_path)
+            self._open_keys()
+        return len(keys)
+
+    def close(self):
+        for f in (self._dat, self._url, self._idx):
+            f.close()
+        if self._keys is not None:
+            self._keys.close()
+
+    def _iter_raw(self, start):
+        """Yields (record number, unpacked record) from start to the end of pages.idx, through a file handle of its own so that it can run alongside lookups."""
+        self._idx.flush()
+        f = open(self._idx.name, 'rb')
+        try:
+            f.seek(start * _RECORD.size)
+            n = start
+            while True:
+                block = f.read(READ_RECORDS * _RECORD.size)
+                for i in range(len(block) // _RECORD.size):
+                    yield n, _RECORD.unpack_from(block, i * _RECORD.size)
+                    n += 1
+                if len(block) < READ_RECORDS * _RECORD.size: break
+        finally:
+            f.close()
+
+    def _read_record(self, n):
+        with self._lock:
+            self._idx.seek(n * _RECORD.size)
+            s = self._idx.read(_RECORD.size)
+        if len(s) < _RECORD.size: raise IndexError("No record %d in %s" % (n, self.path))
+        return _RECORD.unpack(s)
+
+    def _read_url(self, rec):
+        with self._lock:
+            self._url.seek(rec[5])
+            return self._url.read(rec[6])
+
+    def _read_body(self, rec):
+        with self._lock:
+            self._dat.seek(rec[3])
+            data = self._dat.read(rec[4])
+        return zlib.decompress(data)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Inspect or reindex the raw page archive.")
+    parser.add_argument('command', choices=['stats', 'reindex', 'get'])
+    parser.add_argument('url', nargs='?')
+    parser.add_argument('--path', default=ARCHIVE)
+    args = parser.parse_args()
+    if args.command == 'reindex':
+        a = PageArchive(args.path)
+        print "Indexed %d records." % a.reindex()
+    elif args.command == 'get':
+        if not args.url: parser.error("get needs a URL")
+        a = PageArchive(args.path, readonly=True)
+        body = a.get(args.url)
+        if body is None:
+            print >> sys.stderr, "Not archived: %s" % args.url
+            sys.exit(1)
+        sys.stdout.write(body)
+    else:
+        a = PageArchive(args.path, readonly=True)
+        bodies = set()
+        for n, url, fetched, digest in a.iter_records():
+            bodies.add(digest)
+        print "%d fetches, %d distinct bodies, %d compressed bytes, %d of the records in pages.key." % (len(a), len(bodies), os.path.getsize(os.path.join(args.path, 'pages.dat')), a._nkeys)
@@ -1,100 +1,230 @@
-import www
+import os, socket, hashlib, urllib2, httplib, urlparse
+import settings
+import www, ratelimit, stats, aio
 import xml.dom.minidom as xdm
 import datetime
-from time import time, sleep
+from time import time
 # When you decide to solve a problem with regular expressions, you now have two problems.
 import re
 
+# Where arXiv and its API are, and how politely we load them. settings may override these (arxiv_base, arxiv_export_base, arxiv_wait, arxiv_concurrency), e.g. to run against replay.py, and configure() changes them at run time.
+ARXIV_BASE = getattr(settings, 'arxiv_base', "http://arxiv.org").rstrip('/')
+ARXIV_EXPORT_BASE = getattr(settings, 'arxiv_export_base', "http://export.arxiv.org").rstrip('/')
+ARXIV_WAIT = getattr(settings, 'arxiv_wait', 60) # Minimum wait, in seconds, between loading two resources.
+ARXIV_CONCURRENCY = getattr(settings, 'arxiv_concurrency', 1)
+
 class HTTP_Opener():
     def __init__(self):
-        self.prev_time = None
-        self.WAIT_TIME = 60 # Minimum wait, in seconds, between loading two resources.
         self.user_agent = r'GilesBot/1.0 (downloading data for a short list of articles)'
+        self.configure(ARXIV_BASE, ARXIV_WAIT, ARXIV_CONCURRENCY)
+    def configure(self, base, wait, concurrency=1):
+        self.host = urlparse.urlsplit(base).netloc # The export API shares the same politeness budget
+        self.WAIT_TIME = wait
+        ratelimit.scheduler.add_host(self.host, self.WAIT_TIME, concurrency=concurrency)
+    def submit(self,url):
+        """Queues a request for url behind the arXiv rate limit and returns a ratelimit.Future for (html-content, url, headers)."""
+        return ratelimit.scheduler.submit(self.host, www.fetch, url, self.user_agent, False)
     def open(self,url,verbose=False):
-        """Handles all errors by crashing out."""
-        while True:
-            my_time = time()
-            if self.prev_time:
-                # If something messes with the system clock, this assert might fire:
-                assert(my_time > self.prev_time)
-                sleep(self.WAIT_TIME - min((my_time - self.prev_time), self.WAIT_TIME))
-            self.prev_time = my_time
+        """Handles all errors by crashing out. Cached pages are returned without waiting."""
+        out = www.cached(url)
+        if not out:
             try: 
-                res = www.open_http(url,self.user_agent,True)
-                if verbose:
-                    return ''.join(res.readlines()), res.geturl(), res.info()
-                else:
-                    return ''.join(res.readlines()), res.geturl()
+                out = self.submit(url).result()
             except:
                 print "HTTP failed"
                 print url
                 raise
+        if verbose:
+            return out
+        else:
+            return out[:2]
+    def open_stream(self,url,headers=None):
+        """Opens url behind the arXiv rate limit and returns the unread www.Response, so that large files can be streamed. Never cached, and the transfer is not gzip-decoded."""
+        return ratelimit.scheduler.call(self.host, www.open_http, url, self.user_agent, True, False, headers)
+    def head(self,url):
+        """Makes a HEAD request for url behind the arXiv rate limit and returns the headers, so that a file's size can be checked without downloading it."""
+        return ratelimit.scheduler.call(self.host, www.head, url, self.user_agent)
 
 http_opener = HTTP_Opener()
+async_opener = aio.AsyncOpener(http_opener) # Failures are raised, as with http_opener
+
+def configure(base=None, export_base=None, wait=None, concurrency=None):
+    """Points the arXiv functions at other servers and/or changes the wait between requests and the number of requests in flight. Arguments left as None keep their value."""
+    global ARXIV_BASE, ARXIV_EXPORT_BASE, ARXIV_WAIT, ARXIV_CONCURRENCY
+    if base is not None: ARXIV_BASE = base.rstrip('/')
+    if export_base is not None: ARXIV_EXPORT_BASE = export_base.rstrip('/')
+    if wait is not None: ARXIV_WAIT = wait
+    if concurrency is not None: ARXIV_CONCURRENCY = concurrency
+    http_opener.configure(ARXIV_BASE, ARXIV_WAIT, ARXIV_CONCURRENCY)
+
+DOWNLOAD_CHUNK = 256 * 1024
+DOWNLOAD_TRIES = 3 # Attempts at one file. Each retry resumes from where the last one stopped.
+
+def _md5(path):
+    h = hashlib.md5()
+    f = open(path, 'rb')
+    for block in iter(lambda: f.read(DOWNLOAD_CHUNK), ''):
+        h.update(block)
+    f.close()
+    return h.hexdigest()
+
+def _remove(path):
+    if os.path.exists(path): os.remove(path)
+
+def _stream_download(url, dest, md5=None, accept=None):
+    """Streams url to dest through dest.part, which is renamed into place once complete. Returns False if accept(headers) rejects the response, True otherwise. A dest that is already there is kept if its MD5 is md5 or, without md5, if its size is the one a HEAD request reports, so keeping it costs no transfer."""
+    part = dest + '.part'
+    if os.path.exists(dest):
+        if md5:
+            if _md5(dest) == md5:
+                # A .part left from before dest was complete is of no more use.
+                _remove(part)
+                return True
+        else:
+            info = http_opener.head(url)
+            if accept and not accept(info):
+                return False
+            length = info.get('content-length')
+            if length is not None and os.path.getsize(dest) == int(length):
+                _remove(part)
+                return True
+    for attempt in range(DOWNLOAD_TRIES):
+        have = os.path.getsize(part) if os.path.exists(part) else 0
+        headers = {'Range': 'bytes=%d-' % have} if have else None
+        try:
+            res = http_opener.open_stream(url, headers)
+        except urllib2.HTTPError, e:
+            if e.code == 416 and have:
+                stats.incr(http_opener.host, 'retries')
+                # The partial file is no prefix of what is there now. Start over.
+                os.remove(part)
+                continue
+            raise
+        try:
+            info = res.info()
+            if accept and not accept(info):
+                return False
+            length = info.get('content-length')
+            if res.getcode() == 206:
+                # Content-Range: bytes 1000-4999/5000
+                total = int(info['content-range'].split('/')[-1])
+                mode = 'ab'
+            else:
+                total = int(length) if length else None
+                mode = 'wb'
+            if md5 is None and total is not None and os.path.exists(dest) and os.path.getsize(dest) == total:
+                # Only when HEAD gave no size
+                _remove(part)
+                return True
+            f = open(part, mode)
+            t = time()
+            got = 0
+            try:
+                for block in iter(lambda: res.read(DOWNLOAD_CHUNK), ''):
+                    f.write(block)
+                    got += len(block)
+            finally:
+                f.close()
+                stats.observe(http_opener.host, 'download', time() - t)
+                stats.observe(http_opener.host, 'download_bytes', got)
+        except (socket.error, httplib.HTTPException):
+            stats.incr(http_opener.host, 'retries')
+            print "Warning: transfer interrupted, will resume :: %s" % url
+            continue
+        finally:
+            res.close()
+        if total is not None and os.path.getsize(part) < total:
+            stats.incr(http_opener.host, 'retries')
+            print "Warning: transfer incomplete, will resume :: %s" % url
+            continue
+        os.rename(part, dest)
+        return True
+    raise IOError("Could not download %s after %d attempts" % (url, DOWNLOAD_TRIES))
 
 class ArXivRecord():
     def __init__(self, aid):
         self.id = aid
         self._abs_html = False # The HTML of the latest abstract page.
-        self._abs_html_old = False # A list of the HTML of the old abstract pages.
         self._entry_xml = False
         self._categories = False
         self._versions = False
         self._submitter = False
-        self._comments = False
+        self._comments = {} # Version number -> comment. We keep the comments, not the pages they came from.
         
-    def download(self, path):
+    def download(self, path, checksums=None):
+        """Saves the PDF and, if there is one, the gzipped source of the latest version into the directory path. Returns a list of [kind, path] pairs. Files are streamed to disk, a partial file left by a dropped connection is resumed, and a file already on disk is kept if its size matches what a HEAD request reports, or its MD5 matches checksums[kind] when that is given."""
 
         path += '/'
+        checksums = checksums or {}
 
         out = []
 
         pdf_path = path + "%s.pdf" % self.id
         # We let IOErrors bubble up
-        pdf_file = open(pdf_path,'w')
-
-        pdf, _ = http_opener.open("http://arxiv.org/pdf/%s" % self.id)
-        pdf_file.write(pdf)
-        pdf_file.close()
-
+        _stream_download(ARXIV_BASE + "/pdf/%s" % self.id, pdf_path, checksums.get('pdf'))
         out.append(["pdf",pdf_path])
 
         if "PDF only" in self.abs_html():
             print "No sources available."
             return out
 
-        source, _, source_info = http_opener.open("http://arxiv.org/e-print/%s" % self.id, True)
-        try:
-            encoding = source_info['content-encoding']
-        except KeyError:
-            encoding = None
-            print "Warning: could not get source file encoding :: %s." % self.id
-            return out
+        source_path = path + "%s-source.gz" % self.id
+        def is_gzip(info):
+            try:
+                encoding = info['content-encoding']
+            except KeyError:
+                print "Warning: could not get source file encoding :: %s." % self.id
+                return False
+            if encoding != 'x-gzip':
+                print "Warning: Got a source file that was not a gzip :: %s." % self.id
+                return False
+            return True
 
-        if encoding == 'x-gzip':
-            source_path = path + "%s-source.gz"
-            source_file = open( source_path % self.id,'w')
-            source_file.write(source)
-            source_file.close()
+        if _stream_download(ARXIV_BASE + "/e-print/%s" % self.id, source_path, checksums.get('gz'), is_gzip):
             out.append(['gz',source_path])
-        else:
-            print "Warning: Got a source file that was not a gzip :: %s." % self.id
 
         return out
 
+    def abs_url(self, version=None):
+        if version is None: return ARXIV_BASE + "/abs/%s" % self.id
+        return ARXIV_BASE + "/abs/%sv%d" % (bare_id(self.id), version)
+
     def abs_html(self):
         if not self._abs_html:
-            abs_url = "http://arxiv.org/abs/%s" % self.id
-            self._abs_html, _ = http_opener.open(abs_url)
+            self._abs_html, _ = http_opener.open(self.abs_url())
         return self._abs_html
 
+    def atom_url(self):
+        return ARXIV_EXPORT_BASE + "/api/query?id_list=%s" % self.id
+
     def entry_xml(self):
         if not self._entry_xml:
-            atom_url = "http://export.arxiv.org/api/query?id_list=%s" % self.id
-            s, _ = http_opener.open(atom_url)
+            s, _ = http_opener.open(self.atom_url())
             self._entry_xml = xdm.parseString(s).getElementsByTagName("entry")[0]
         return self._entry_xml
 
+    def preload_async(self, all_comments=True):
+        """Coroutine: preload for aio's event loop. The abs page and the Atom entry are requested together and, with all_comments, then the abs pages of all the versions whose comments we do not have, so that comments() needs no more requests either."""
+        abs_page, atom = yield [None if self._abs_html else async_opener.open(self.abs_url()),
+                                None if self._entry_xml else async_opener.open(self.atom_url())]
+        if abs_page: self._abs_html = abs_page[0]
+        if atom: self._entry_xml = xdm.parseString(atom[0]).getElementsByTagName("entry")[0]
+        if all_comments:
+            numv = len(self.versions() or [])
+            todo = [i for i in range(1, numv + 1) if i not in self._comments and i != self._shown_version(numv)]
+            pages = yield [async_opener.open(self.abs_url(i)) for i in todo]
+            for i, p in zip(todo, pages):
+                self._comments[i] = _comment_from_abs(p[0])
+
+    def use_pages(self, abs_html=None, entry_xml=None, version_pages=None, comments=None):
+        """Gives the record pages that we already have, e.g. from an archive.PageArchive, so that it does not load them: the abs page, the Atom <entry> element (see atom_entries) and {version number: abs page of that version}. comments is {version number: comment}, e.g. from a stored ArxivEntry, for versions whose pages we no longer have."""
+        if abs_html is not None: self._abs_html = abs_html
+        if entry_xml is not None: self._entry_xml = entry_xml
+        for i, p in (version_pages or {}).items():
+            self._comments[i] = _comment_from_abs(p)
+        for i, c in (comments or {}).items():
+            self._comments[i] = c
+
     def preload(self, abs_html = True, entry_xml = True):
         """Normally, remote pages are lazily loaded. However, this means that any method that collects data could raise an error (because it went to lazily load a page and failed). If you don't want to be responsible for this, then use this method to preload everything you need. Once this is done, only self.download and self.comments can still raise an HTTP error."""
         if abs_html: self.abs_html()
@@ -129,18 +259,81 @@ class ArXivRecord():
             self._versions = [x[1] for x in sorted(out, key=lambda x: x[0])]
         return self._versions
 
-    def comments(self):
-        """Returns a list of comments ordered by version number."""
-        if self._comments: return self._comments
+    def comments(self, all_versions=True):
+        """Returns a list of comments ordered by version number. The comment of the version shown on the abstract page comes from that page, which we already have. Neither the abs page nor the Atom and OAI metadata carry the comments of earlier versions, so with all_versions those are read from the versioned abs pages, fetching only the versions we have not seen yet. Without all_versions, they are None."""
         numv = len(self.versions())
-        self._abs_html_old = []
-        self._comments = []
-        for i in range(1, numv + 1):
-            url = "http://arxiv.org/abs/%sv%d" % (self.id, i)
-            p, _ = http_opener.open(url)
-            self._abs_html_old.append(p)
-            m = re.search(r'<td class="tablecell comments">(.*?)</td>', p, flags = re.MULTILINE)
-            if m: 
-                self._comments.append(m.group(1))
-            else: self._comments.append('')
-        return self._comments
+        shown = self._shown_version(numv)
+        if shown not in self._comments:
+            self._comments[shown] = _comment_from_abs(self.abs_html())
+        if all_versions:
+            for i in range(1, numv + 1):
+                if i in self._comments: continue
+                p, _ = http_opener.open(self.abs_url(i))
+                self._comments[i] = _comment_from_abs(p)
+        return [self._comments.get(i) for i in range(1, numv + 1)]
+
+    def forget_cached(self):
+        """Drops our pages from www's cache: the abs page and the Atom entry, which change with each new version. The abs pages of earlier versions stay."""
+        self._abs_html = False
+        self._versions = False
+        self._submitter = False
+        www.cache_invalidate(self.abs_url())
+        www.cache_invalidate(self.atom_url())
+
+    def latest_version(self):
+        """Returns the number of the latest version, from the Atom entry, which prefetch_entries can load for many papers at once. The abs page is not needed."""
+        # Looks like <id>http://arxiv.org/abs/hep-th/9901001v3</id>
+        m = re.search(r'v([0-9]+)$', self.entry_xml().getElementsByTagName("id")[0].firstChild.data)
+        return int(m.group(1)) if m else None
+
+    def _shown_version(self, numv):
+        """The version on the page at abs_url(): the one in our id, or else the latest."""
+        m = re.search(r'v([0-9]+)$', self.id)
+        return int(m.group(1)) if m else numv
+
+COMMENTS_REGEX = re.compile(r'<td class="tablecell comments">(.*?)</td>', flags = re.MULTILINE)
+
+def _comment_from_abs(p):
+    m = COMMENTS_REGEX.search(p)
+    if m: return m.group(1)
+    return ''
+
+ATOM_CHUNK = 100 # arXiv ids per Atom API request. The API takes hundreds, but large responses are slow to come back.
+
+def bare_id(aid):
+    """Strips any version suffix from an arXiv id: 1101.0001v2 -> 1101.0001"""
+    return re.sub(r'v[0-9]+$', '', aid)
+
+def prefetch_entries(records, chunk=ATOM_CHUNK, fresh=False):
+    """Takes a list of ArXivRecords or arXiv ids and fills in the Atom entries of those that do not have one yet, using one API request per chunk of ids rather than one per paper. Returns the list of ArXivRecords. Ids that the API does not know about are left to be loaded lazily (and fail) as before. With fresh, the cache is not read, so the entries are current."""
+    records = [x if isinstance(x, ArXivRecord) else ArXivRecord(x) for x in records]
+    todo = {}
+    ids = []
+    for r in records:
+        if not r._entry_xml:
+            aid = bare_id(r.id)
+            if aid not in todo: ids.append(aid)
+            todo.setdefault(aid, []).append(r)
+    # Bare ids, so that the API answers with the latest version of each and its entries map back onto todo
+    for i in range(0, len(ids), chunk):
+        part = ids[i:i + chunk]
+        atom_url = ARXIV_EXPORT_BASE + "/api/query?id_list=%s&max_results=%d" % (','.join(part), len(part))
+        s = http_opener.submit(atom_url).result()[0] if fresh else http_opener.open(atom_url)[0]
+        for aid, e in atom_entries(s).items():
+            for r in todo.get(aid, []):
+                r._entry_xml = e
+    return records
+
+def atom_entries(s):
+    """Takes the text of an Atom API response and returns {arXiv id without version: <entry> element}."""
+    out = {}
+    for e in xdm.parseString(s).getElementsByTagName("entry"):
+        # Looks like <id>http://arxiv.org/abs/hep-th/9901001v1</id>
+        aid = e.getElementsByTagName("id")[0].firstChild.data.split('/abs/')[-1]
+        out[bare_id(aid)] = e
+    return out
+
+def atom_ids(url):
+    """Returns the arXiv ids without version that an Atom API URL asks for, from its id_list."""
+    q = urlparse.parse_qs(urlparse.urlsplit(url).query)
+    return [bare_id(x) for x in ','.join(q.get('id_list', [])).split(',') if x]
@@ -0,0 +1,231 @@
+"""Benchmarks. Run from src/:
+    python bench.py [--fixtures ../fixtures] [--out ../bench_results.jsonl] [--repeat N] [--only NAME ...]
+
+The parsing benchmarks run on a corpus of real pages recorded with fixtures.py; the ones whose pages are missing are skipped. mongo_dump and Name.compatible fall back to synthetic data. Each run appends one JSON line per benchmark to the results file (time, revision, items, seconds, items per second, peak RSS and its growth) and prints the change against the last comparable run.
+"""
+
+import os, gc, sys, json, argparse, datetime, subprocess, resource
+from time import time
+
+import hphys_types as ht
+import fixtures
+
+RESULTS = "../bench_results.jsonl"
+REPEAT = 5 # Passes over the corpus in each benchmark
+MAX_NAME_PAIRS = 200000
+
+def sample_publication(i, nauthors=10):
+    """A Publication shaped like the ones abstract_read builds."""
+    pub = ht.Publication()
+    pub.ads_bibcode = "2011PhRvL.%03d.%04dX" % (i % 1000, i)
+    pub.publication_type = 'article'
+    pub.title = ht.LatexString({'contents': 'On the {\\it quantum} theory of things, part %d' % i})
+    pub.abstract = ht.HTMLString({'contents': 'We study things. ' * 40})
+    pub.authors = [{'name': ht.Name({'names': ['A.', 'B%d.' % j], 'last': 'Author%d' % j}), 'affiliation': 'Department of Physics, University %d' % j} for j in range(nauthors)]
+    pub.pacs_codes = ['03.65.-w', '03.67.Bg']
+    pub.keywords = ['Quantum mechanics', 'Entanglement']
+    pub.doi = '10.1103/PhysRevLett.%d' % i
+    pub.arxiv_id = '1101.%04d' % i
+    snap = ht.JournalSnapshot({'journal': 'Physical Review Letters', 'volume': '106', 'pages': str(i)})
+    snap.date = ht.MonthYear({'month': 1, 'year': 2011})
+    pub.published_snapshots = [snap]
+    entry = ht.ArxivEntry({'primary_category': 'quant-ph', 'categories': ['cond-mat']})
+    entry.snapshots = [ht.ArxivSnapshot({'date': datetime.datetime(2011, 1, 1), 'comment': '4 pages', 'version': 1})]
+    pub.arxiv_entry = entry
+    return pub
+
+def _time(f, *args):
+    t = time()
+    out = f(*args)
+    return time() - t, out
+
+def bench_serializers(n=20000):
+    """Times the recursive mongo_dump / mongo_read against the generated batch serializers on n Publications. Returns a dict of timings in seconds."""
+    pubs = [sample_publication(i) for i in range(n)]
+    t_dump, docs = _time(lambda: [ht.mongo_dump(p) for p in pubs])
+    t_dump_batch, docs_batch = _time(ht.mongo_dump_batch, pubs)
+    assert docs == docs_batch
+    t_read, _ = _time(lambda: [ht.mongo_read(d) for d in docs])
+    t_read_batch, read = _time(ht.mongo_read_batch, docs)
+    assert ht.mongo_dump_batch(read) == docs
+    return {'n': n, 'mongo_dump': t_dump, 'mongo_dump_batch': t_dump_batch, 'mongo_read': t_read, 'mongo_read_batch': t_read_batch}
+
+def _maxrss():
+    # Kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def _measure(name, n, f, repeat=REPEAT):
+    """Runs f() repeat times on n items and returns the result record."""
+    gc.collect()
+    rss = _maxrss()
+    t = time()
+    for i in range(repeat):
+        f()
+    dt = time() - t
+    return {'bench': name, 'items': n * repeat, 'seconds': dt, 'per_second': n * repeat / dt if dt else None,
+            'maxrss_kb': _maxrss(), 'rss_growth_kb': _maxrss() - rss}
+
+def _ads_pages(store):
+    return [b for (u, b) in store.bodies('ads_abs')] if store else []
+
+def bench_affiliations(store, repeat=REPEAT):
+    pages = _ads_pages(store)
+    if not pages: return None
+    import ads
+    return _measure('affiliations_from_abstract', len(pages), lambda: [ads.affiliations_from_abstract(p) for p in pages], repeat)
+
+def bench_pacs(store, repeat=REPEAT):
+    """pacs_keywords_parse on the PACS lines of the recorded pages, with its memo emptied before each pass."""
+    pages = _ads_pages(store)
+    if not pages: return None
+    import ads
+    lines = [x for x in [ads.abstract_page_fields(p)['pacs'] for p in pages] if x]
+    if not lines: return None
+    ads.pacs_keywords_parse(lines[0]) # Loads the PACS tables outside the timing
+    def run():
+        ads._pacs_parse_memo.clear()
+        for x in lines: ads.pacs_keywords_parse(x)
+    return _measure('pacs_keywords_parse', len(lines), run, repeat)
+
+def _arxiv_records(store):
+    """ArXivRecords with the recorded abs page and Atom entry of each e-print filled in."""
+    import arxiv
+    if not store: return []
+    entries = {}
+    for url, body in store.bodies('arxiv_atom'):
+        entries.update(arxiv.atom_entries(body))
+    out = []
+    for url, body in store.bodies('arxiv_abs'):
+        r = arxiv.ArXivRecord(url.split('/abs/')[-1])
+        e = entries.get(arxiv.bare_id(r.id))
+        if e:
+            r.use_pages(body, e)
+            out.append(r)
+    return out
+
+def bench_arxiv(store, repeat=REPEAT):
+    """ArXivRecord.versions and categories on recorded pages, with their memoized results dropped before each pass."""
+    records = _arxiv_records(store)
+    if not records: return None
+    def run():
+        for r in records:
+            r._versions = False
+            r._categories = False
+            r.versions()
+            r.categories()
+    return _measure('arxiv_versions_categories', len(records), run, repeat)
+
+def _publications(store):
+    """Publications parsed from the recorded ADS pages, or synthetic ones if there are none (or no BibTeX parser)."""
+    pubs = []
+    if store:
+        try:
+            import ads
+            for url in store.urls('ads_abs'):
+                code = url.split('/abs/')[-1]
+                bib = [x for x in store.urls('ads_bibtex') if 'bibcode=%s&' % code in x]
+                if bib: pubs.append(ads.abstract_parse(code, store.body(url), store.body(bib[0])))
+        except Exception, e:
+            print >> sys.stderr, "Warning: could not parse the recorded pages, using synthetic Publications (%s)" % e
+            pubs = []
+    return pubs or [sample_publication(i) for i in range(2000)], bool(pubs)
+
+def bench_mongo_dump(store, repeat=REPEAT):
+    pubs, real = _publications(store)
+    out = [_measure('mongo_dump', len(pubs), lambda: [ht.mongo_dump(p) for p in pubs], repeat),
+           _measure('mongo_dump_batch', len(pubs), lambda: ht.mongo_dump_batch(pubs), repeat)]
+    for x in out: x['synthetic'] = not real
+    return out
+
+def bench_names(store, repeat=REPEAT):
+    """Name.compatible on every pair of author names that share a last name, across the recorded pages."""
+    names = []
+    for p in _ads_pages(store):
+        import ads
+        names.extend([x[0] for x in ads.affiliations_from_abstract(p)])
+    real = bool(names)
+    if not real:
+        names = [ht.Name({'last': 'Author%d' % (i % 50), 'names': [['A.', 'Alice', 'Al.', 'B.'][i % 4]] + (['B.'] if i % 3 else [])}) for i in range(2000)]
+    by_last = {}
+    for n in names:
+        by_last.setdefault(n.last, []).append(n)
+    pairs = []
+    for group in by_last.values():
+        pairs.extend([(a, b) for a in group for b in group])
+    pairs = pairs[:MAX_NAME_PAIRS]
+    out = _measure('name_compatible', len(pairs), lambda: [a.compatible(b) for (a, b) in pairs], repeat)
+    out['synthetic'] = not real
+    return out
+
+BENCHMARKS = [('affiliations_from_abstract', bench_affiliations),
+              ('pacs_keywords_parse', bench_pacs),
+              ('arxiv', bench_arxiv),
+              ('mongo_dump', bench_mongo_dump),
+              ('name_compatible', bench_names)]
+
+def _revision():
+    try:
+        return subprocess.Popen(['git', 'rev-parse', '--short', 'HEAD'], stdout=subprocess.PIPE, stderr=open(os.devnull, 'w')).communicate()[0].strip() or None
+    except OSError:
+        return None
+
+def _previous(path):
+    """The last result of each benchmark in the results file, keyed by (bench, synthetic)."""
+    out = {}
+    if not os.path.exists(path): return out
+    f = open(path)
+    for line in f:
+        try:
+            r = json.loads(line)
+        except ValueError:
+            continue
+        out[(r['bench'], r.get('synthetic', False))] = r
+    f.close()
+    return out
+
+def run(fixtures_path=fixtures.FIXTURES, out_path=RESULTS, repeat=REPEAT, only=None):
+    """Runs the benchmarks, appends their results to out_path and returns them."""
+    store = fixtures.FixtureStore(fixtures_path) if os.path.exists(os.path.join(fixtures_path, 'index.json')) else None
+    if store is None:
+        print "No fixtures at %s: only the synthetic benchmarks will run." % fixtures_path
+    previous = _previous(out_path)
+    stamp = datetime.datetime.utcnow().isoformat()
+    revision = _revision()
+    results = []
+    for name, f in BENCHMARKS:
+        if only and name not in only: continue
+        r = f(store, repeat)
+        if r is None:
+            print "%-28s skipped: nothing recorded" % name
+            continue
+        for x in (r if isinstance(r, list) else [r]):
+            x.update({'time': stamp, 'revision': revision, 'repeat': repeat})
+            x.setdefault('synthetic', False)
+            results.append(x)
+            last = previous.get((x['bench'], x['synthetic']))
+            change = ''
+            if last and last.get('per_second') and x['per_second']:
+                change = "%+.1f%% vs %s" % (100.0 * (x['per_second'] / last['per_second'] - 1), last.get('revision') or last['time'])
+            print "%-28s %10.1f items/s %8d kB peak %s%s" % (x['bench'], x['per_second'] or 0, x['maxrss_kb'], '(synthetic) ' if x['synthetic'] else '', change)
+    f = open(out_path, 'a')
+    for x in results:
+        f.write(json.dumps(x, sort_keys=True) + '\n')
+    f.close()
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the parsers and serializers on recorded pages.")
+    parser.add_argument('--fixtures', default=fixtures.FIXTURES)
+    parser.add_argument('--out', default=RESULTS, help='JSON-lines file the results are appended to')
+    parser.add_argument('--repeat', type=int, default=REPEAT)
+    parser.add_argument('--only', nargs='*', choices=[x[0] for x in BENCHMARKS])
+    parser.add_argument('--serializers', action='store_true', help='Also compare mongo_dump/mongo_read with the batch serializers')
+    args = parser.parse_args()
+    run(args.fixtures, args.out, args.repeat, args.only)
+    if args.serializers:
+        r = bench_serializers()
+        print "%d Publications" % r['n']
+        print "mongo_dump       %.3f s" % r['mongo_dump']
+        print "mongo_dump_batch %.3f s (%.1fx)" % (r['mongo_dump_batch'], r['mongo_dump'] / r['mongo_dump_batch'])
+        print "mongo_read       %.3f s" % r['mongo_read']
+        print "mongo_read_batch %.3f s (%.1fx)" % (r['mongo_read_batch'], r['mongo_read'] / r['mongo_read_batch'])
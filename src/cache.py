@@ -0,0 +1,133 @@
+"""An opt-in, on-disk cache of HTTP responses, keyed by URL. Switch it on with www.cache_enable."""
+
+import os, zlib, json, hashlib, sqlite3, threading, urlparse
+from time import time
+
+# Notes on this module:
+# Bodies are content-addressed: each one is stored once, zlib-compressed, under the SHA-1 of its uncompressed bytes. Several URLs may point at the same body (ADS serves identical pages under equivalent URLs).
+# The index is a sqlite file next to the bodies. It holds the URL -> body mapping, the response headers and the access times that drive LRU eviction.
+
+# Seconds for which a cached response stays fresh, by host. None means forever.
+HOST_TTLS = {'adsabs.harvard.edu': 30 * 24 * 3600, # Abstract pages and BibTeX change rarely
+             'arxiv.org': 24 * 3600, # New versions appear on arXiv
+             'export.arxiv.org': 24 * 3600}
+DEFAULT_TTL = 24 * 3600
+MAX_BYTES = 2 * 1024 ** 3 # Compressed bytes on disk before we start evicting
+EVICT_BATCH = 64
+
+class HTTPCache():
+    def __init__(self, path, max_bytes=MAX_BYTES, ttls=None, default_ttl=DEFAULT_TTL):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttls = dict(HOST_TTLS)
+        if ttls: self.ttls.update(ttls)
+        self.default_ttl = default_ttl
+        self._objects = os.path.join(path, 'objects')
+        if not os.path.isdir(self._objects):
+            os.makedirs(self._objects)
+        # The openers may be used from several threads at once, so one connection is shared under a lock.
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(path, 'index.sqlite'), check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS entries (url TEXT PRIMARY KEY, digest TEXT, final_url TEXT, headers TEXT, stored REAL, accessed REAL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS objects (digest TEXT PRIMARY KEY, size INTEGER, refs INTEGER)")
+        self._db.commit()
+
+    def ttl(self, url):
+        """Returns the freshness lifetime in seconds for url, or None if it never expires."""
+        host = urlparse.urlparse(url).hostname
+        return self.ttls.get(host, self.default_ttl)
+
+    def _object_path(self, digest):
+        return os.path.join(self._objects, digest[:2], digest)
+
+    def get(self, url):
+        """Returns (html-content, url, headers) for a fresh copy of url, or None."""
+        with self._lock:
+            row = self._db.execute("SELECT digest, final_url, headers, stored FROM entries WHERE url = ?", (url,)).fetchone()
+            if not row: return None
+            digest, final_url, headers, stored = row
+            ttl = self.ttl(url)
+            if ttl is not None and time() - stored > ttl:
+                self._drop(url, digest)
+                self._db.commit()
+                return None
+            try:
+                f = open(self._object_path(digest), 'rb')
+                body = zlib.decompress(f.read())
+                f.close()
+            except (IOError, zlib.error):
+                # Somebody removed or truncated the file underneath us. Forget the entry.
+                self._drop(url, digest)
+                self._db.commit()
+                return None
+            self._db.execute("UPDATE entries SET accessed = ? WHERE url = ?", (time(), url))
+            self._db.commit()
+        return body, final_url, json.loads(headers)
+
+    def put(self, url, body, final_url=None, headers=None):
+        """Stores a response for url, then evicts the least recently used entries if we are over max_bytes."""
+        digest = hashlib.sha1(body).hexdigest()
+        headers = json.dumps(dict(headers or {}))
+        now = time()
+        with self._lock:
+            row = self._db.execute("SELECT digest FROM entries WHERE url = ?", (url,)).fetchone()
+            if row: self._drop(url, row[0])
+            obj = self._db.execute("SELECT refs FROM objects WHERE digest = ?", (digest,)).fetchone()
+            if obj:
+                self._db.execute("UPDATE objects SET refs = refs + 1 WHERE digest = ?", (digest,))
+            else:
+                size = self._write_object(digest, body)
+                self._db.execute("INSERT INTO objects VALUES (?, ?, 1)", (digest, size))
+            self._db.execute("INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?)", (url, digest, final_url or url, headers, now, now))
+            self._evict()
+            self._db.commit()
+
+    def invalidate(self, url):
+        """Forgets any cached copy of url."""
+        with self._lock:
+            row = self._db.execute("SELECT digest FROM entries WHERE url = ?", (url,)).fetchone()
+            if row:
+                self._drop(url, row[0])
+                self._db.commit()
+
+    def size(self):
+        """Returns the number of compressed bytes held on disk."""
+        with self._lock:
+            return self._db.execute("SELECT COALESCE(SUM(size), 0) FROM objects").fetchone()[0]
+
+    def _write_object(self, digest, body):
+        p = self._object_path(digest)
+        d = os.path.dirname(p)
+        if not os.path.isdir(d):
+            os.makedirs(d)
+        data = zlib.compress(body)
+        # Write-then-rename so that a crash never leaves a half-written body under a valid digest.
+        tmp = p + '.tmp'
+        f = open(tmp, 'wb')
+        f.write(data)
+        f.close()
+        os.rename(tmp, p)
+        return len(data)
+
+    def _drop(self, url, digest):
+        """Removes the entry for url and releases its reference on digest. Caller holds the lock."""
+        self._db.execute("DELETE FROM entries WHERE url = ?", (url,))
+        self._db.execute("UPDATE objects SET refs = refs - 1 WHERE digest = ?", (digest,))
+        row = self._db.execute("SELECT refs FROM objects WHERE digest = ?", (digest,)).fetchone()
+        if row and row[0] <= 0:
+            self._db.execute("DELETE FROM objects WHERE digest = ?", (digest,))
+            try:
+                os.remove(self._object_path(digest))
+            except OSError:
+                pass
+
+    def _evict(self):
+        """Drops least recently used entries until we fit in max_bytes. Caller holds the lock."""
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM objects").fetchone()[0]
+        while total > self.max_bytes:
+            rows = self._db.execute("SELECT url, digest FROM entries ORDER BY accessed LIMIT ?", (EVICT_BATCH,)).fetchall()
+            if not rows: break
+            for url, digest in rows:
+                self._drop(url, digest)
+            total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM objects").fetchone()[0]
@@ -0,0 +1,172 @@
+"""Corpus-wide author disambiguation: decides which Person each Alias stands for.
+
+Every author occurrence in the publications collection is put in a block by its accent-folded last name and first initial, and names are only ever compared inside their block. Within a block, each distinct name is an alias. Two aliases are linked when Name.compatible allows it and they share enough coauthors and affiliation words. The linked groups become Persons, and each Alias gets a likelihood score for every Person it is compatible with.
+
+Blocks are scored in parallel by a process pool. Usage, from src/:
+    python disambig.py [--processes N]
+"""
+
+import re, argparse, unicodedata, htmlentitydefs
+import multiprocessing
+
+import hphys_types as ht
+import mongo
+
+NAME_WEIGHT = 0.3 # Score for a compatible pair of names, before any other evidence
+COAUTHOR_WEIGHT = 0.5 # Times the Jaccard overlap of the two aliases' coauthors
+AFFILIATION_WEIGHT = 0.2 # Times the Jaccard overlap of the words of their affiliations
+LINK_SCORE = 0.4 # Pairs scoring at least this are the same person. A bare name match is not enough.
+MAX_COAUTHORS = 50 # Coauthors of bigger papers (collaborations) are ignored. They say little about who is who, and make the sets huge.
+CHUNKSIZE = 20 # Blocks handed to a worker at a time
+
+# Words too common in physics affiliations to tell anyone apart
+_AFFILIATION_STOP = set(['of', 'the', 'and', 'for', 'de', 'department', 'dept', 'university', 'univ', 'institute', 'physics', 'laboratory', 'lab', 'center', 'centre', 'school', 'science', 'sciences'])
+_WORD_REGEX = re.compile(r'[a-z0-9]+')
+_ENTITY_REGEX = re.compile(r'&(#?)(\w+);')
+
+def _entity(m):
+    try:
+        if m.group(1): return unichr(int(m.group(2)))
+        return unichr(htmlentitydefs.name2codepoint[m.group(2)])
+    except (KeyError, ValueError):
+        return m.group(0)
+
+def fold(s):
+    """Lower-cases s and strips accents (including HTML entities like &ouml;), so that Schrodinger, Schr&ouml;dinger and Schr\xf6dinger fall in one block."""
+    if s is None: return ''
+    if isinstance(s, ht.TypedString): s = s.mongo_dump()
+    if isinstance(s, str): s = s.decode('utf-8', 'replace')
+    s = _ENTITY_REGEX.sub(_entity, s)
+    s = unicodedata.normalize('NFKD', s)
+    return ''.join([c for c in s if not unicodedata.combining(c)]).encode('ascii', 'ignore').lower()
+
+def block_key(name):
+    """The block of a Name: its folded last name and the folded initial of its first given name. Names with no given names block on the last name alone."""
+    names = getattr(name, 'names', [])
+    initial = fold(names[0])[:1] if names else ''
+    return "%s|%s" % (fold(name.last), initial)
+
+def _alias_key(name):
+    return (name.last if not isinstance(name.last, ht.TypedString) else name.last.mongo_dump(), tuple(getattr(name, 'names', [])), getattr(name, 'lineage', None))
+
+def _affiliation_words(s):
+    if not s: return set()
+    return set([x for x in _WORD_REGEX.findall(fold(s)) if x not in _AFFILIATION_STOP and len(x) > 1])
+
+def _jaccard(a, b):
+    if not a or not b: return 0.0
+    return len(a & b) / float(len(a | b))
+
+def collect_blocks(publications):
+    """Takes an iterable of Publications, e.g. with authors as built by ads.abstract_parse from affiliations_from_abstract, and returns {block key: {alias key: [occurrences, coauthor block keys, affiliation words]}}. An alias key is (last, names, lineage)."""
+    blocks = {}
+    for pub in publications:
+        authors = [x for x in getattr(pub, 'authors', []) if isinstance(x, dict) and x.get('name') is not None]
+        keys = [block_key(x['name']) for x in authors]
+        big = len(authors) > MAX_COAUTHORS
+        for i, a in enumerate(authors):
+            entry = blocks.setdefault(keys[i], {}).setdefault(_alias_key(a['name']), [0, set(), set()])
+            entry[0] += 1
+            if not big:
+                entry[1].update(keys[:i] + keys[i + 1:])
+            entry[2].update(_affiliation_words(a.get('affiliation')))
+    return blocks
+
+def _name(key):
+    n = ht.Name({'last': key[0], 'names': list(key[1])})
+    if key[2] is not None: n.lineage = key[2]
+    return n
+
+def score_block(item):
+    """Disambiguates one block. Takes (block key, {alias key: [occurrences, coauthors, affiliation words]}) and returns a list of (person id, display name, [(alias key, likelihood)]) for each Person found, the likelihoods of each alias summing to 1 over the Persons it may be.
+
+    Pairs are linked best first, and two groups are only merged when every name in one is compatible with every name in the other, so that an "A. Foo" cannot join an "Alice Foo" to an "Adam Foo"."""
+    bkey, aliases = item
+    keys = sorted(aliases)
+    names = dict([(k, _name(k)) for k in keys])
+    n = len(keys)
+    compatible = {}
+    pairs = []
+    for i in range(n):
+        for j in range(i + 1, n):
+            a, b = keys[i], keys[j]
+            if not names[a].compatible(names[b]): continue
+            s = NAME_WEIGHT + COAUTHOR_WEIGHT * _jaccard(aliases[a][1], aliases[b][1]) + AFFILIATION_WEIGHT * _jaccard(aliases[a][2], aliases[b][2])
+            compatible[(a, b)] = compatible[(b, a)] = s
+            if s >= LINK_SCORE: pairs.append((s, a, b))
+    pairs.sort(reverse=True)
+
+    # Union-find over the aliases, with the members of each group at its root
+    parent = dict([(k, k) for k in keys])
+    members = dict([(k, [k]) for k in keys])
+    def find(k):
+        while parent[k] != k:
+            parent[k] = parent[parent[k]]
+            k = parent[k]
+        return k
+    for s, a, b in pairs:
+        ra, rb = find(a), find(b)
+        if ra == rb: continue
+        if not all([(x, y) in compatible for x in members[ra] for y in members[rb]]): continue
+        if len(members[ra]) < len(members[rb]): ra, rb = rb, ra
+        parent[rb] = ra
+        members[ra].extend(members.pop(rb))
+
+    groups = sorted(members.values(), key=lambda g: min(g))
+    # Each alias's affinity to each group it could belong to: 1 for its own, else its best score against a member
+    affinity = dict([(k, []) for k in keys])
+    for gi, g in enumerate(groups):
+        for k in keys:
+            if k in g:
+                affinity[k].append((gi, 1.0))
+            elif all([(k, y) in compatible for y in g]):
+                affinity[k].append((gi, max([compatible[(k, y)] for y in g])))
+    out = []
+    for gi, g in enumerate(groups):
+        # The group is known by its most complete name (spelled-out names first), and the most used among those
+        best = max(g, key=lambda k: (len([x for x in k[1] if not x.endswith('.')]), len(k[1]), aliases[k][0], k))
+        person_id = "%s|%s" % (bkey, ' '.join(best[1]).lower())
+        if best[2]: person_id += '|' + best[2].lower()
+        scored = []
+        for k in keys:
+            for gj, v in affinity[k]:
+                if gj == gi:
+                    scored.append((k, v / sum([y for (_, y) in affinity[k]])))
+        out.append((person_id, names[best].full_name().strip(), scored))
+    return out
+
+def disambiguate(db=None, processes=None, chunksize=CHUNKSIZE):
+    """Runs the whole job over db (by default, the hphysics database). Persons are upserted by id, and the persons field of each Alias is replaced. Returns (blocks, persons, aliases) counts."""
+    if db is None:
+        _, db = mongo.mongo_connect()
+    cursor = db[ht.Publication.mongo_collection].find({}, {'_type': 1, 'authors': 1})
+    blocks = collect_blocks(ht.mongo_read_fast(x) for x in cursor)
+    persons = {}
+    alias_persons = {}
+    pool = multiprocessing.Pool(processes)
+    try:
+        # Big blocks first, so that the pool is not left waiting on one at the end
+        work = sorted(blocks.items(), key=lambda x: -len(x[1]))
+        for result in pool.imap_unordered(score_block, work, chunksize):
+            for person_id, display, scored in result:
+                persons[person_id] = display
+                for k, v in scored:
+                    alias_persons.setdefault(k, []).append([person_id, v])
+    finally:
+        pool.close()
+        pool.join()
+    with mongo.BulkWriter(db) as writer:
+        for person_id, display in persons.items():
+            p = ht.Person({'display_name': display})
+            p.id = person_id
+            writer.add(p)
+        for k, scores in alias_persons.items():
+            scores.sort(key=lambda x: -x[1])
+            writer.add(ht.Alias({'name': _name(k), 'persons': scores}))
+    return (len(blocks), len(persons), len(alias_persons))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Group the author names of all publications into Persons and score the Aliases.")
+    parser.add_argument('--processes', type=int, default=None, help='Worker processes (default: one per CPU)')
+    args = parser.parse_args()
+    print "%d blocks, %d persons, %d aliases" % disambiguate(processes=args.processes)
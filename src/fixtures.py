@@ -0,0 +1,105 @@
+"""A recorded corpus of real ADS and arXiv responses, for benchmarks and offline runs.
+
+A fixture directory holds index.json, mapping each URL to its final URL, response headers, kind and body file, and the bodies themselves under bodies/<sha1>. Record one from the live sites, from src/:
+    python fixtures.py --bibcodes bibcodes.txt [--arxiv] [--path ../fixtures]
+This runs abstract_read on each bibcode (and, with --arxiv, reads the arXiv abs page and Atom entry of each e-print, without downloading any files) with every response written to the fixtures.
+"""
+
+import os, json, hashlib, threading, argparse, urlparse
+
+FIXTURES = "../fixtures"
+
+def kind_of(url):
+    """Classifies a URL as 'ads_abs', 'ads_bibtex', 'ads_search', 'arxiv_abs', 'arxiv_atom' or 'other'."""
+    parts = urlparse.urlsplit(url)
+    host = parts.hostname or ''
+    if 'adsabs' in host:
+        if 'data_type=BIBTEX' in parts.query: return 'ads_bibtex'
+        if parts.path.startswith('/abs/'): return 'ads_abs'
+        if 'author=' in parts.query: return 'ads_search'
+    elif 'arxiv' in host:
+        if parts.path.startswith('/api/query'): return 'arxiv_atom'
+        if parts.path.startswith('/abs/'): return 'arxiv_abs'
+    return 'other'
+
+class FixtureStore():
+    def __init__(self, path=FIXTURES):
+        self.path = path
+        self._bodies = os.path.join(path, 'bodies')
+        if not os.path.isdir(self._bodies):
+            os.makedirs(self._bodies)
+        self._lock = threading.Lock()
+        self._index_path = os.path.join(path, 'index.json')
+        if os.path.exists(self._index_path):
+            f = open(self._index_path)
+            self.index = json.load(f)
+            f.close()
+        else:
+            self.index = {}
+
+    def put(self, url, body, final_url, headers):
+        digest = hashlib.sha1(body).hexdigest()
+        body_path = os.path.join(self._bodies, digest)
+        with self._lock:
+            if not os.path.exists(body_path):
+                f = open(body_path, 'wb')
+                f.write(body)
+                f.close()
+            self.index[url] = {'final_url': final_url, 'headers': headers, 'kind': kind_of(url), 'body': digest}
+            # Small enough to rewrite whole. The rename keeps a crash from leaving half an index.
+            tmp = self._index_path + '.tmp'
+            f = open(tmp, 'w')
+            json.dump(self.index, f, indent=1, sort_keys=True)
+            f.close()
+            os.rename(tmp, self._index_path)
+
+    def get(self, url):
+        """Returns (html-content, url, headers) for a recorded url, or None, like www.cache_lookup."""
+        e = self.index.get(url)
+        if e is None: return None
+        return self.body(url), e['final_url'], e['headers']
+
+    def body(self, url):
+        f = open(os.path.join(self._bodies, self.index[url]['body']), 'rb')
+        s = f.read()
+        f.close()
+        return s
+
+    def urls(self, kind=None):
+        return sorted([x for x in self.index if kind is None or self.index[x]['kind'] == kind])
+
+    def bodies(self, kind):
+        """Returns [(url, body)] for every recorded url of a kind."""
+        return [(x, self.body(x)) for x in self.urls(kind)]
+
+def record(bibcodes, with_arxiv=False, path=FIXTURES):
+    """Records the pages behind the given bibcodes from the live sites. Returns the FixtureStore."""
+    import www, ads, arxiv
+    store = FixtureStore(path)
+    www.record_enable(store)
+    try:
+        for code in bibcodes:
+            try:
+                pub = ads.abstract_read(code)
+            except Exception, e:
+                print "Warning: could not record %s (%s)" % (code, e)
+                continue
+            if with_arxiv and getattr(pub, 'arxiv_id', None):
+                ar = arxiv.ArXivRecord(pub.arxiv_id)
+                ar.versions()
+                ar.categories()
+            print "Recorded %s" % code
+    finally:
+        www.record_enable(None)
+    return store
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Record ADS and arXiv responses as fixtures for bench.py.")
+    parser.add_argument('--bibcodes', required=True, help='File with one ADS bibcode per line')
+    parser.add_argument('--arxiv', action='store_true', help='Also record the arXiv abs page and Atom entry of each e-print')
+    parser.add_argument('--path', default=FIXTURES)
+    args = parser.parse_args()
+    f = open(args.bibcodes)
+    codes = [x.strip() for x in f if x.strip()]
+    f.close()
+    record(codes, args.arxiv, args.path)
@@ -6,23 +6,18 @@
 
 # Allowed native types: dictionaries with string keys and valid items, lists with valid items, strings, ints, floats, datetime.datetime, re.compile, pymongo.objectid.ObjectId
 
-import sys, inspect
-import copy
+import gc, datetime
 
-# A dictionary of constructors for all of the MongoDocument descendents. For use in mongo_read
+# A dictionary of constructors for all of the MongoDocument descendents. For use in mongo_read. MongoMeta fills it in as each class is defined.
 MTYPES = {}
-# A smart-alecky way to populate MTYPES by finding all the descendents of MongoDocument in the loaded module
-for name, obj in inspect.getmembers(sys.modules[__name__]):
-        if hasattr(obj, "mongo_type"):
-            MTYPES[obj.mongo_type] = obj
-            
+
 def mongo_dump(obj):
     """Take an allowed native type or a MongoDocument object and output a form that is suitable to be .insert()ed into a Mongo collection."""
     if isinstance(obj, dict):
         out = {}
         for (key, val) in obj.items():
             out[key] = mongo_dump(val)
-            return out
+        return out
     elif isinstance(obj, list):
         return map(mongo_dump, obj)
     elif hasattr(obj, "mongo_dump"):
@@ -32,21 +27,40 @@ def mongo_dump(obj):
 def mongo_read(obj):
     """Take an object extracted from a Mongo collection and expand any MongoDocuments that are nested inside of it."""
     if isinstance(obj, dict):
+        out = {}
         for (key, val) in obj.items():
-            out[key] = mongo_dump(val)
-            return out
+            out[key] = mongo_read(val)
         ty = obj.get('_type', None)
         if ty:
-            return MTYPES[ty](obj)
+            return MTYPES[ty](out)
+        return out
     if isinstance(obj, list):
         return map(mongo_read, obj)
     return obj
 
 # This dude deals in immutable document schemes right now. Maybe I'll write a full ORM-layer. Maybe not. Should write a migration tool that operates on the parameter level so that we can migrate easily to new schemas. 
 
-class MongoDocument:
+class MongoMeta(type):
+    """Resolves the full list of mongo params of each MongoDocument class once, when the class is defined, and stores it in _mongo_fields. Also gives each class __slots__ for the params it declares, so documents carry no per-instance __dict__."""
+    def __new__(mcs, name, bases, ns):
+        own = ns.get('_mongo_params', [])
+        if '__slots__' not in ns:
+            ns['__slots__'] = tuple([x[0] for x in own])
+        cls = type.__new__(mcs, name, bases, ns)
+        fields = list(own)
+        for b in reversed(bases):
+            fields.extend(getattr(b, '_mongo_fields', ()))
+        cls._mongo_fields = tuple(fields)
+        if 'mongo_type' in ns:
+            MTYPES[ns['mongo_type']] = cls
+        return cls
+
+class MongoDocument(object):
+    __metaclass__ = MongoMeta
+    __slots__ = ('id',)
+    _mongo_params = []
     def __init__(self, d = {}):
-        for x in self.mongo_params():
+        for x in self._mongo_fields:
             pname = x[0]
             val = d.get(pname, None)
             if val != None:
@@ -55,24 +69,30 @@ class MongoDocument:
         setattr(self, 'id', val)
     def mongo_dump(self):
         out = {'_type': self.mongo_type}
-        for x in self.mongo_params():
-            out[x[0]] = mongo_read(getattr(self,x[0]))
+        for x in self._mongo_fields:
+            # Parameters that were never set are left out of the document
+            if hasattr(self, x[0]):
+                out[x[0]] = mongo_dump(getattr(self,x[0]))
         return out
     def mongo_params(self):
-        out = copy.copy(self._mongo_params)
-        ancestors = list(self.__class__.__bases__)
-        while ancestors:
-            x = ancestors.pop()
-            try:
-                out.extend(x._mongo_params)
-                ancestors.extend(x.__bases__)
-            except AttributeError: pass
-        return out
+        return self._mongo_fields
+    # Classes with __slots__ need these to be pickled with the older pickle protocols (multiprocessing, for one).
+    def __getstate__(self):
+        return dict([(x[0], getattr(self, x[0])) for x in self._mongo_fields if hasattr(self, x[0])] + [('id', getattr(self, 'id', None))])
+    def __setstate__(self, state):
+        for k, v in state.items():
+            setattr(self, k, v)
 
 # Collections
 
+# mongo_collection names the collection a class is stored in. mongo_keys are the params that identify a document, in order of preference; mongo.BulkWriter upserts on the first one that is set.
+# mongo_indexes lists (keys, options) for the indexes the collection should have, as taken by pymongo's create_index. mongo.ensure_indexes creates or checks them.
+
 class Person(MongoDocument):
     mongo_type = 'Person'
+    mongo_collection = 'persons'
+    mongo_keys = ()
+    mongo_indexes = [([('display_name', 1)], {})]
     _mongo_params = [('display_name', 'str'),
                      ('names', 'HistoricalProperty'), # The way we deal with people is that we have a table of People and a table of Aliases. An Alias is any name that we saw used in the wild for that person. Of course, an alias might be associated with many people. 
                      ('honorifics', 'HistoricalProperty'), 
@@ -81,11 +101,21 @@ class Person(MongoDocument):
 
 class Alias(MongoDocument):
     mongo_type = 'Alias'
+    mongo_collection = 'aliases'
+    mongo_keys = ('name',)
+    # Lookups are by last name, then given names (query.compatible_name). names is an array, so this is a multikey index and cannot be unique.
+    mongo_indexes = [([('name.last', 1), ('name.names', 1), ('name.lineage', 1)], {})]
     _mongo_params = [('name', 'Name'),
                      ('persons', 'list')] # List of [ids, likelihood scores] for the persons. A liklihood score gives intuition for: "Given that I encountered this alias in the wild, how likely is to correspond to this person?
 
 class Publication(MongoDocument):
     mongo_type = 'Publication'
+    mongo_collection = 'publications'
+    mongo_keys = ('ads_bibcode', 'arxiv_id', 'doi')
+    mongo_indexes = [([('ads_bibcode', 1)], {'unique': True, 'sparse': True}),
+                     ([('arxiv_id', 1)], {'sparse': True}),
+                     ([('doi', 1)], {'sparse': True}),
+                     ([('authors.name.last', 1)], {})]
     _mongo_params = [('publication_type','str'),
                      ('ads_bibcode','str'),
                      ('authors','list'), # List of [id, alias]
@@ -141,6 +171,18 @@ class TypedString(MongoDocument):
                 return self.contents
             except AttributeError:
                 return ''
+    # A typed string stands for its contents, so that e.g. a Name read back by mongo_read_batch (which restores the LatexString of its last name) still matches one built from a plain string.
+    def __eq__(self, other):
+        return self.mongo_dump() == (other.mongo_dump() if isinstance(other, TypedString) else other)
+    def __ne__(self, other):
+        return not self.__eq__(other)
+    def __hash__(self):
+        return hash(self.mongo_dump())
+    # It concatenates like its contents too, so that Name.full_name works on a Name read back by mongo_read_batch.
+    def __add__(self, other):
+        return self.mongo_dump() + (other.mongo_dump() if isinstance(other, TypedString) else other)
+    def __radd__(self, other):
+        return other + self.mongo_dump()
 
 class LatexString(TypedString):
     mongo_type = 'LatexString'
@@ -174,8 +216,9 @@ class Name(MongoDocument):
             if b[-1] == '.':
                 if b[:-1] == a[0:len(b) - 1]:
                     return 2
-        finally:
-            return 0
+        except IndexError:
+            pass
+        return 0
 
     def compatible(self, other):
         """This function compares two names and returns a numeric code indicating the result. The codes are given below where the call was one.two:
@@ -185,38 +228,41 @@ class Name(MongoDocument):
         3 : two contains more data than one.
         4 : both 2 and 3 hold."""
         # TODO. Once this is standardized to my liking it can be used to implement __cmp__
-        # Right now, we assume that we don't have to have any names except the last. So A. B. Foo and C. D. Foo are the same people (and they both contain more data than the other). 
         if other.last != self.last: return 0
-        if other.lineage != self.lineage: return 0
-        data = [self.permits(other), other.permits(self)]
-        if data[0] and data[1]: return 4
-        if data[0]: return 2
-        if data[1]: return 3
-        assert()
+        if getattr(other, 'lineage', None) != getattr(self, 'lineage', None): return 0
+        if getattr(self, 'names', []) == getattr(other, 'names', []): return 1
+        # Both permits only hold for identical names, which are caught above.
+        if self.permits(other): return 2
+        if other.permits(self): return 3
+        # e.g. Mikhail D. Foo and M. Dmitri Foo, but not A. Foo and B. Foo
+        if self._covers(other, (1, 2, 3)) or other._covers(self, (1, 2, 3)): return 4
+        return 0
 
     def permits(self, other):
-        """Asks if self.names carries more data or the same amount of data as other.names"""
+        """Asks if self.names carries more data or the same amount of data as other.names, i.e. if every name in other.names is covered, in order, by a name in self.names that is the same or more spelled out."""
+        return self._covers(other, (1, 2))
+
+    def _covers(self, other, codes):
+        """True if each of other.names can be matched, in order, to a different one of self.names for which _compatible gives one of codes."""
+        names = getattr(self, 'names', [])
         i = 0
-        onl = len(other.names)
-        for n in self.names:
-            for j in range(i, onl):
-                res = self._permits(n, other.names[j])
-                if res in [0,3]: continue # I didn't fit inside it
-                else:
-                    i = j + 1
-            else: return False
+        for n in getattr(other, 'names', []):
+            # Matching each name to the first that fits leaves the most names for the ones after it.
+            while i < len(names) and self._compatible(names[i], n) not in codes:
+                i += 1
+            if i == len(names): return False
+            i += 1
         return True
 
     def __eq__(self, other):
+        if not isinstance(other, Name): return False
         if self.last != other.last: return False
-        if len(self.names) != len(other.names): return False
-        for i in range(0, len(self.names)):
-            if self.names[i] != other.names[i]: return False
-        if self.lineage != other.lineage: return False
+        if getattr(self, 'names', []) != getattr(other, 'names', []): return False
+        if getattr(self, 'lineage', None) != getattr(other, 'lineage', None): return False
         return True
 
-    def __neq__(self, other):
-        return not __eq__(self,other)
+    def __ne__(self, other):
+        return not self.__eq__(other)
 
 class MonthYear(MongoDocument):
     mongo_type="MonthYear"
@@ -254,3 +300,112 @@ class HistoricalProperty(MongoDocument):
 
     def update(self, time, value):
         self.data.append([time, value])
+
+# Specialized serializers
+
+# mongo_dump and mongo_read above find their way through a document with isinstance and hasattr checks at every node. The functions below are generated once per class from its declared params: each one reads the class's slots directly and dispatches nested values on their exact type. They produce the same documents as mongo_dump, and mongo_read_fast also restores TypedStrings (which are stored as bare strings) from the declared types.
+
+_NATIVE = set([str, unicode, int, long, float, bool, type(None), datetime.datetime])
+_STRINGS = (str, unicode)
+_DUMPERS = {} # class -> generated dump function
+_READERS = {} # class -> generated read function
+
+def _dump_any(v):
+    t = type(v)
+    if t in _NATIVE: return v
+    # Most nested values are native, so we test for that inline rather than paying for a call.
+    if t is list: return [x if type(x) in _NATIVE else _dump_any(x) for x in v]
+    if t is dict: return dict([(k, x if type(x) in _NATIVE else _dump_any(x)) for (k, x) in v.iteritems()])
+    f = _DUMPERS.get(t)
+    if f is None:
+        if not isinstance(v, MongoDocument): return mongo_dump(v)
+        f = _make_dumper(t)
+    return f(v)
+
+def _read_any(v):
+    t = type(v)
+    if t is dict:
+        ty = v.get('_type')
+        if ty is not None:
+            cls = MTYPES[ty]
+            return (_READERS.get(cls) or _make_reader(cls))(v)
+        return dict([(k, _read_any(x)) for (k, x) in v.iteritems()])
+    if t is list: return [_read_any(x) for x in v]
+    return v
+
+def _typed_string(tyname, s):
+    obj = object.__new__(MTYPES[tyname])
+    obj.id = None
+    obj.contents = s
+    return obj
+
+def _compile(name, lines, cls):
+    ns = {'_dump_any': _dump_any, '_read_any': _read_any, '_typed_string': _typed_string, '_NATIVE': _NATIVE, '_STRINGS': _STRINGS, 'cls': cls, '_new': object.__new__}
+    exec '\n'.join(lines) in ns
+    return ns[name]
+
+def _make_dumper(cls):
+    if issubclass(cls, TypedString):
+        f = lambda obj: getattr(obj, 'contents', '')
+    else:
+        lines = ['def dump(obj):', '    out = {"_type": %r}' % cls.mongo_type]
+        for (name, ty) in cls._mongo_fields:
+            lines.extend(['    try:', '        v = obj.%s' % name, '    except AttributeError:', '        pass', '    else:'])
+            if ty == 'list':
+                lines.append('        out[%r] = [x if type(x) in _NATIVE else _dump_any(x) for x in v] if type(v) is list else _dump_any(v)' % name)
+            elif ty in MTYPES:
+                lines.append('        out[%r] = _dump_any(v)' % name)
+            else:
+                lines.append('        out[%r] = v if type(v) in _NATIVE else _dump_any(v)' % name)
+        lines.append('    return out')
+        f = _compile('dump', lines, cls)
+    _DUMPERS[cls] = f
+    return f
+
+def _make_reader(cls):
+    lines = ['def read(d):', '    obj = _new(cls)', '    obj.id = d.get("_id")']
+    for (name, ty) in cls._mongo_fields:
+        lines.extend(['    v = d.get(%r)' % name, '    if v is not None:'])
+        if ty in MTYPES and issubclass(MTYPES[ty], TypedString):
+            lines.append('        obj.%s = _typed_string(%r, v) if type(v) in _STRINGS else _read_any(v)' % (name, ty))
+        elif ty == 'list' or ty in MTYPES:
+            lines.append('        obj.%s = _read_any(v)' % name)
+        else:
+            lines.append('        obj.%s = v' % name)
+    lines.append('    return obj')
+    f = _compile('read', lines, cls)
+    _READERS[cls] = f
+    return f
+
+def mongo_dump_fast(obj):
+    """Does what mongo_dump does, with the generated per-class serializers."""
+    return _dump_any(obj)
+
+def mongo_read_fast(obj):
+    """Does what mongo_read does, with the generated per-class deserializers. Params declared as LatexString or HTMLString come back as those types rather than as bare strings."""
+    return _read_any(obj)
+
+# A batch allocates a great many small dicts and lists and frees none of them, which makes the cyclic garbage collector run over and over for nothing. We hold it off for the length of a batch.
+def _without_gc(f, docs):
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return f(docs)
+    finally:
+        if enabled: gc.enable()
+
+def _dump_batch(docs):
+    out = []
+    for d in docs:
+        t = type(d)
+        f = _DUMPERS.get(t) or _make_dumper(t)
+        out.append(f(d))
+    return out
+
+def mongo_dump_batch(docs):
+    """Takes a list of MongoDocuments (e.g. Publications) and returns a list of documents ready to be inserted."""
+    return _without_gc(_dump_batch, docs)
+
+def mongo_read_batch(docs):
+    """Takes a list of documents from a Mongo collection and returns the MongoDocuments they hold."""
+    return _without_gc(lambda docs: [_read_any(d) for d in docs], docs)
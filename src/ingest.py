@@ -0,0 +1,195 @@
+"""Bulk ingest of publications into the database.
+
+Takes authors and/or bibcodes and runs them through ads.read_pipeline, the same threaded pipeline as ads.author_publications:
+    resolve (authors -> bibcodes) -> fetch (raw ADS pages) and parse (Publication), on a pool of threads -> [arxiv] -> store (Mongo)
+A publication whose arXiv entry cannot be built is stored without it.
+Progress is recorded per bibcode in a local checkpoint file, so a restart skips everything that was already stored.
+
+Usage, from src/:
+    python ingest.py --authors authors.txt --bibcodes bibcodes.txt [--arxiv] [--checkpoint ../ingest.sqlite] [--archive ../archive] [--validators ../refresh.sqlite]
+An authors file has one "Last, First Middle" per line. A bibcodes file has one bibcode per line. With --archive, every page fetched is also kept in an archive.PageArchive, for reparse.py.
+The ETag and Last-Modified of the ADS pages of each stored publication are kept in refresh.py's validators file, so that its first run can already skip what has not changed.
+"""
+
+import threading, sqlite3, argparse
+from time import time
+
+import www, ads, mongo, stats, archive, refresh
+
+CHECKPOINT = "../ingest.sqlite"
+QUEUE_SIZE = 100
+REPORT_EVERY = 60 # Seconds between throughput reports
+
+class Checkpoint():
+    """Per-bibcode progress, in a sqlite file. A bibcode is 'pending' once resolved, then 'stored' or 'failed'."""
+    def __init__(self, path=CHECKPOINT):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS bibcodes (bibcode TEXT PRIMARY KEY, status TEXT, note TEXT, updated REAL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS authors (query TEXT PRIMARY KEY, updated REAL)")
+        self._db.commit()
+
+    def status(self, bibcode):
+        with self._lock:
+            row = self._db.execute("SELECT status FROM bibcodes WHERE bibcode = ?", (bibcode,)).fetchone()
+        return row[0] if row else None
+
+    def mark(self, bibcode, status, note=None):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO bibcodes VALUES (?, ?, ?, ?)", (bibcode, status, note, time()))
+            self._db.commit()
+
+    def author_done(self, query):
+        with self._lock:
+            return self._db.execute("SELECT 1 FROM authors WHERE query = ?", (query,)).fetchone() is not None
+
+    def mark_author(self, query):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO authors VALUES (?, ?)", (query, time()))
+            self._db.commit()
+
+    def unfinished(self):
+        """Bibcodes that were resolved by an earlier run but never stored."""
+        with self._lock:
+            return [x[0] for x in self._db.execute("SELECT bibcode FROM bibcodes WHERE status != 'stored'")]
+
+class Stage():
+    """Counts the items that went through one step of the pipeline, the failures and the time spent, for the throughput reports. Used from several threads."""
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.failed = 0
+        self.busy = 0.0 # Summed over threads
+        self.started = time()
+        self._lock = threading.Lock()
+
+    def run(self, func, *args):
+        """Returns func(*args), counted. An exception is counted as a failure and raised."""
+        t = time()
+        try:
+            return func(*args)
+        except:
+            with self._lock: self.failed += 1
+            raise
+        finally:
+            with self._lock:
+                self.count += 1
+                self.busy += time() - t
+
+    def report(self):
+        wall = time() - self.started
+        with self._lock:
+            rate = self.count / wall if wall else 0
+            per = self.busy / self.count if self.count else 0
+            return "%-8s %6d done %4d failed %8.3f items/s %8.3f s/item" % (self.name, self.count, self.failed, rate, per)
+
+def resolve(authors, bibcodes, checkpoint):
+    """Yields every bibcode that has not been stored yet: leftovers from earlier runs first, then the given bibcodes, then the results of each author search that is not already done."""
+    try:
+        for code in _resolve(authors, bibcodes, checkpoint):
+            yield code
+    except Exception, e:
+        print "Warning: resolve stopped early (%s)" % e
+
+def _resolve(authors, bibcodes, checkpoint):
+    seen = set()
+    def new(code):
+        if code in seen: return False
+        seen.add(code)
+        if checkpoint.status(code) == 'stored': return False
+        checkpoint.mark(code, 'pending')
+        return True
+    for code in checkpoint.unfinished():
+        if new(code): yield code
+    for code in bibcodes:
+        if new(code): yield code
+    for query in authors:
+        if checkpoint.author_done(query): continue
+        last, _, given = query.partition(',')
+        given = given.split()
+        first = given[0] if given else ''
+        middle = ' '.join(given[1:])
+        for code in ads.author_search_iter(first, middle, last.strip()):
+            if new(code): yield code
+        checkpoint.mark_author(query)
+
+def ingest(authors=(), bibcodes=(), checkpoint_path=CHECKPOINT, with_arxiv=False, fetchers=ads.PIPELINE_WORKERS, db=None, profile=False, archive_path=None, validators_path=refresh.VALIDATORS):
+    """Runs the pipeline to completion and returns the list of Stages, for their counters. Publications are written in batches through a mongo.BulkWriter on db (by default, the hphysics database). With profile, the slow unindexed queries seen during the run are reported at the end. With archive_path, the raw pages are archived there. The validators of the ADS pages are saved in validators_path for refresh.py, unless it is None."""
+    checkpoint = Checkpoint(checkpoint_path)
+    validators = refresh.Validators(validators_path) if validators_path else None
+    if archive_path:
+        www.archive_enable(archive.PageArchive(archive_path))
+    if db is None:
+        _, db = mongo.mongo_connect()
+    writer = mongo.BulkWriter(db)
+
+    fetch, parse, arxiv, store = Stage('fetch'), Stage('parse'), Stage('arxiv'), Stage('store')
+    stages = [fetch, parse] + ([arxiv] if with_arxiv else []) + [store]
+
+    def read(code):
+        pages, save = fetch.run(ads.abstract_fetch, code, True)
+        return parse.run(ads.abstract_parse, code, *pages), save
+    def unread(code, e):
+        print "Warning: could not read abstract :: %s (%s)" % (code, e)
+        checkpoint.mark(code, 'failed', "read: %s" % e)
+    def stored(code, save):
+        checkpoint.mark(code, 'stored')
+        if validators is not None:
+            for x in save: validators.save(*x)
+
+    if profile:
+        profile_since, profile_was = mongo.profile_start(db)
+    try:
+        last_report = time()
+        # Reading runs on ads.read_pipeline's threads; the arXiv entries and the writes are done here, in the order the abstracts come in.
+        for code, (pub, save) in ads.read_pipeline(resolve(authors, bibcodes, checkpoint), read, fetchers, QUEUE_SIZE, unread):
+            if with_arxiv and getattr(pub, 'arxiv_id', None):
+                try:
+                    pub.arxiv_entry = arxiv.run(ads.arxiv_build, pub.arxiv_id)
+                except Exception, e:
+                    # Stored without its arXiv entry, which refresh.py or a later run can add.
+                    print "Warning: could not build arXiv entry :: %s %s (%s)" % (code, pub.arxiv_id, e)
+            # A bibcode only counts as stored once its batch has been written, and the same goes for its validators, as in refresh.py.
+            try:
+                store.run(writer.add, pub, lambda code=code, save=save: stored(code, save))
+            except Exception, e:
+                print "Warning: store failed :: %s (%s)" % (code, e)
+                checkpoint.mark(code, 'failed', "store: %s" % e)
+            if time() - last_report > REPORT_EVERY:
+                last_report = time()
+                for s in stages: print s.report()
+                print stats.log_line()
+        writer.close()
+        if archive_path:
+            www.ARCHIVE.reindex()
+            www.archive_enable(None)
+        for s in stages: print s.report()
+        print stats.log_line()
+        if profile:
+            mongo.print_slow_queries(mongo.slow_queries(db, profile_since))
+    finally:
+        # Leave the profiler as we found it
+        if profile: mongo.profile_stop(db, profile_was)
+    return stages
+
+def _read_lines(path):
+    if not path: return []
+    f = open(path)
+    out = [x.strip() for x in f if x.strip()]
+    f.close()
+    return out
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Fetch, parse and store publications for a list of authors or bibcodes.")
+    parser.add_argument('--authors', help='File with one "Last, First Middle" per line')
+    parser.add_argument('--bibcodes', help='File with one ADS bibcode per line')
+    parser.add_argument('--checkpoint', default=CHECKPOINT, help='Progress file, reused across runs')
+    parser.add_argument('--arxiv', action='store_true', help='Also build the arXiv entry of each publication')
+    parser.add_argument('--fetchers', type=int, default=ads.PIPELINE_WORKERS, help='Threads fetching and parsing abstracts')
+    parser.add_argument('--profile', action='store_true', help='Report slow unindexed Mongo queries at the end')
+    parser.add_argument('--archive', help='Keep every fetched page in the archive at this path')
+    parser.add_argument('--validators', default=refresh.VALIDATORS, help="refresh.py's ETag/Last-Modified file")
+    args = parser.parse_args()
+    if not (args.authors or args.bibcodes):
+        parser.error("Nothing to ingest: give --authors and/or --bibcodes")
+    ingest(_read_lines(args.authors), _read_lines(args.bibcodes), args.checkpoint, args.arxiv, args.fetchers, profile=args.profile, archive_path=args.archive, validators_path=args.validators)
@@ -1,6 +1,13 @@
-"""Implements all the functions needed to interface with a MongoDB back-end."""
+"""Implements all the functions needed to interface with a MongoDB back-end.
 
+Index management, from src/:
+    python mongo.py indexes [--check]   Create (or, with --check, only report) the indexes declared on the hphys_types collections
+    python mongo.py slow [--minutes N]  Report slow queries that scanned a whole collection, from the profiler
+"""
+
+import os, sys, threading, argparse, datetime
 import pymongo
+import hphys_types as ht
 
 # Notes on this module:
 # Cursors time-out with OperationFailure. Reads should be wrapped in try-except
@@ -9,12 +16,220 @@ _HOST = "localhost"
 _PORT = 27017
 _DB = 'hphysics'
 
-# If we were running a daemon, the daemon could share one connection between its threads. This is safe.
+BATCH_SIZE = 500 # Documents per collection that BulkWriter buffers before it writes
+SLOW_MS = 100 # Queries slower than this are recorded by the profiler
+
+# pymongo's client keeps its own pool of sockets and is safe to share between threads, so we keep one per process. A forked child must not reuse its parent's sockets, so it gets a fresh one.
+_clients = {}
+_clients_pid = None
+_lock = threading.Lock()
+
+def mongo_client(host=_HOST, port=_PORT):
+    """Returns the process-wide client for host:port."""
+    global _clients, _clients_pid
+    with _lock:
+        if _clients_pid != os.getpid():
+            _clients = {}
+            _clients_pid = os.getpid()
+        conn = _clients.get((host, port))
+        if conn is None:
+            # MongoClient replaced Connection in pymongo 2.4, and Connection is gone from 3.0
+            cls = getattr(pymongo, 'MongoClient', None) or pymongo.Connection
+            conn = _clients[(host, port)] = cls(host, port)
+    return conn
 
 def mongo_connect(host=_HOST,port=_PORT,dbname=_DB):
-    """Returns (connection, db) for the Mongo DB"""
-    conn = pymongo.Connection(host, port)
+    """Returns (connection, db) for the Mongo DB. The connection is the shared client from mongo_client."""
+    conn = mongo_client(host, port)
     db = conn[dbname]
     # If we want to do any transformation:
     #    db.add_son_manipulator(Transform())
     return (conn, db)
+
+def _key_filter(cls, doc):
+    """Returns the query that identifies doc, from the first of cls.mongo_keys that is set, or None. Embedded documents are matched field by field, since matching a whole embedded document depends on its key order, and their params that are not set are matched as null, as in query._exact_query, so that an Alias without a lineage is not taken for one with."""
+    for k in getattr(cls, 'mongo_keys', ()):
+        v = doc.get(k)
+        if v is None: continue
+        if isinstance(v, dict):
+            out = dict([("%s.%s" % (k, x), y) for (x, y) in v.items()])
+            for x in getattr(ht.MTYPES.get(v.get('_type')), '_mongo_fields', ()):
+                out.setdefault("%s.%s" % (k, x[0]), None)
+            return out
+        return {k: v}
+    return None
+
+class BulkWriter():
+    """Buffers Publications, Aliases, Persons (any MongoDocument with a mongo_collection) and writes them to their collections as unordered bulk upserts, keyed by the class's mongo_keys. Documents with no key set are inserted. Use it as a context manager, or call close() at the end, so the last partial batches are written.
+
+    db can be anything that hands out collections by name, e.g. a mongomock database in tests."""
+    def __init__(self, db=None, batch_size=BATCH_SIZE, write_concern=None):
+        if db is None:
+            _, db = mongo_connect()
+        self.db = db
+        self.batch_size = batch_size
+        self.write_concern = write_concern # e.g. {'w': 1, 'j': True}. None uses the client's default.
+        self.written = 0
+        self._lock = threading.Lock()
+        self._buffers = {} # collection name -> list of [filter, doc, callback], in arrival order
+
+    def add(self, obj, callback=None):
+        """Buffers obj. callback, if given, is called with no arguments once obj has been written."""
+        cls = type(obj)
+        doc = ht.mongo_dump_batch([obj])[0]
+        f = _key_filter(cls, doc)
+        if f is None and getattr(obj, 'id', None) is not None:
+            f = {'_id': obj.id}
+        with self._lock:
+            buf = self._buffers.setdefault(cls.mongo_collection, [])
+            buf.append([f, doc, callback])
+            full = len(buf) >= self.batch_size
+        if full: self.flush(cls.mongo_collection)
+
+    def update(self, cls, f, fields, callback=None):
+        """Buffers a $set of fields on the document of cls's collection that matches the query f. fields may use dotted paths, as diff_fields returns them. callback is as for add."""
+        with self._lock:
+            buf = self._buffers.setdefault(cls.mongo_collection, [])
+            buf.append([f, dict(fields), callback])
+            full = len(buf) >= self.batch_size
+        if full: self.flush(cls.mongo_collection)
+
+    def add_many(self, objs):
+        for x in objs:
+            self.add(x)
+
+    def flush(self, collection=None):
+        """Writes the buffered documents of one collection, or of all of them."""
+        with self._lock:
+            names = [collection] if collection else self._buffers.keys()
+            work = [(x, self._buffers.pop(x, [])) for x in names]
+            for name, ops in work:
+                if ops: self._write(self.db[name], ops)
+        for name, ops in work:
+            for x in ops:
+                if x[2]: x[2]()
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        if exc[0] is None: self.close()
+
+    def _write(self, coll, ops):
+        # Several updates of one document in a batch would race each other in an unordered bulk, so we fold them into one $set, later fields winning.
+        merged = {}
+        order = []
+        for f, doc, cb in ops:
+            k = repr(sorted(f.items())) if f else len(order)
+            if k in merged:
+                merged[k][1].update(doc)
+            else:
+                order.append(k)
+                merged[k] = (f, dict(doc))
+        ops = [merged[k] for k in order]
+        if hasattr(coll, 'bulk_write'):
+            # pymongo >= 3
+            if self.write_concern is not None:
+                from pymongo.write_concern import WriteConcern
+                coll = coll.with_options(write_concern=WriteConcern(**self.write_concern))
+            requests = [pymongo.UpdateOne(f, {'$set': doc}, upsert=True) if f else pymongo.InsertOne(doc) for (f, doc) in ops]
+            coll.bulk_write(requests, ordered=False)
+        else:
+            # pymongo 2.7 - 2.x
+            bulk = coll.initialize_unordered_bulk_op()
+            for f, doc in ops:
+                if f: bulk.find(f).upsert().update_one({'$set': doc})
+                else: bulk.insert(doc)
+            bulk.execute(self.write_concern)
+        self.written += len(ops)
+
+def diff_fields(old, new, prefix=''):
+    """Compares two dumped documents and returns {dotted path: value} for what new changes, so that a $set of the result turns old into new without rewriting the rest. Embedded documents with the same _type and the same fields are compared field by field; anything else that differs is replaced whole. Fields that new leaves out are left alone."""
+    out = {}
+    for k, v in new.items():
+        o = old.get(k)
+        if isinstance(v, dict) and isinstance(o, dict) and '_type' in v and v.get('_type') == o.get('_type') and set(v) == set(o):
+            out.update(diff_fields(o, v, prefix + k + '.'))
+        elif k not in old or o != v:
+            out[prefix + k] = v
+    return out
+
+def collection_classes():
+    """Returns the hphys_types classes that are stored in a collection of their own."""
+    return sorted([x for x in ht.MTYPES.values() if hasattr(x, 'mongo_collection')], key=lambda x: x.mongo_collection)
+
+def ensure_indexes(db=None, check_only=False):
+    """Creates the indexes declared in each class's mongo_indexes that the collection does not have yet. With check_only, nothing is created. Returns a list of (collection, keys, status) where status is 'ok', 'created' or 'missing'."""
+    if db is None:
+        _, db = mongo_connect()
+    out = []
+    for cls in collection_classes():
+        coll = db[cls.mongo_collection]
+        have = [list(x['key']) for x in coll.index_information().values()]
+        for keys, options in getattr(cls, 'mongo_indexes', []):
+            if [tuple(x) for x in keys] in [[tuple(y) for y in x] for x in have]:
+                status = 'ok'
+            elif check_only:
+                status = 'missing'
+            else:
+                coll.create_index(keys, **options)
+                status = 'created'
+            out.append((cls.mongo_collection, keys, status))
+    return out
+
+def profile_start(db=None, slow_ms=SLOW_MS):
+    """Turns on the profiler for slow operations on db. Returns the time it was turned on, for slow_queries, and the profiler settings it had before, for profile_stop."""
+    if db is None:
+        _, db = mongo_connect()
+    was = db.command('profile', -1)
+    db.command('profile', 1, slowms=slow_ms)
+    return datetime.datetime.utcnow(), {'was': was.get('was', 0), 'slowms': was.get('slowms', SLOW_MS)}
+
+def profile_stop(db=None, was=None):
+    """Puts the profiler of db back to the settings that profile_start returned, or turns it off."""
+    if db is None:
+        _, db = mongo_connect()
+    was = was or {'was': 0, 'slowms': SLOW_MS}
+    db.command('profile', was['was'], slowms=was['slowms'])
+
+def slow_queries(db=None, since=None):
+    """Returns the profiled operations since the given UTC datetime that scanned a whole collection, slowest first, as dicts with ns, op, millis and query."""
+    if db is None:
+        _, db = mongo_connect()
+    spec = {'ns': {'$not': {'$regex': r'\.system\.'}}}
+    if since is not None:
+        spec['ts'] = {'$gte': since}
+    out = []
+    for x in db['system.profile'].find(spec):
+        # planSummary arrived in MongoDB 2.6. Before that, a scan shows as examining more documents than it returns, with no index keys.
+        plan = x.get('planSummary', '')
+        scanned = x.get('docsExamined', x.get('nscanned', 0))
+        if 'COLLSCAN' in plan or (not plan and not x.get('keysExamined', x.get('nscannedKeys')) and scanned > x.get('nreturned', 0)):
+            out.append({'ns': x.get('ns'), 'op': x.get('op'), 'millis': x.get('millis'), 'query': x.get('query', x.get('command'))})
+    out.sort(key=lambda x: -(x['millis'] or 0))
+    return out
+
+def print_slow_queries(queries):
+    if not queries:
+        print "No slow collection scans."
+    for x in queries:
+        print "%6s ms %-8s %-30s %s" % (x['millis'], x['op'], x['ns'], x['query'])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Manage the indexes of the hphysics collections.")
+    sub = parser.add_subparsers(dest='command')
+    p = sub.add_parser('indexes', help='Create or check the declared indexes')
+    p.add_argument('--check', action='store_true', help='Only report missing indexes')
+    p = sub.add_parser('slow', help='Report slow unindexed queries seen by the profiler')
+    p.add_argument('--minutes', type=int, default=60)
+    args = parser.parse_args()
+    if args.command == 'indexes':
+        missing = False
+        for coll, keys, status in ensure_indexes(check_only=args.check):
+            print "%-8s %-15s %s" % (status, coll, keys)
+            missing = missing or status == 'missing'
+        sys.exit(1 if missing else 0)
+    else:
+        print_slow_queries(slow_queries(since=datetime.datetime.utcnow() - datetime.timedelta(minutes=args.minutes)))
@@ -1,19 +1,128 @@
-import re
-import yaml
+import os, re, hashlib, marshal, threading
 
 PACS_REGEX = re.compile(r"[0-9]{2}\.[0-9]{2}\.[a-zA-Z\-\+][a-zA-Z\-]")
 
 PACS_DATA = "../pacs/pacs.yml"
+# The YAML takes seconds to parse, so we keep a marshalled copy. It is rebuilt whenever the YAML's mtime and hash no longer match the ones recorded in it. It lives outside the pacs submodule, which would otherwise show as modified.
+PACS_COMPILED = "../cache/pacs.marshal"
+_OLD_COMPILED = PACS_DATA + ".marshal" # Where earlier versions kept it
+_COMPILED_FORMAT = 1
 
-f = open(PACS_DATA)
-PACS_TREE = yaml.load(f.read())
-f.close()
-PACS_NAMES = {}
-for x in PACS_TREE:
+_data = None
+_lock = threading.Lock()
+
+def _sha1(path):
+    h = hashlib.sha1()
+    f = open(path, 'rb')
+    for block in iter(lambda: f.read(1 << 16), ''):
+        h.update(block)
+    f.close()
+    return h.hexdigest()
+
+def _read_compiled(path, compiled):
+    """Returns (tree, names) from the compiled file if it was made from the current YAML, else None."""
+    try:
+        f = open(compiled, 'rb')
+    except IOError:
+        return None
+    try:
+        header = marshal.load(f)
+        if header.get('format') != _COMPILED_FORMAT: return None
+        st = os.stat(path)
+        # A touched but unchanged YAML still matches on its hash.
+        if (header.get('mtime'), header.get('size')) != (st.st_mtime, st.st_size):
+            if header.get('sha1') != _sha1(path): return None
+        return marshal.load(f)
+    except (EOFError, ValueError, TypeError, AttributeError):
+        return None
+    finally:
+        f.close()
+
+def _write_compiled(path, compiled, data):
+    st = os.stat(path)
+    header = {'format': _COMPILED_FORMAT, 'mtime': st.st_mtime, 'size': st.st_size, 'sha1': _sha1(path)}
+    tmp = compiled + '.%d.tmp' % os.getpid()
     try:
-        PACS_NAMES[PACS_TREE[x]['name']] = x
-    except KeyError:
-        pass
+        d = os.path.dirname(compiled)
+        if d and not os.path.isdir(d): os.makedirs(d)
+        f = open(tmp, 'wb')
+        marshal.dump(header, f)
+        marshal.dump(data, f)
+        f.close()
+        os.rename(tmp, compiled)
+    except (IOError, OSError, ValueError):
+        # Read-only checkout, or something in the YAML that marshal cannot store. We just parse the YAML every time.
+        try: os.remove(tmp)
+        except OSError: pass
+
+def pacs_load(path=PACS_DATA, compiled=PACS_COMPILED):
+    """Returns (PACS_TREE, PACS_NAMES) as plain dicts, loading them on the first call."""
+    global _data
+    with _lock:
+        if _data is None:
+            data = _read_compiled(path, compiled)
+            if data is None:
+                import yaml
+                f = open(path)
+                tree = yaml.load(f.read())
+                f.close()
+                names = {}
+                for x in tree:
+                    try:
+                        names[tree[x]['name']] = x
+                    except KeyError:
+                        pass
+                data = (tree, names)
+                _write_compiled(path, compiled, data)
+                if path == PACS_DATA and os.path.exists(_OLD_COMPILED):
+                    try: os.remove(_OLD_COMPILED)
+                    except OSError: pass
+            _data = data
+    return _data
+
+class _LazyTable(object):
+    """A read-only stand-in for one of the PACS dicts that loads the data on first use, so importing this module costs almost nothing."""
+    def __init__(self, index):
+        self._index = index
+    def _table(self):
+        return pacs_load()[self._index]
+    def __getitem__(self, key):
+        return self._table()[key]
+    def __contains__(self, key):
+        return key in self._table()
+    def __iter__(self):
+        return iter(self._table())
+    def __len__(self):
+        return len(self._table())
+    def get(self, key, default=None):
+        return self._table().get(key, default)
+    def keys(self):
+        return self._table().keys()
+    def items(self):
+        return self._table().items()
+    def iteritems(self):
+        return self._table().iteritems()
+
+PACS_TREE = _LazyTable(0)
+PACS_NAMES = _LazyTable(1)
+
+_names_trie = None
+
+def pacs_names_trie():
+    """Returns (trie, longest). The trie holds every PACS name split into its ', ' separated units: each node is a dict from the next unit to the child node, and the key None holds the code of the name that ends there. longest is the largest number of units in a name."""
+    global _names_trie
+    if _names_trie is None:
+        trie = {}
+        longest = 0
+        for name, code in PACS_NAMES.items():
+            units = name.split(', ')
+            longest = max(longest, len(units))
+            node = trie
+            for u in units:
+                node = node.setdefault(u, {})
+            node[None] = code
+        _names_trie = (trie, longest)
+    return _names_trie
 
 def pacs_get_level(code):
     if code[1] == '0': return 1
@@ -22,3 +131,116 @@ def pacs_get_level(code):
     if code[6] in ('+','-'): return 3
     if code[6].isupper(): return 4
     return 5
+
+def _pacs_parent(code, level, known, groups):
+    """Works out the parent of a well-formed code. known maps code -> level, and groups maps (first 7 characters, level) -> codes, for the level 3 and 4 codes. Where the natural parent is missing from the data, we climb to the next level up."""
+    if level == 1: return None
+    candidates = []
+    if level == 5:
+        # 03.65.ge sits under 03.65.Ge
+        candidates.extend(groups.get((code[:6] + code[6].upper(), 4), []))
+    if level >= 4:
+        # 03.65.Ge sits under 03.65.-w, or failing that 03.65.+i
+        candidates.extend(groups.get((code[:6] + '-', 3), []))
+        candidates.extend(groups.get((code[:6] + '+', 3), []))
+    if level >= 3:
+        candidates.append(code[:3])
+    candidates.append(code[0] + '0.')
+    for c in candidates:
+        if c != code and c in known and known[c] < level:
+            return c
+    return None
+
+class PacsIndex():
+    """The PACS hierarchy, computed once: each code's level and parent, and a pre-order numbering in which every subtree is a contiguous interval. "Is X under Y" is then two comparisons, and "everything under Y" is a slice."""
+    def __init__(self, codes):
+        self.level = {}
+        for c in codes:
+            try:
+                self.level[c] = pacs_get_level(c)
+            except (AssertionError, IndexError, TypeError):
+                pass # Not a code we understand
+        groups = {}
+        for c in sorted(self.level):
+            if self.level[c] in (3, 4):
+                groups.setdefault((c[:7], self.level[c]), []).append(c)
+        self.parent = {}
+        self.children = {}
+        for c in self.level:
+            p = _pacs_parent(c, self.level[c], self.level, groups)
+            self.parent[c] = p
+            self.children.setdefault(p, []).append(c)
+        for v in self.children.values(): v.sort()
+        # Pre-order numbering. pre[c] is c's position in order, and end[c] is the position of the last code in c's subtree.
+        self.order = []
+        self.pre = {}
+        self.end = {}
+        stack = [(c, False) for c in reversed(self.children.get(None, []))]
+        while stack:
+            c, leaving = stack.pop()
+            if leaving:
+                self.end[c] = len(self.order) - 1
+                continue
+            self.pre[c] = len(self.order)
+            self.order.append(c)
+            stack.append((c, True))
+            stack.extend([(x, False) for x in reversed(self.children.get(c, []))])
+        # For each level, the ancestor (or self) of every code at that level. This is what roll_up looks codes up in.
+        self._at_level = {}
+        for lvl in range(1, 6):
+            table = {}
+            for c in self.order:
+                a = c
+                while a is not None and self.level[a] > lvl:
+                    a = self.parent[a]
+                if a is not None and self.level[a] == lvl:
+                    table[c] = a
+            self._at_level[lvl] = table
+
+    def is_under(self, code, ancestor):
+        """True if code is ancestor or lies in its subtree."""
+        try:
+            return self.pre[ancestor] <= self.pre[code] <= self.end[ancestor]
+        except KeyError:
+            return False
+
+    def subtree(self, code):
+        """Returns code and every code under it, in pre-order."""
+        if code not in self.pre: return []
+        return self.order[self.pre[code]:self.end[code] + 1]
+
+    def ancestors(self, code):
+        """Returns the codes above code, nearest first."""
+        out = []
+        p = self.parent.get(code)
+        while p is not None:
+            out.append(p)
+            p = self.parent[p]
+        return out
+
+    def ancestor_at(self, code, level):
+        """Returns the code at the given level that code is under (code itself if it is at that level), or None."""
+        return self._at_level[level].get(code)
+
+    def roll_up(self, codes, level):
+        """Maps a list of codes onto the given level of the tree in one pass. Codes that are unknown or above that level map to None."""
+        return map(self._at_level[level].get, codes)
+
+    def count_by_level(self, code_lists, level):
+        """Takes a list of lists of codes (e.g. the pacs_codes of many Publications) and returns a dict counting, for each code at level, the lists that have at least one code under it."""
+        table = self._at_level[level]
+        counts = {}
+        for codes in code_lists:
+            for a in set(map(table.get, codes)):
+                if a is not None:
+                    counts[a] = counts.get(a, 0) + 1
+        return counts
+
+_index = None
+
+def pacs_index():
+    """Returns the PacsIndex of PACS_TREE, building it on the first call."""
+    global _index
+    if _index is None:
+        _index = PacsIndex(PACS_TREE.keys())
+    return _index
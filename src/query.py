@@ -1,9 +1,134 @@
+from collections import OrderedDict
+
 import hphys_types as ht
 
+MAX_BUCKETS = 5000 # Last names that an AliasResolver keeps in memory
+
+def _exact_query(name):
+    """The query that matches the Alias of exactly this Name. Fields are matched one by one, since matching a whole embedded document depends on its key order."""
+    return {'name.last': ht.mongo_dump(name.last),
+            'name.names': getattr(name, 'names', []),
+            'name.lineage': getattr(name, 'lineage', None)}
+
 def compatible_name(coll, name):
     """Queries in an Alias collection and returns a tuple ([[List_of_possible_names, Likeliehood_score]], Known_alias?)."""
-    known_alias = coll.find_one(name.mongo_dump())
+    known_alias = coll.find_one(_exact_query(name))
     if known_alias:
-        return (mongo_read(known_alias).persons, True)
+        return (ht.mongo_read(known_alias).persons, True)
     else:
-    return ([[x._id, 1] for x in map(ht.Name, coll.find({"name.last" : name.last})) with name.compatible(x)], False)
+        return ([[x.id, 1] for x in map(ht.mongo_read, coll.find({"name.last" : ht.mongo_dump(name.last)})) if name.compatible(x.name)], False)
+
+class _Node(object):
+    """A node of a given-name trie. full holds the Aliases with a given name that is spelled out and ends here, abbr the ones with a given name that is this prefix followed by a '.'."""
+    __slots__ = ('children', 'full', 'abbr')
+    def __init__(self):
+        self.children = {}
+        self.full = []
+        self.abbr = []
+
+    def add(self, given, alias):
+        node = self
+        for c in given.rstrip('.'):
+            node = node.children.setdefault(c, _Node())
+        if given.endswith('.'): node.abbr.append(alias)
+        else: node.full.append(alias)
+
+    def match(self, given):
+        """The Aliases indexed under a given name that Name._compatible accepts against given."""
+        out = []
+        node = self
+        # An abbreviation on the way down fits: "A." and "Al." both fit "Alice" and "Ali."
+        for c in given.rstrip('.'):
+            node = node.children.get(c)
+            if node is None: return out
+            out.extend(node.abbr)
+        out.extend(node.full)
+        if given.endswith('.'):
+            # and so does everything this abbreviation is a prefix of.
+            stack = node.children.values()
+            while stack:
+                n = stack.pop()
+                out.extend(n.full)
+                out.extend(n.abbr)
+                stack.extend(n.children.values())
+        return out
+
+class _Bucket():
+    """The Aliases that share one last name, indexed by their given names.
+
+    Name.compatible holds if either name's given names fit, in order, into the other's. So the first given name of one of them fits some given name of the other, and the candidates for a Name are the Aliases with any given name that fits its first, plus those whose first given name fits any of its."""
+    def __init__(self, aliases):
+        self.aliases = list(aliases)
+        self.exact = {} # (names, lineage) -> Alias
+        self.nameless = [] # Aliases with no given names, which fit any
+        self.first = _Node() # Over each Alias's first given name
+        self.any = _Node() # Over all of each Alias's given names
+        for a in self.aliases:
+            names = getattr(a.name, 'names', [])
+            self.exact[(tuple(names), getattr(a.name, 'lineage', None))] = a
+            if not names:
+                self.nameless.append(a)
+                continue
+            self.first.add(names[0], a)
+            for x in set(names):
+                self.any.add(x, a)
+
+    def candidates(self, name):
+        """The Aliases that might be compatible with name. Name.compatible has the final say."""
+        names = getattr(name, 'names', [])
+        if not names: return self.aliases
+        out = self.nameless + self.any.match(names[0])
+        for x in names:
+            out.extend(self.first.match(x))
+        seen = set()
+        return [x for x in out if id(x) not in seen and not seen.add(id(x))]
+
+    def resolve(self, name):
+        """compatible_name, against this bucket."""
+        known = self.exact.get((tuple(getattr(name, 'names', [])), getattr(name, 'lineage', None)))
+        if known is not None:
+            return (getattr(known, 'persons', []), True)
+        return ([[x.id, 1] for x in self.candidates(name) if name.compatible(x.name)], False)
+
+class AliasResolver():
+    """compatible_name for many Names at once. The Aliases of a last name are fetched once, in a single query with every other last name that is not loaded yet, and then answered from memory. The max_buckets most recently used last names are kept.
+
+    The index does not see Aliases written after their last name was loaded. Call forget() after writing to the collection."""
+    def __init__(self, coll, max_buckets=MAX_BUCKETS):
+        self.coll = coll
+        self.max_buckets = max_buckets
+        self._buckets = OrderedDict() # last name -> _Bucket, least recently used first
+        self.queries = 0
+
+    def resolve(self, names):
+        """Returns compatible_name's answer for each of names, in order."""
+        lasts = []
+        for n in names:
+            if n.last not in lasts: lasts.append(n.last)
+        missing = [x for x in lasts if x not in self._buckets]
+        if missing: self._load(missing)
+        buckets = {}
+        for x in lasts:
+            buckets[x] = self._buckets.pop(x)
+            self._buckets[x] = buckets[x]
+        out = [buckets[n.last].resolve(n) for n in names]
+        while len(self._buckets) > self.max_buckets:
+            self._buckets.popitem(last=False)
+        return out
+
+    def resolve_one(self, name):
+        return self.resolve([name])[0]
+
+    def forget(self, last=None):
+        """Drops the bucket of one last name, or all of them."""
+        if last is None: self._buckets.clear()
+        else: self._buckets.pop(last, None)
+
+    def _load(self, lasts):
+        self.queries += 1
+        found = dict([(x, []) for x in lasts])
+        docs = list(self.coll.find({'name.last': {'$in': [ht.mongo_dump(x) for x in lasts]}}))
+        for a in ht.mongo_read_batch(docs):
+            found.setdefault(a.name.last, []).append(a)
+        for x in lasts:
+            self._buckets[x] = _Bucket(found[x])
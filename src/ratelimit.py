@@ -0,0 +1,206 @@
+"""A process-wide scheduler that enforces a politeness interval per host, while fetches for different hosts run in parallel on a worker pool."""
+
+import sys, threading, Queue
+from collections import deque
+from time import time
+
+import stats
+
+# Notes on this module:
+# Each host has a token bucket. A request is only handed to a worker when its host has a token, a worker is idle and the host is below its concurrency limit, so the interval between two request starts on one host is never shorter than the host's interval.
+# The HTTP_Opener classes in ads.py and arxiv.py are thin clients of the shared `scheduler` below.
+# The time each request spent queued behind its host's limit is recorded as stats (host, 'wait').
+# aio's event loop cannot block on the condition, so it uses acquire/take_token/release (and withdraw, for a coroutine cancelled in the queue) instead of submit. A place freed by release goes straight to the longest-waiting acquire() caller, which is woken through its callback.
+
+WORKERS = 8
+
+class Future():
+    """The eventual result of a function run by the Scheduler."""
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+    def set_result(self, result):
+        self._result = result
+        self._done.set()
+    def set_exception(self, exc_info):
+        self._exc_info = exc_info
+        self._done.set()
+    def done(self):
+        return self._done.is_set()
+    def result(self, timeout=None):
+        """Blocks until the function has run, then returns its value or re-raises its exception."""
+        # Event.wait without a timeout cannot be interrupted by Ctrl-C, so we wake up now and then.
+        while not self._done.wait(timeout if timeout is not None else 1):
+            if timeout is not None: raise RuntimeError("Timed out waiting for a scheduled request")
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+class TokenBucket():
+    """Holds at most capacity tokens and gains one every interval seconds. With capacity 1 this is a strict minimum gap between takes."""
+    def __init__(self, interval, capacity=1):
+        self.interval = interval
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = None # When the next token started accruing
+
+    def _refill(self, now):
+        if self.tokens >= self.capacity or self.stamp is None or self.interval <= 0:
+            # A full bucket does not accrue, so the gap is counted from the take that empties it.
+            if self.interval <= 0: self.tokens = self.capacity
+            self.stamp = now
+            return
+        # If something messes with the system clock, we never hand out tokens early:
+        if now < self.stamp: self.stamp = now
+        gained = int((now - self.stamp) / self.interval)
+        if gained:
+            self.tokens = min(self.capacity, self.tokens + gained)
+            self.stamp += gained * self.interval
+
+    def delay(self, now):
+        """Returns the number of seconds until a token is available."""
+        self._refill(now)
+        if self.tokens >= 1: return 0
+        return self.stamp + self.interval - now
+
+    def take(self, now):
+        self._refill(now)
+        assert self.tokens >= 1
+        self.tokens -= 1
+
+class _Host():
+    def __init__(self, interval, capacity, concurrency):
+        self.bucket = TokenBucket(interval, capacity)
+        self.concurrency = concurrency
+        self.active = 0
+        self.pending = deque()
+        self.waiters = deque() # Wake-up callbacks of acquire() callers waiting for a place, first come first served
+
+class Scheduler():
+    def __init__(self, workers=WORKERS):
+        self.workers = workers
+        self._cond = threading.Condition()
+        self._hosts = {}
+        self._work = Queue.Queue()
+        self._idle = 0
+        self._started = False
+
+    def add_host(self, host, interval, capacity=1, concurrency=1):
+        """Declares the politeness rules for host: at least interval seconds between request starts (with bursts of up to capacity) and at most concurrency requests in flight. Calling this again for a known host updates its rules."""
+        with self._cond:
+            h = self._hosts.get(host)
+            if h:
+                h.bucket.interval = interval
+                h.bucket.capacity = capacity
+                h.concurrency = concurrency
+                self._hand_over(h)
+            else:
+                self._hosts[host] = _Host(interval, capacity, concurrency)
+            self._cond.notify_all()
+
+    def submit(self, host, func, *args, **kwargs):
+        """Queues func(*args, **kwargs) behind host's rate limit and returns a Future."""
+        fut = Future()
+        with self._cond:
+            if not self._started: self._start()
+            if host not in self._hosts:
+                raise KeyError("No rate limit declared for host %s" % host)
+            self._hosts[host].pending.append((host, fut, func, args, kwargs, time()))
+            self._cond.notify_all()
+        return fut
+
+    def acquire(self, host, wake):
+        """For requests made outside the worker pool (aio's event loop): takes a place in host's concurrency limit and returns True if one is free. Otherwise returns False, and once a place is handed over, wake() is called from the thread that released it. Callers are served in the order they asked, and one that gives up waiting must call withdraw. Each place must be given back with release, after a token has been taken with take_token."""
+        with self._cond:
+            h = self._get(host)
+            if h.active < h.concurrency and not h.waiters:
+                h.active += 1
+                return True
+            h.waiters.append(wake)
+            return False
+
+    def withdraw(self, host, wake):
+        """Takes an acquire() caller out of host's queue. Returns False if it was not there, because a place has been handed to it, which it must then release."""
+        with self._cond:
+            try:
+                self._get(host).waiters.remove(wake)
+            except ValueError:
+                return False
+            return True
+
+    def take_token(self, host):
+        """Takes a token from host's bucket and returns 0, or returns the number of seconds until one is due."""
+        with self._cond:
+            h = self._get(host)
+            now = time()
+            d = h.bucket.delay(now)
+            if d > 0: return d
+            h.bucket.take(now)
+            return 0
+
+    def release(self, host):
+        with self._cond:
+            h = self._hosts[host]
+            h.active -= 1
+            self._hand_over(h)
+            self._cond.notify_all()
+
+    def _get(self, host):
+        h = self._hosts.get(host)
+        if h is None:
+            raise KeyError("No rate limit declared for host %s" % host)
+        return h
+
+    def _hand_over(self, h):
+        """Gives free places to waiting acquire() callers. Caller holds the lock."""
+        while h.waiters and h.active < h.concurrency:
+            h.active += 1
+            h.waiters.popleft()()
+
+    def call(self, host, func, *args, **kwargs):
+        """Runs func(*args, **kwargs) behind host's rate limit and returns its value."""
+        return self.submit(host, func, *args, **kwargs).result()
+
+    def _start(self):
+        self._started = True
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker, name="ratelimit-worker-%d" % i)
+            t.daemon = True
+            t.start()
+        t = threading.Thread(target=self._dispatch, name="ratelimit-dispatch")
+        t.daemon = True
+        t.start()
+
+    def _dispatch(self):
+        with self._cond:
+            while True:
+                now = time()
+                wait = None
+                for h in self._hosts.values():
+                    while h.pending and self._idle > 0 and h.active < h.concurrency:
+                        d = h.bucket.delay(now)
+                        if d > 0:
+                            wait = d if wait is None else min(wait, d)
+                            break
+                        h.bucket.take(now)
+                        h.active += 1
+                        self._idle -= 1
+                        item = h.pending.popleft()
+                        stats.observe(item[0], 'wait', now - item[5])
+                        self._work.put(item)
+                self._cond.wait(wait)
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                self._idle += 1
+                self._cond.notify_all()
+            host, fut, func, args, kwargs, queued = self._work.get()
+            try:
+                fut.set_result(func(*args, **kwargs))
+            except:
+                fut.set_exception(sys.exc_info())
+            self.release(host)
+
+scheduler = Scheduler()
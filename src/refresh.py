@@ -0,0 +1,188 @@
+"""Incremental refresh of stored publications: only what changed at the source is fetched in full, rebuilt and written back.
+
+For each stored publication:
+    ADS    the abstract page and the BibTeX are re-requested as conditional GETs, with the ETag and Last-Modified that we kept from the last response. A 304 costs no body and no parsing. Where ADS sends no validators, the new body is compared with the SHA-1 of the last one.
+    arXiv  the Atom entries are loaded ATOM_CHUNK papers per request, and the latest version number and categories compared with what is stored. Only a paper with a new version is rebuilt with arxiv_build, reusing the stored comments of the earlier versions, so that only the abs pages and the files of the new version are loaded; a change of categories alone is written without any further request.
+A publication that changed is rebuilt, compared field by field with the stored document (mongo.diff_fields), and only the changed fields are $set through a mongo.BulkWriter.
+
+Usage, from src/:
+    python refresh.py [--bibcodes bibcodes.txt] [--no-arxiv] [--validators ../refresh.sqlite]
+Without --bibcodes, every stored publication with an ADS bibcode is checked.
+"""
+
+import hashlib, threading, sqlite3, argparse
+from time import time
+
+import ads, arxiv, mongo, stats
+import hphys_types as ht
+
+VALIDATORS = "../refresh.sqlite"
+BATCH = 100 # Publications read from Mongo and checked together
+FILES = "../files"
+
+class Validators():
+    """The ETag, Last-Modified and body SHA-1 of the last response for each URL, in a sqlite file."""
+    def __init__(self, path=VALIDATORS):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS validators (url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, digest TEXT, updated REAL)")
+        self._db.commit()
+
+    def get(self, url):
+        """Returns (etag, last_modified, digest) for url, or None if we have never seen it."""
+        with self._lock:
+            return self._db.execute("SELECT etag, last_modified, digest FROM validators WHERE url = ?", (url,)).fetchone()
+
+    def save(self, url, body, headers):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO validators VALUES (?, ?, ?, ?, ?)",
+                             (url, headers.get('etag'), headers.get('last-modified'), hashlib.sha1(body).hexdigest(), time()))
+            self._db.commit()
+
+def _submit_pages(bibcode, validators):
+    """Queues conditional GETs of the ADS pages of bibcode and returns their futures."""
+    out = []
+    for url in ads.abstract_urls(bibcode):
+        v = validators.get(url) or (None, None, None)
+        out.append(ads.http_opener.submit_conditional(url, v[0], v[1]))
+    return out
+
+def _changed_pages(bibcode, futures, validators):
+    """Waits for the futures of _submit_pages. Returns None if neither page has changed, and otherwise ((abstract page, BibTeX), [(url, body, headers)] to save in the validators once the result is stored)."""
+    urls = ads.abstract_urls(bibcode)
+    pages = []
+    save = []
+    changed = False
+    for url, fut in zip(urls, futures):
+        out = fut.result()
+        if out is None:
+            pages.append(None)
+            continue
+        body, _, headers = out
+        v = validators.get(url)
+        if v is None or v[2] != hashlib.sha1(body).hexdigest():
+            changed = True
+        pages.append(body)
+        save.append((url, body, headers))
+    if not changed:
+        # Nothing new, but the validators may have been renewed.
+        _save(validators, save)
+        return None
+    # If only one of the pages changed, the other is still needed to rebuild. It comes from the cache if we have it there.
+    pages = [p if p is not None else ads.http_opener.open(url)[0] for (p, url) in zip(pages, urls)]
+    return tuple(pages), save
+
+def _save(validators, save):
+    for x in save:
+        validators.save(*x)
+
+def _stored_snapshots(doc):
+    entry = doc.get('arxiv_entry') or {}
+    return len(entry.get('snapshots') or [])
+
+def _stored_comments(entry):
+    return dict((x['version'], x.get('comment')) for x in entry.get('snapshots') or [] if x.get('version'))
+
+def _check_arxiv(docs, files_path):
+    """Compares the stored arXiv entries of docs with arXiv's Atom entries. Returns {bibcode: dumped ArxivEntry or the fields of it that changed} for those that changed."""
+    docs = [x for x in docs if x.get('arxiv_id') and x.get('arxiv_entry')]
+    if not docs: return {}
+    records = arxiv.prefetch_entries([x['arxiv_id'] for x in docs], fresh=True)
+    out = {}
+    for doc, r in zip(docs, records):
+        try:
+            latest = r.latest_version()
+            primary, others = r.categories()
+        except Exception, e:
+            print "Warning: no Atom entry for %s (%s)" % (doc['arxiv_id'], e)
+            continue
+        stored = doc['arxiv_entry']
+        if latest is not None and latest != _stored_snapshots(doc):
+            stats.incr('refresh', 'arxiv_changed')
+            r.forget_cached()
+            # The comments of the versions we already have are kept, so that only the abs pages of the new versions are loaded.
+            r.use_pages(comments=_stored_comments(stored))
+            try:
+                entry = ads.arxiv_build(r, files_path)
+            except Exception, e:
+                stats.incr('refresh', 'failed')
+                print "Warning: could not rebuild arXiv entry :: %s (%s)" % (doc['arxiv_id'], e)
+                continue
+            out[doc['ads_bibcode']] = ht.mongo_dump_batch([entry])[0]
+        elif primary != stored.get('primary_category') or others != stored.get('categories'):
+            stats.incr('refresh', 'arxiv_changed')
+            out[doc['ads_bibcode']] = dict(stored, primary_category=primary, categories=others)
+    return out
+
+def refresh_batch(docs, validators, writer, with_arxiv=True, files_path=FILES):
+    """Checks one batch of stored publication documents and queues the changed fields on writer. Returns the number of publications that changed."""
+    # Every conditional GET of the batch is queued at once, so the scheduler keeps the ADS host as busy as its limits allow.
+    pending = [(x, _submit_pages(x['ads_bibcode'], validators)) for x in docs]
+    entries = _check_arxiv(docs, files_path) if with_arxiv else {}
+    changed = 0
+    for doc, futures in pending:
+        code = doc['ads_bibcode']
+        try:
+            pages = _changed_pages(code, futures, validators)
+        except Exception, e:
+            stats.incr('refresh', 'failed')
+            print "Warning: could not check %s (%s)" % (code, e)
+            continue
+        new = {}
+        save = []
+        if pages is not None:
+            stats.incr('refresh', 'ads_changed')
+            (abs_s, bibtex_s), save = pages
+            try:
+                pub = ads.abstract_parse(code, abs_s, bibtex_s)
+            except Exception, e:
+                stats.incr('refresh', 'failed')
+                print "Warning: could not parse %s (%s)" % (code, e)
+                continue
+            new = ht.mongo_dump_batch([pub])[0]
+        if code in entries:
+            new['arxiv_entry'] = entries[code]
+        fields = mongo.diff_fields(doc, new)
+        if not fields:
+            stats.incr('refresh', 'unchanged')
+            _save(validators, save)
+            continue
+        changed += 1
+        stats.incr('refresh', 'written')
+        # The validators are only saved once the new fields are in Mongo, so that a crash in between does not hide the change from the next run.
+        writer.update(ht.Publication, {'ads_bibcode': code}, fields, lambda save=save: _save(validators, save))
+    return changed
+
+def refresh(bibcodes=None, db=None, validators_path=VALIDATORS, with_arxiv=True, files_path=FILES, batch=BATCH):
+    """Refreshes the given bibcodes, or every stored publication, and returns the number that changed."""
+    if db is None:
+        _, db = mongo.mongo_connect()
+    coll = db[ht.Publication.mongo_collection]
+    validators = Validators(validators_path)
+    if bibcodes is None:
+        # A cursor left open while we wait on the rate limits would time out, so we take the bibcodes first and read the documents batch by batch.
+        bibcodes = [x['ads_bibcode'] for x in coll.find({'ads_bibcode': {'$exists': True}}, {'ads_bibcode': 1})]
+    bibcodes = list(bibcodes)
+    changed = 0
+    writer = mongo.BulkWriter(db)
+    for i in range(0, len(bibcodes), batch):
+        docs = list(coll.find({'ads_bibcode': {'$in': bibcodes[i:i + batch]}}))
+        changed += refresh_batch(docs, validators, writer, with_arxiv, files_path)
+        print "Checked %d of %d, %d changed. %s" % (min(i + batch, len(bibcodes)), len(bibcodes), changed, stats.log_line())
+    writer.close()
+    return changed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Re-fetch and rewrite only the stored publications that changed at ADS or arXiv.")
+    parser.add_argument('--bibcodes', help='File with one ADS bibcode per line. By default, every stored publication.')
+    parser.add_argument('--no-arxiv', action='store_true', help='Do not check arXiv entries')
+    parser.add_argument('--validators', default=VALIDATORS, help='ETag/Last-Modified file, reused across runs')
+    parser.add_argument('--files', default=FILES, help='Where arxiv_build downloads new versions')
+    parser.add_argument('--batch', type=int, default=BATCH)
+    args = parser.parse_args()
+    codes = None
+    if args.bibcodes:
+        f = open(args.bibcodes)
+        codes = [x.strip() for x in f if x.strip()]
+        f.close()
+    print "%d publications changed." % refresh(codes, None, args.validators, not args.no_arxiv, args.files, args.batch)
@@ -0,0 +1,172 @@
+"""Rebuilds Publications from the raw pages in an archive.PageArchive, on all cores, with no network access.
+
+Parsing (the abstract page regexes, the PACS search, BibTeX, the Atom XML, the version dates) is pure CPU work, so a process pool does it here. Each worker opens the archive read-only once, and bibcodes are handed out in chunks, so the cost of a task is spread over many publications. Bibcodes go out in the order their pages were fetched, which keeps the reads from the archive close together. The Publications come back as they are done and go straight into a mongo.BulkWriter.
+
+With --arxiv, the arXiv entry is rebuilt too, from the archived abs pages and Atom responses (batched ones included). Nothing is downloaded: the files of the latest version are those already in --files, and the comment of a version whose page was never archived is taken from the stored document, since the whole entry is written back.
+
+Usage, from src/:
+    python reparse.py [--archive ../archive] [--bibcodes bibcodes.txt] [--arxiv] [--processes N]
+Without --bibcodes, every bibcode with an abstract page in the archive is re-parsed.
+"""
+
+import os, argparse
+import multiprocessing
+
+import ads, arxiv, archive, mongo
+import hphys_types as ht
+
+CHUNKSIZE = 50 # Bibcodes handed to a worker at a time
+FILES = "../files"
+ATOM_MEMO = 64 # Parsed Atom responses each worker keeps. A batched response serves up to arxiv.ATOM_CHUNK papers.
+BATCH = 100 # Publications held back at a time to have their missing comments read from Mongo in one query
+
+def archived(pages):
+    """Scans the records of a PageArchive, without reading any bodies. Returns (the bibcodes with an abstract page, in the order they were first fetched, {arXiv id: record number of the latest Atom response that covers it})."""
+    abs_prefix = ads.ADS_BASE + "/abs/"
+    atom_prefix = arxiv.ARXIV_EXPORT_BASE + "/api/query?"
+    codes = []
+    seen = set()
+    atom = {}
+    for n, url, fetched, digest in pages.iter_records():
+        if url.startswith(abs_prefix):
+            code = url[len(abs_prefix):]
+            if code not in seen:
+                seen.add(code)
+                codes.append(code)
+        elif url.startswith(atom_prefix):
+            for aid in arxiv.atom_ids(url):
+                atom[aid] = n
+    return codes, atom
+
+# State of a worker process, set by _init_worker
+_pages = None
+_atom = None
+_with_arxiv = False
+_files_path = FILES
+_atom_memo = {}
+
+def _init_worker(path, atom, with_arxiv, files_path):
+    global _pages, _atom, _with_arxiv, _files_path
+    _pages = archive.PageArchive(path, readonly=True)
+    _atom = atom
+    _with_arxiv = with_arxiv
+    _files_path = files_path
+
+def _atom_entry(aid):
+    n = _atom.get(arxiv.bare_id(aid))
+    if n is None: return None
+    entries = _atom_memo.get(n)
+    if entries is None:
+        if len(_atom_memo) >= ATOM_MEMO: _atom_memo.clear()
+        entries = _atom_memo[n] = arxiv.atom_entries(_pages.body(n))
+    return entries.get(arxiv.bare_id(aid))
+
+def _downloaded(aid):
+    """What ArXivRecord.download would return for files already on disk."""
+    path = os.path.abspath(_files_path) + '/'
+    out = []
+    for kind, name in (('pdf', "%s.pdf" % aid), ('gz', "%s-source.gz" % aid)):
+        if os.path.exists(path + name):
+            out.append([kind, path + name])
+    return out
+
+def _arxiv_entry(aid):
+    """Builds the ArxivEntry of aid from archived pages, or returns None if the archive does not have them."""
+    ar = arxiv.ArXivRecord(aid)
+    abs_html = _pages.get(ar.abs_url())
+    entry_xml = _atom_entry(aid)
+    if abs_html is None or entry_xml is None: return None
+    ar.use_pages(abs_html, entry_xml)
+    versions = {}
+    for i in range(1, len(ar.versions() or []) + 1):
+        p = _pages.get(ar.abs_url(i))
+        if p is not None: versions[i] = p
+    ar.use_pages(version_pages=versions)
+    # Comments of versions that were never fetched stay None, rather than being fetched now. _keep_comments fills them in from Mongo.
+    entry = ads.arxiv_parse(ar, all_comments=False)
+    if entry.snapshots:
+        entry.snapshots[-1].versions = _downloaded(aid)
+    return entry
+
+def _parse(code):
+    """Runs in a worker. Returns (bibcode, Publication or None, None or the reason there is none)."""
+    try:
+        pages = [_pages.get(x) for x in ads.abstract_urls(code)]
+        if None in pages:
+            return code, None, "not archived"
+        pub = ads.abstract_parse(code, *pages)
+        if _with_arxiv and getattr(pub, 'arxiv_id', None):
+            entry = _arxiv_entry(pub.arxiv_id)
+            if entry is not None:
+                pub.arxiv_entry = entry
+        return code, pub, None
+    except Exception, e:
+        return code, None, "%s: %s" % (type(e).__name__, e)
+
+def _keep_comments(db, pubs):
+    """Fills in the comments that _arxiv_entry left None from the stored documents of pubs, so that writing the rebuilt arxiv_entry over the stored one does not lose them."""
+    gaps = {}
+    for pub in pubs:
+        entry = getattr(pub, 'arxiv_entry', None)
+        if entry is not None and [x for x in getattr(entry, 'snapshots', []) if getattr(x, 'comment', None) is None]:
+            gaps[pub.ads_bibcode] = entry
+    if not gaps: return
+    for doc in db[ht.Publication.mongo_collection].find({'ads_bibcode': {'$in': gaps.keys()}}, {'ads_bibcode': 1, 'arxiv_entry.snapshots': 1}):
+        stored = dict([(x.get('version'), x.get('comment')) for x in (doc.get('arxiv_entry') or {}).get('snapshots') or []])
+        for snap in gaps[doc['ads_bibcode']].snapshots:
+            if getattr(snap, 'comment', None) is None and stored.get(snap.version) is not None:
+                snap.comment = stored[snap.version]
+
+def _write(db, writer, pubs):
+    _keep_comments(db, pubs)
+    for x in pubs:
+        writer.add(x)
+    del pubs[:]
+
+def reparse(path=archive.ARCHIVE, bibcodes=None, with_arxiv=False, db=None, processes=None, chunksize=CHUNKSIZE, files_path=FILES):
+    """Re-parses the given bibcodes, or every archived one, and writes the Publications to db (by default, the hphysics database). Returns (parsed, missing, failed) counts."""
+    pages = archive.PageArchive(path, readonly=True)
+    codes, atom = archived(pages)
+    pages.close()
+    if bibcodes is not None:
+        # Still in fetch order, for the archive's sake
+        wanted = set(bibcodes)
+        codes = [x for x in codes if x in wanted] + sorted(wanted.difference(codes))
+    if db is None:
+        _, db = mongo.mongo_connect()
+    parsed = missing = failed = 0
+    pool = multiprocessing.Pool(processes, _init_worker, (path, atom, with_arxiv, files_path))
+    try:
+        with mongo.BulkWriter(db) as writer:
+            held = []
+            for code, pub, note in pool.imap_unordered(_parse, codes, chunksize):
+                if pub is not None:
+                    parsed += 1
+                    held.append(pub)
+                    if len(held) >= BATCH: _write(db, writer, held)
+                elif note == "not archived":
+                    missing += 1
+                else:
+                    failed += 1
+                    print "Warning: could not re-parse %s (%s)" % (code, note)
+            _write(db, writer, held)
+    finally:
+        pool.close()
+        pool.join()
+    return parsed, missing, failed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Rebuild publications from archived pages, in parallel.")
+    parser.add_argument('--archive', default=archive.ARCHIVE)
+    parser.add_argument('--bibcodes', help='File with one ADS bibcode per line. By default, every archived bibcode.')
+    parser.add_argument('--arxiv', action='store_true', help='Also rebuild the arXiv entries')
+    parser.add_argument('--files', default=FILES, help='Where the arXiv files were downloaded')
+    parser.add_argument('--processes', type=int, default=None, help='Worker processes (default: one per CPU)')
+    parser.add_argument('--chunksize', type=int, default=CHUNKSIZE)
+    args = parser.parse_args()
+    codes = None
+    if args.bibcodes:
+        f = open(args.bibcodes)
+        codes = [x.strip() for x in f if x.strip()]
+        f.close()
+    print "%d parsed, %d not archived, %d failed" % reparse(args.archive, codes, args.arxiv, None, args.processes, args.chunksize, args.files)
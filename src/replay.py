@@ -0,0 +1,242 @@
+"""A local stand-in for ADS and arXiv that replays responses recorded with fixtures.py, so that a whole crawl can run at full speed on one machine.
+
+Each site is served under a prefix of its own:
+    /ads/...     http://adsabs.harvard.edu/...
+    /arxiv/...   http://arxiv.org/...
+    /export/...  http://export.arxiv.org/...
+Links to the real sites inside text responses, such as ADS's "next set of references", are rewritten to point back here. PDFs and e-prints are served from a files directory laid out as ArXivRecord.download leaves it, with arXiv's headers (e-prints come as Content-Encoding: x-gzip), Range support and answers to HEAD. Conditional GETs against a recorded ETag or Last-Modified get a 304. Latency and errors can be injected.
+
+Run, from src/:
+    python replay.py [--port 8000] [--arxiv-port 8001] [--fixtures ../fixtures] [--files ../files] [--latency 0.05] [--jitter 0.02] [--error-rate 0.01] [--truncate-rate 0.01]
+It prints the settings that point the crawl at it. ADS is pointed at --port and arXiv at --arxiv-port (both serve everything), so that the two sites keep separate rate limits and connections. In the same process, start() and point_at() do the same.
+"""
+
+import os, re, gzip, random, threading, argparse, StringIO
+import BaseHTTPServer, SocketServer
+from time import sleep
+
+import fixtures
+
+SITES = [('/ads', 'http://adsabs.harvard.edu'),
+         ('/arxiv', 'http://arxiv.org'),
+         ('/export', 'http://export.arxiv.org')]
+FILES = "../files"
+PORT = 8000
+CHUNK = 64 * 1024
+
+# Recorded headers that describe the recorded transfer rather than the page
+_DROP_HEADERS = set(['content-length', 'transfer-encoding', 'connection', 'keep-alive', 'content-encoding', 'date', 'server'])
+_TEXT_REGEX = re.compile(r'text/|xml|json')
+# Files that ArXivRecord.download streams: (kind, arXiv id)
+_FILE_REGEX = re.compile(r'^http://arxiv\.org/(pdf|e-print)/(.+)$')
+
+class ReplayServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Serves a FixtureStore. latency (plus a uniform jitter of up to jitter) seconds are added to every response, error_rate of them are answered with a 503, and truncate_rate of the file transfers are cut off half way."""
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 256 # The default listen backlog of 5 drops connections when a crawl opens many at once
+
+    def __init__(self, address, store, files=FILES, latency=0, jitter=0, error_rate=0, truncate_rate=0, gzip=False, seed=None, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, ReplayHandler)
+        self.store = store
+        self.files = files
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.truncate_rate = truncate_rate
+        self.gzip = gzip
+        self.verbose = verbose
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.counts = {'hits': 0, 'misses': 0, 'errors': 0, 'files': 0, 'truncated': 0, 'not_modified': 0}
+        host, port = self.server_address[:2]
+        self.base = "http://%s:%d" % ('localhost' if host in ('', '0.0.0.0') else host, port)
+        self._rewrite_regex = re.compile('|'.join([re.escape(real) for (_, real) in SITES]))
+        self._rewrites = dict([(real, self.base + prefix) for (prefix, real) in SITES])
+
+    def count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def chance(self, rate):
+        if rate <= 0: return False
+        with self._lock:
+            return self._random.random() < rate
+
+    def delay(self):
+        if self.jitter:
+            with self._lock:
+                return self.latency + self._random.uniform(0, self.jitter)
+        return self.latency
+
+    def real_url(self, path):
+        """Maps a request path to the URL it was recorded under, or None."""
+        for prefix, real in SITES:
+            if path.startswith(prefix + '/'):
+                return real + path[len(prefix):]
+        return None
+
+    def rewrite(self, body):
+        return self._rewrite_regex.sub(lambda m: self._rewrites[m.group(0)], body)
+
+class ReplayHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # Keep-alive, like the real sites, so www.POOL reuses its connections
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def do_GET(self):
+        srv = self.server
+        delay = srv.delay()
+        if delay: sleep(delay)
+        if srv.chance(srv.error_rate):
+            srv.count('errors')
+            return self._send(503, {'Content-Type': 'text/plain', 'Retry-After': '1'}, "Injected error\n")
+        url = srv.real_url(self.path)
+        m = _FILE_REGEX.match(url or '')
+        if m:
+            return self._send_file(m.group(1), m.group(2))
+        hit = srv.store.get(url) if url else None
+        if hit is None:
+            srv.count('misses')
+            return self._send(404, {'Content-Type': 'text/plain'}, "Not recorded: %s\n" % (url or self.path))
+        srv.count('hits')
+        body, _, headers = hit
+        h = dict([(k, v) for (k, v) in headers.items() if k.lower() not in _DROP_HEADERS])
+        if self._not_modified(h):
+            srv.count('not_modified')
+            self.send_response(304)
+            for k, v in h.items():
+                if k.lower() in ('etag', 'last-modified'): self.send_header(k, v)
+            self.end_headers()
+            return
+        if _TEXT_REGEX.search(h.get('content-type', 'text/html')):
+            body = srv.rewrite(body)
+        if srv.gzip and 'gzip' in self.headers.get('accept-encoding', ''):
+            buf = StringIO.StringIO()
+            z = gzip.GzipFile(fileobj=buf, mode='wb')
+            z.write(body)
+            z.close()
+            body = buf.getvalue()
+            h['Content-Encoding'] = 'gzip'
+        self._send(200, h, body)
+
+    def do_HEAD(self):
+        # Only files, whose size ArXivRecord.download checks before it downloads one again
+        url = self.server.real_url(self.path)
+        m = _FILE_REGEX.match(url or '')
+        if m:
+            return self._send_file(m.group(1), m.group(2))
+        self._send(405, {'Allow': 'GET'}, '')
+
+    def _not_modified(self, headers):
+        """Whether a conditional GET matches the recorded ETag or Last-Modified, as with refresh.py."""
+        h = dict([(k.lower(), v) for (k, v) in headers.items()])
+        if self.headers.get('if-none-match'):
+            return self.headers['if-none-match'] == h.get('etag')
+        return bool(self.headers.get('if-modified-since')) and self.headers['if-modified-since'] == h.get('last-modified')
+
+    def _send(self, code, headers, body):
+        self.send_response(code)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD': self.wfile.write(body)
+
+    def _send_file(self, kind, aid):
+        """Serves a PDF or e-print saved by ArXivRecord.download, honouring Range: bytes=N-."""
+        srv = self.server
+        if kind == 'pdf':
+            path = os.path.join(srv.files, "%s.pdf" % aid)
+            headers = {'Content-Type': 'application/pdf'}
+        else:
+            path = os.path.join(srv.files, "%s-source.gz" % aid)
+            headers = {'Content-Type': 'application/x-eprint-tar', 'Content-Encoding': 'x-gzip'}
+        if not os.path.isfile(path):
+            srv.count('misses')
+            return self._send(404, {'Content-Type': 'text/plain'}, "No file for %s\n" % self.path)
+        size = os.path.getsize(path)
+        start = 0
+        m = re.match(r'bytes=(\d+)-$', self.headers.get('range', ''))
+        if m:
+            start = int(m.group(1))
+            if start >= size:
+                return self._send(416, {'Content-Range': 'bytes */%d' % size}, '')
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, size - 1, size))
+        else:
+            self.send_response(200)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(size - start))
+        self.end_headers()
+        if self.command == 'HEAD': return
+        srv.count('files')
+        stop = size
+        if srv.chance(srv.truncate_rate):
+            srv.count('truncated')
+            stop = start + (size - start) // 2
+            self.close_connection = 1
+        f = open(path, 'rb')
+        try:
+            f.seek(start)
+            left = stop - start
+            while left > 0:
+                block = f.read(min(CHUNK, left))
+                if not block: break
+                self.wfile.write(block)
+                left -= len(block)
+        finally:
+            f.close()
+
+def start(store=None, port=PORT, **kwargs):
+    """Starts a ReplayServer on a daemon thread and returns it. store defaults to the fixtures at fixtures.FIXTURES; keyword arguments go to ReplayServer. Port 0 picks a free port."""
+    if store is None: store = fixtures.FixtureStore()
+    srv = ReplayServer(('localhost', port), store, **kwargs)
+    t = threading.Thread(target=srv.serve_forever, name="replay")
+    t.daemon = True
+    t.start()
+    return srv
+
+def point_at(base, concurrency=4, arxiv_base=None):
+    """Points ads and arxiv at a replay server at base (e.g. srv.base), with no wait between requests and up to concurrency requests in flight to each site. The rate limits and www.POOL work per host:port, so ADS and arXiv on one server share one limit and one set of connections. Pass a second server's base as arxiv_base to keep them apart, as they are in a real crawl. Call this before the first request, since www.POOL sizes each host's connections when it first sees the host."""
+    import ads, arxiv, www
+    arxiv_base = arxiv_base or base
+    www.POOL.max_per_host = max(www.POOL.max_per_host, concurrency)
+    ads.configure(base + '/ads', 0, concurrency)
+    arxiv.configure(arxiv_base + '/arxiv', arxiv_base + '/export', 0, concurrency)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay recorded ADS and arXiv responses on a local port.")
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--arxiv-port', type=int, default=PORT + 1, help='A second port, for the arXiv sites')
+    parser.add_argument('--fixtures', default=fixtures.FIXTURES)
+    parser.add_argument('--files', default=FILES, help='Directory of downloaded PDFs and e-prints')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Up to this many more seconds, at random')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests answered with a 503')
+    parser.add_argument('--truncate-rate', type=float, default=0.0, help='Fraction of file transfers cut off half way')
+    parser.add_argument('--gzip', action='store_true', help='Compress responses for clients that accept it')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+    store = fixtures.FixtureStore(args.fixtures)
+    options = (args.files, args.latency, args.jitter, args.error_rate, args.truncate_rate, args.gzip, args.seed, args.verbose)
+    srv = ReplayServer(('localhost', args.port), store, *options)
+    arxiv_srv = ReplayServer(('localhost', args.arxiv_port), store, *options)
+    print "Replaying %d recorded responses on %s and %s. To crawl against them, put in settings.py:" % (len(store.index), srv.base, arxiv_srv.base)
+    print "    ads_base = '%s/ads'" % srv.base
+    print "    arxiv_base = '%s/arxiv'" % arxiv_srv.base
+    print "    arxiv_export_base = '%s/export'" % arxiv_srv.base
+    print "    ads_wait = arxiv_wait = 0"
+    print "    ads_concurrency = arxiv_concurrency = 4"
+    t = threading.Thread(target=arxiv_srv.serve_forever, name="replay-arxiv")
+    t.daemon = True
+    t.start()
+    try:
+        srv.serve_forever()
+    except KeyboardInterrupt:
+        print srv.counts, arxiv_srv.counts
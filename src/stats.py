@@ -0,0 +1,134 @@
+"""Counters and timing histograms for the crawl, per host and per stage.
+
+Keys are host names (as seen by www and ratelimit) or stage names (abstract_parse, arxiv_build, ...). What is recorded:
+    hosts:  requests, cache_hits, errors, retries (counters); wait (rate-limit queueing, s), network (s), bytes,
+            and for streamed arXiv files download (s) and download_bytes (histograms)
+    stages: time (s), plus stage-specific counters such as memo_hits for pacs_keywords_parse
+Read them with snapshot(), or as one line with log_line(). start_logging() prints that line periodically.
+"""
+
+import sys, math, threading
+from time import time
+
+LOG_EVERY = 60 # Seconds between lines from start_logging
+
+class Histogram():
+    """Counts values in power-of-two buckets, which is enough to tell a 50 ms response from a 500 ms one at constant cost per value."""
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = {} # Exponent e -> number of values in (2**(e-1), 2**e]. Values <= 0 are under None.
+
+    def add(self, v):
+        self.count += 1
+        self.total += v
+        if self.min is None or v < self.min: self.min = v
+        if self.max is None or v > self.max: self.max = v
+        e = math.frexp(v)[1] if v > 0 else None
+        self.buckets[e] = self.buckets.get(e, 0) + 1
+
+    def percentile(self, p):
+        """An upper bound on the p-th percentile (0 < p <= 100): the top of the bucket it falls in, but never more than the largest value seen."""
+        if not self.count: return None
+        want = self.count * p / 100.0
+        seen = 0
+        for e in sorted(self.buckets, key=lambda x: -1e9 if x is None else x):
+            seen += self.buckets[e]
+            if seen >= want:
+                return 0.0 if e is None else min(2.0 ** e, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {'count': self.count, 'total': self.total, 'min': self.min, 'max': self.max,
+                'mean': self.total / self.count if self.count else None,
+                'p50': self.percentile(50), 'p95': self.percentile(95), 'buckets': dict(self.buckets)}
+
+class _Timer(object):
+    __slots__ = ('stats', 'key', 'name', 'start')
+    def __init__(self, stats, key, name):
+        self.stats = stats
+        self.key = key
+        self.name = name
+    def __enter__(self):
+        self.start = time()
+        return self
+    def __exit__(self, *exc):
+        self.stats.observe(self.key, self.name, time() - self.start)
+
+class Stats():
+    """Thread-safe counters and histograms, each named by (key, name)."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time()
+            self._counters = {}
+            self._histograms = {}
+
+    def incr(self, key, name, n=1):
+        with self._lock:
+            self._counters[(key, name)] = self._counters.get((key, name), 0) + n
+
+    def observe(self, key, name, value):
+        with self._lock:
+            h = self._histograms.get((key, name))
+            if h is None:
+                h = self._histograms[(key, name)] = Histogram()
+            h.add(value)
+
+    def timer(self, key, name='time'):
+        """A context manager that records how long its block took."""
+        return _Timer(self, key, name)
+
+    def snapshot(self):
+        """Returns {key: {name: counter value or histogram dict}}."""
+        out = {}
+        with self._lock:
+            for (k, n), v in self._counters.items():
+                out.setdefault(k, {})[n] = v
+            for (k, n), h in self._histograms.items():
+                out.setdefault(k, {})[n] = h.snapshot()
+        return out
+
+    def log_line(self):
+        """Everything in one line, e.g. "[120s] arxiv.org: requests=3 bytes n=3 mean=41872 p95<=65536 | ..." """
+        parts = []
+        for key, values in sorted(self.snapshot().items()):
+            items = []
+            for name, v in sorted(values.items()):
+                if isinstance(v, dict):
+                    items.append("%s n=%d mean=%s p95<=%s" % (name, v['count'], _fmt(v['mean']), _fmt(v['p95'])))
+                else:
+                    items.append("%s=%d" % (name, v))
+            parts.append("%s: %s" % (key, ' '.join(items)))
+        return "[%ds] %s" % (time() - self.started, ' | '.join(parts))
+
+    def start_logging(self, every=LOG_EVERY, out=None):
+        """Prints log_line() to out (by default, stderr) every so many seconds, from a daemon thread. Returns an Event that stops it when set."""
+        stop = threading.Event()
+        def run():
+            while not stop.wait(every):
+                print >> (out or sys.stderr), "stats: " + self.log_line()
+        t = threading.Thread(target=run, name="stats-log")
+        t.daemon = True
+        t.start()
+        return stop
+
+def _fmt(v):
+    if v is None: return '-'
+    if isinstance(v, float) and v < 100: return "%.3g" % v
+    return "%d" % v
+
+STATS = Stats()
+
+# Shortcuts to the process-wide STATS
+incr = STATS.incr
+observe = STATS.observe
+timer = STATS.timer
+snapshot = STATS.snapshot
+log_line = STATS.log_line
+start_logging = STATS.start_logging
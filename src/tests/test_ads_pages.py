@@ -0,0 +1,123 @@
+"""The one-scan parsers of ADS abstract and search pages against the parsers they replaced, on saved pages. Run from src/: python -m unittest discover -s tests"""
+
+import os, re, unittest
+
+import ads
+import hphys_types as ht
+
+try:
+    from BeautifulSoup import BeautifulSoup as BS
+except ImportError:
+    BS = None
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'ads')
+
+def page(name):
+    f = open(os.path.join(DATA, name), 'rb')
+    try: return f.read()
+    finally: f.close()
+
+ABSTRACT_PAGES = ['abs_full.html', 'abs_no_affiliation.html', 'abs_no_authors.html']
+SEARCH_PAGES = ['search_page1.html', 'search_page2.html']
+
+# The parsers as they were before the one-scan rewrite
+
+def old_affiliations_from_abstract(s):
+    auth_line_start = r'<tr><td nowrap valign="top" align="left"><b>Authors:</b></td><td><br></td><td align="left" valign="top">'
+    auth_line_end = r'</td></tr>'
+    aff_line_start = r'<tr><td nowrap valign="top" align="left"><b>Affiliation:</b></td><td><br></td><td align="left" valign="top">'
+    aff_line_end = r'</td></tr>'
+    auth_pattern = r'<a href=".*?">(.*?)</a>'
+    aff_pattern = r'([A-Z][A-Z][A-Z]?[A-Z]?)\((.*?)\)'
+    auth_line = re.search('^' + auth_line_start + r'(.*?)' + auth_line_end, s, flags=re.MULTILINE)
+    if not auth_line: return []
+    auths = [x for x in re.findall(auth_pattern, auth_line.group(0))]
+    auths = map(lambda x: x.replace("&#160;"," ").replace(".-",". ").replace('\xc2\xa0',' ').split(", "), auths)
+    out = []
+    for a in auths:
+        assert(a[0])
+        try:
+            names = filter(lambda x: x, a[1].split(' '))
+        except IndexError:
+            names = []
+        out.append(ht.Name({"names": names, "last": a[0]}))
+    auths = out
+    aff_line = re.search('^' + aff_line_start + r'(.*?)' + aff_line_end, s, flags=re.MULTILINE)
+    if aff_line:
+        affs = [x[1] for x in re.findall(aff_pattern, aff_line.group(0))]
+    else: affs = [None] * len(auths)
+    return zip(auths,affs)
+
+def old_abstract(s):
+    m = re.search(r'<h3 align="center">                               Abstract</h3>\n' + r'((.*?\n)*?)<hr>', s)
+    return m.group(1) if m else None
+
+def old_pacs(s):
+    m = re.search(r'<tr><td nowrap valign="top" align="left"><b>PACS Keywords:</b></td><td><br></td><td align="left" valign="top">(.*?)</td></tr>', s)
+    return m.group(1) if m else None
+
+def old_bibcodes_from_search(html):
+    return [x["value"] for x in BS(html).findAll(attrs={"type": "checkbox", "name": "bibcode"})]
+
+def old_next_search_url(html):
+    match = re.search(r'Get <a href="(.*?)">next set of references</a>', html)
+    return match.group(1) if match else None
+
+class AbstractPageTest(unittest.TestCase):
+    def test_same_fields_as_before(self):
+        for name in ABSTRACT_PAGES:
+            s = page(name)
+            fields = ads.abstract_page_fields(s)
+            self.assertEqual(fields['abstract'], old_abstract(s), name)
+            self.assertEqual(fields['pacs'], old_pacs(s), name)
+            new = ads.affiliations_from_abstract(s, fields)
+            old = old_affiliations_from_abstract(s)
+            self.assertEqual(len(new), len(old), name)
+            for (n1, a1), (n2, a2) in zip(new, old):
+                self.assertEqual(n1, n2, name)
+                self.assertEqual(a1, a2, name)
+
+    def test_full_page(self):
+        s = page('abs_full.html')
+        authors = ads.affiliations_from_abstract(s)
+        self.assertEqual(len(authors), 7)
+        self.assertEqual(authors[0][0], ht.Name({'names': ['M.', 'D.'], 'last': 'Lukin'}))
+        self.assertEqual(authors[3][0], ht.Name({'names': ['L.', 'M.'], 'last': 'Duan'}))
+        self.assertEqual(authors[5][0], ht.Name({'names': ['J.', 'I.'], 'last': 'Cirac'}))
+        self.assertTrue(authors[1][1].startswith('Fachbereich Physik'))
+        fields = ads.abstract_page_fields(s)
+        self.assertTrue(fields['abstract'].startswith('We describe a technique'))
+        self.assertTrue(fields['pacs'].startswith('Quantum computation, '))
+
+    def test_missing_fields(self):
+        fields = ads.abstract_page_fields(page('abs_no_affiliation.html'))
+        self.assertEqual((fields['affiliation'], fields['pacs'], fields['abstract']), (None, None, None))
+        self.assertEqual(ads.affiliations_from_abstract(page('abs_no_affiliation.html')), [(ht.Name({'names': ['Rodney'], 'last': 'Loudon'}), None)])
+        fields = ads.abstract_page_fields(page('abs_no_authors.html'))
+        self.assertEqual(fields['authors'], None)
+        self.assertEqual(fields['pacs'], 'Errata')
+        self.assertEqual(ads.affiliations_from_abstract(page('abs_no_authors.html')), [])
+
+class SearchPageTest(unittest.TestCase):
+    EXPECTED = {'search_page1.html': ['2008Natur.455..644M', '2005RvMP...77..633F', '2003RvMP...75..457L', '2001Natur.414..413D', '2001PhRvL..87c7901L', '2000A&A...360L..13L'],
+                'search_page2.html': ['2000PhRvL..84.5094F', '1999PhRvL..82.5229K']}
+
+    def test_bibcodes(self):
+        for name in SEARCH_PAGES:
+            self.assertEqual(ads.bibcodes_from_search(page(name)), self.EXPECTED[name], name)
+
+    @unittest.skipIf(BS is None, "BeautifulSoup, which the old parser used, is not installed")
+    def test_same_bibcodes_as_before(self):
+        for name in SEARCH_PAGES:
+            self.assertEqual(ads.bibcodes_from_search(page(name)), old_bibcodes_from_search(page(name)), name)
+        entities = ''.join(['<input type="checkbox" name="bibcode" value="%s">' % x for x in ['A&amp;A', 'a&lt;b', 'x&#38;y', 'x&#x26;y', 'caf&eacute;', 'a&nbsp;b', 'a&quot;b', 'a & b']])
+        self.assertEqual(ads.bibcodes_from_search(entities), old_bibcodes_from_search(entities))
+
+    def test_next_page(self):
+        for name in SEARCH_PAGES:
+            self.assertEqual(ads._next_search_url(page(name)), old_next_search_url(page(name)), name)
+        self.assertEqual(ads._next_search_url(page('search_page1.html')), 'http://adsabs.harvard.edu/cgi-bin/nph-abs_connect?return_req=no_params&amp;author=Lukin,%20M.%20D.&amp;start_nr=7&amp;start_cnt=7')
+        self.assertEqual(ads._next_search_url(page('search_page2.html')), None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+"""disambig.score_block on blocks of initial and spelled-out variants of names. Run from src/: python -m unittest discover -s tests"""
+
+import unittest
+
+import disambig
+
+def alias(names, last='Lukin'):
+    return (last, tuple(names), None)
+
+class ScoreBlockTest(unittest.TestCase):
+    def test_initials_join_full_names(self):
+        coauthors = set(['giedke|g', 'cirac|j', 'zoller|p'])
+        block = {alias(['M.']): [3, set(coauthors), set(['harvard'])],
+                 alias(['Mikhail', 'D.']): [5, set(coauthors), set(['harvard'])],
+                 alias(['Mikhail']): [2, set(['cirac|j', 'zoller|p']), set()]}
+        result = disambig.score_block(('lukin|m', block))
+        self.assertEqual(len(result), 1)
+        person_id, display, scored = result[0]
+        self.assertEqual(person_id, 'lukin|m|mikhail d.')
+        self.assertEqual(display, 'Mikhail D. Lukin')
+        self.assertEqual(sorted(scored), sorted([(k, 1.0) for k in block]))
+
+    def test_different_first_names_stay_apart(self):
+        shared = set(['giedke|g', 'cirac|j'])
+        block = {alias(['M.']): [3, set(shared), set()],
+                 alias(['Mikhail', 'D.']): [5, set(shared), set()],
+                 alias(['Maria']): [4, set(shared), set()]}
+        result = disambig.score_block(('lukin|m', block))
+        # M. fits both, but Mikhail D. and Maria cannot be one person, so M. joins one of them and is shared out between the two.
+        persons = dict([(person_id, dict(scored)) for (person_id, _, scored) in result])
+        self.assertEqual(sorted(persons), ['lukin|m|maria', 'lukin|m|mikhail d.'])
+        self.assertEqual(persons['lukin|m|maria'].get(alias(['Maria'])), 1.0)
+        self.assertEqual(persons['lukin|m|mikhail d.'].get(alias(['Mikhail', 'D.'])), 1.0)
+        self.assertAlmostEqual(persons['lukin|m|maria'][alias(['M.'])] + persons['lukin|m|mikhail d.'][alias(['M.'])], 1.0)
+
+    def test_name_alone_is_not_enough(self):
+        block = {alias(['M.']): [1, set(['a|b']), set()],
+                 alias(['Mikhail']): [1, set(['c|d']), set()]}
+        self.assertEqual(len(disambig.score_block(('lukin|m', block))), 2)
+
+if __name__ == '__main__':
+    unittest.main()
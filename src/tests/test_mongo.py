@@ -0,0 +1,75 @@
+"""mongo.BulkWriter against mongomock, an in-process stand-in for mongod. Run from src/: python -m unittest discover -s tests"""
+
+import unittest
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+import mongo
+import hphys_types as ht
+
+def alias(names, persons, lineage=None):
+    n = ht.Name({'names': names, 'last': 'Lukin'})
+    if lineage is not None: n.lineage = lineage
+    return ht.Alias({'name': n, 'persons': persons})
+
+@unittest.skipIf(mongomock is None, "mongomock is not installed")
+class BulkWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.db = mongomock.MongoClient().db
+        self.aliases = self.db[ht.Alias.mongo_collection]
+
+    def test_buffers_until_batch_size(self):
+        writer = mongo.BulkWriter(self.db, batch_size=3)
+        writer.add(alias(['M.'], [['a', 1]]))
+        writer.add(alias(['Mikhail'], [['a', 1]]))
+        self.assertEqual(self.aliases.count_documents({}), 0)
+        writer.add(alias(['Mikhail', 'D.'], [['a', 1]]))
+        self.assertEqual(self.aliases.count_documents({}), 3)
+        self.assertEqual(writer.written, 3)
+
+    def test_close_flushes_and_calls_back(self):
+        done = []
+        with mongo.BulkWriter(self.db) as writer:
+            writer.add(alias(['M.'], [['a', 1]]), lambda: done.append(1))
+            self.assertEqual(done, [])
+        self.assertEqual(done, [1])
+        self.assertEqual(self.aliases.count_documents({}), 1)
+
+    def test_upserts_on_key(self):
+        with mongo.BulkWriter(self.db) as writer:
+            writer.add(alias(['M.'], [['a', 1]]))
+        with mongo.BulkWriter(self.db) as writer:
+            writer.add(alias(['M.'], [['b', 1]]))
+        docs = list(self.aliases.find())
+        self.assertEqual(len(docs), 1)
+        self.assertEqual(docs[0]['persons'], [['b', 1]])
+
+    def test_lineage_is_part_of_the_key(self):
+        with mongo.BulkWriter(self.db) as writer:
+            writer.add(alias(['M.'], [['jr', 1]], 'Jr.'))
+        with mongo.BulkWriter(self.db) as writer:
+            writer.add(alias(['M.'], [['sr', 1]]))
+        docs = dict([(d['name'].get('lineage'), d['persons']) for d in self.aliases.find()])
+        self.assertEqual(docs, {'Jr.': [['jr', 1]], None: [['sr', 1]]})
+
+    def test_updates_of_one_document_are_merged(self):
+        pubs = self.db[ht.Publication.mongo_collection]
+        with mongo.BulkWriter(self.db) as writer:
+            writer.add(ht.Publication({'ads_bibcode': '2001PhRvL..87c7901L', 'title': 'Old', 'keywords': ['a']}))
+            writer.update(ht.Publication, {'ads_bibcode': '2001PhRvL..87c7901L'}, {'title': 'New'})
+            writer.update(ht.Publication, {'ads_bibcode': '2001PhRvL..87c7901L'}, {'title': 'Newer'})
+        docs = list(pubs.find())
+        self.assertEqual(len(docs), 1)
+        self.assertEqual((docs[0]['title'], docs[0]['keywords']), ('Newer', ['a']))
+
+    def test_documents_without_a_key_are_inserted(self):
+        with mongo.BulkWriter(self.db) as writer:
+            writer.add(ht.Person({'display_name': 'Mikhail D. Lukin'}))
+            writer.add(ht.Person({'display_name': 'Mikhail D. Lukin'}))
+        self.assertEqual(self.db[ht.Person.mongo_collection].count_documents({}), 2)
+
+if __name__ == '__main__':
+    unittest.main()
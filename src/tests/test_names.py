@@ -0,0 +1,68 @@
+"""Name.compatible on pairs of names as ADS writes them. Run from src/: python -m unittest discover -s tests"""
+
+import unittest
+
+import hphys_types as ht
+import query
+
+def name(names, last='Lukin', lineage=None):
+    n = ht.Name({'names': names, 'last': last})
+    if lineage is not None: n.lineage = lineage
+    return n
+
+# (one, two, one.compatible(two))
+PAIRS = [
+    ((['Mikhail', 'D.'],), (['Mikhail', 'D.'],), 1),
+    (([],), ([],), 1),
+    ((['Mikhail', 'D.'],), (['M.'],), 2),
+    ((['M.'],), (['Mikhail', 'D.'],), 3),
+    ((['Mikhail'],), (['M.'],), 2),
+    ((['M.'],), (['Mikhail'],), 3),
+    ((['Mikhail'],), (['Mikhail', 'D.'],), 3),
+    ((['Mikhail', 'D.'],), (['Mikhail'],), 2),
+    ((['Mikhail', 'D.'],), (['M.', 'D.'],), 2),
+    ((['Mikhail', 'Dmitri'],), (['M.', 'D.'],), 2),
+    ((['Mikhail', 'D.'],), (['D.'],), 2),
+    ((['M.'],), ([],), 2),
+    (([],), (['Mikhail'],), 3),
+    ((['Mikhail', 'D.'],), (['M.', 'Dmitri'],), 4),
+    ((['M.', 'D.'],), (['Mikhail'],), 4),
+    ((['Mikhail'],), (['Michael'],), 0),
+    ((['A.'],), (['B.'],), 0),
+    ((['Mikhail', 'D.'],), (['D.', 'Mikhail'],), 0),
+    ((['Mikhail'],), (['Mikhail'], 'Lukina'), 0),
+    ((['Mikhail'],), (['Mikhail'], 'Lukin', 'Jr.'), 0),
+]
+
+class CompatibleTest(unittest.TestCase):
+    def test_pairs(self):
+        for one, two, code in PAIRS:
+            got = name(*one).compatible(name(*two))
+            self.assertEqual(got, code, "%r.compatible(%r) is %d, not %d" % (one, two, got, code))
+
+    def test_typed_last_name(self):
+        # As mongo_read_batch gives it back
+        a = name(['M.'], ht.LatexString({'contents': 'Lukin'}))
+        self.assertEqual(a.compatible(name(['Mikhail', 'D.'])), 3)
+        self.assertEqual(name(['Mikhail', 'D.']).compatible(a), 2)
+
+class BucketTest(unittest.TestCase):
+    def test_candidates_find_every_compatible_alias(self):
+        variants = [[], ['M.'], ['Mikhail'], ['Mikhail', 'D.'], ['M.', 'D.'], ['M.', 'Dmitri'], ['Mi.'], ['Maria'], ['D.'], ['A.', 'M.']]
+        aliases = []
+        for i, names in enumerate(variants):
+            a = ht.Alias({'name': name(names), 'persons': [['p%d' % i, 1]]})
+            a.id = i
+            aliases.append(a)
+        bucket = query._Bucket(aliases)
+        for names in variants + [['Michael'], ['Mikhail', 'Dmitrievich'], ['D.', 'M.']]:
+            n = name(names)
+            expected = sorted([a.id for a in aliases if n.compatible(a.name)])
+            found, known = bucket.resolve(n)
+            if known:
+                self.assertEqual(found, [['p%d' % variants.index(names), 1]])
+                continue
+            self.assertEqual(sorted([x[0] for x in found]), expected, "candidates for %r" % names)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,21 +1,278 @@
-import urllib2
+import os, socket, threading, urllib2, httplib, urlparse, zlib
+from time import time
 import settings
+import cache, stats
 
-def open_http(url,user_agent=settings.user_agent,raw=False):
-    request = urllib2.Request(url)
-    request.add_header('User-Agent', user_agent)
-    opener = urllib2.build_opener() 
-    """Tries to open an http url. Raises an error if the request fails."""
-    res = opener.open(request)
-    if raw: return res
-    return ''.join(res.readlines()), res.geturl()
+# Notes on this module:
+# Requests go through a process-wide pool of keep-alive connections (POOL) instead of urllib2, so that the thousands of requests we make to ADS and arXiv reuse a handful of sockets.
+# The pool follows redirects and raises urllib2.HTTPError for error statuses, like urllib2 did, so callers did not have to change.
+# fetch records requests, cache hits, errors, network time and response size per host in stats.
+# revalidate makes conditional GETs for refresh.py. A 304 is counted as not_modified and has no body to store.
+
+TIMEOUT = 30 # Seconds for connecting and for each socket read
+MAX_PER_HOST = 2 # Open connections per (scheme, host, port). Further requests to that host wait for a free one.
+MAX_REDIRECTS = 5
+CHUNK = 64 * 1024
+
+CACHE = None # An HTTPCache once cache_enable has been called. Until then, every request goes to the network.
+RECORDER = None # Anything with put(url, body, final_url, headers), e.g. a fixtures.FixtureStore, that is handed every page fetch returns.
+ARCHIVE = None # Anything with put(url, body), e.g. an archive.PageArchive, that is handed every page fetch returns.
+
+class Response():
+    """A file-like HTTP response, in the style of the objects returned by urllib2. The connection goes back to the pool once the body has been read to the end or the response is closed."""
+    def __init__(self, pool, key, conn, res, url, decode):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._res = res
+        self._url = url
+        self.code = res.status
+        self.msg = res.reason
+        self._headers = res.msg
+        self._inflate = None
+        self._buf = ''
+        if decode and res.getheader('content-encoding', '').lower() == 'gzip':
+            # 16 + MAX_WBITS tells zlib to expect a gzip header. We hand out the decoded body, so the header would be a lie.
+            self._inflate = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            del self._headers['content-encoding']
+
+    def geturl(self):
+        return self._url
+    def getcode(self):
+        return self.code
+    def info(self):
+        return self._headers
+
+    def _read_raw(self, n):
+        if self._conn is None: return ''
+        try:
+            s = self._res.read(n)
+        except:
+            # A timeout or a short body. Either way the connection is spent, but its slot in the pool must come back.
+            self._discard()
+            raise
+        if not s: self._release()
+        return s
+
+    def read(self, n=None):
+        if self._inflate is None:
+            if n is None:
+                s = self._read_raw(None)
+                self._release()
+                return s
+            return self._read_raw(n)
+        while n is None or len(self._buf) < n:
+            raw = self._read_raw(CHUNK)
+            try:
+                if not raw:
+                    self._buf += self._inflate.flush()
+                    break
+                self._buf += self._inflate.decompress(raw)
+            except zlib.error:
+                self._discard()
+                raise
+        if n is None: n = len(self._buf)
+        s, self._buf = self._buf[:n], self._buf[n:]
+        return s
+
+    def readlines(self):
+        return self.read().splitlines(True)
+
+    def close(self):
+        self._release()
+
+    def _release(self):
+        if self._conn is None: return
+        # The socket can only be reused if the server will keep it open and we consumed the whole body.
+        reuse = not self._res.will_close and self._res.isclosed()
+        self._pool.put(self._key, self._conn, reuse)
+        self._conn = None
+
+    def _discard(self):
+        """Hands the connection back to the pool to be closed, after a failed read."""
+        if self._conn is None: return
+        self._pool.put(self._key, self._conn, False)
+        self._conn = None
+
+class ConnectionPool():
+    """Keep-alive HTTP connections, at most max_per_host for each (scheme, host, port)."""
+    def __init__(self, max_per_host=MAX_PER_HOST, timeout=TIMEOUT):
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = {}
+        self._slots = {}
+
+    def get(self, key):
+        """Returns (connection, reused?) for key, waiting if all of its connections are busy."""
+        with self._lock:
+            # Connections inherited from a parent process share their sockets with it. Start again.
+            if self._pid != os.getpid(): self._reset()
+            slot = self._slots.get(key)
+            if slot is None:
+                slot = self._slots[key] = threading.BoundedSemaphore(self.max_per_host)
+        slot.acquire()
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle: return idle.pop(), True
+        scheme, host, port = key
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, port, timeout=self.timeout), False
+        return httplib.HTTPConnection(host, port, timeout=self.timeout), False
+
+    def put(self, key, conn, reuse):
+        if reuse:
+            with self._lock:
+                self._idle.setdefault(key, []).append(conn)
+        else:
+            conn.close()
+        with self._lock:
+            slot = self._slots.get(key)
+        if slot: slot.release()
+
+    def request(self, url, headers, gzip=True, method='GET'):
+        """Makes a request, following redirects, and returns a Response. Raises urllib2.HTTPError for error statuses."""
+        for i in range(MAX_REDIRECTS + 1):
+            parts = urlparse.urlsplit(url)
+            scheme = parts.scheme or 'http'
+            port = parts.port or (443 if scheme == 'https' else 80)
+            key = (scheme, parts.hostname, port)
+            path = parts.path or '/'
+            if parts.query: path += '?' + parts.query
+            h = dict(headers)
+            if gzip: h['Accept-Encoding'] = 'gzip'
+            conn, reused = self.get(key)
+            try:
+                conn.request(method, path, headers=h)
+                res = conn.getresponse()
+            except (httplib.HTTPException, socket.error):
+                self.put(key, conn, False)
+                if not reused: raise
+                # The server dropped an idle keep-alive connection. Try once more on a fresh one.
+                conn, _ = self.get(key)
+                try:
+                    conn.request(method, path, headers=h)
+                    res = conn.getresponse()
+                except:
+                    self.put(key, conn, False)
+                    raise
+            out = Response(self, key, conn, res, url, gzip)
+            if res.status in (301, 302, 303, 307) and res.getheader('location'):
+                _drain(out)
+                url = urlparse.urljoin(url, res.getheader('location'))
+                if res.status == 303: method = 'GET'
+                continue
+            if res.status >= 400:
+                _drain(out)
+                raise urllib2.HTTPError(url, res.status, res.reason, res.msg, None)
+            return out
+        raise urllib2.HTTPError(url, res.status, "Too many redirects", res.msg, None)
+
+def _drain(res):
+    """Reads and drops the body of res, so that its connection can be reused, and makes sure the connection goes back to the pool even if the read fails."""
+    try:
+        res.read()
+    finally:
+        res.close()
+
+POOL = ConnectionPool()
+
+def cache_enable(path, **kwargs):
+    """Switches on the on-disk response cache at path. Keyword arguments are passed to cache.HTTPCache."""
+    global CACHE
+    CACHE = cache.HTTPCache(path, **kwargs)
+    return CACHE
+
+def record_enable(recorder):
+    """Hands every page that fetch returns, from the network or the cache, to recorder.put. None switches recording off."""
+    global RECORDER
+    RECORDER = recorder
+
+def archive_enable(archive):
+    """Hands every page that fetch returns, from the network or the cache, to archive.put. None switches archiving off."""
+    global ARCHIVE
+    ARCHIVE = archive
+
+def cache_lookup(url):
+    """Returns (html-content, url, headers) for a fresh cached copy of url, or None. Never touches the network."""
+    if CACHE is None: return None
+    return CACHE.get(url)
+
+def cached(url):
+    """Like cache_lookup, but a hit is counted as the host's cache_hits and handed to the recorder and the archive, as a page from the network would be. This is how the openers look in the cache before they queue a request."""
+    hit = cache_lookup(url)
+    if hit:
+        stats.incr(urlparse.urlsplit(url).hostname, 'cache_hits')
+        if RECORDER is not None: RECORDER.put(url, *hit)
+        if ARCHIVE is not None: ARCHIVE.put(url, hit[0])
+    return hit
+
+def cache_invalidate(url):
+    """Drops any cached copy of url, so that the next fetch goes to the network."""
+    if CACHE is not None: CACHE.invalidate(url)
+
+def fetch(url,user_agent=settings.user_agent,lookup=True):
+    """Tries to open an http url and returns (html-content, url, headers). Raises an error if the request fails. Responses are stored in the cache, if it is switched on."""
+    if lookup:
+        hit = cached(url)
+        if hit: return hit
+    return _fetch_network(url, user_agent, None)
+
+def revalidate(url, etag=None, last_modified=None, user_agent=settings.user_agent):
+    """Makes a conditional GET for url with the ETag and/or Last-Modified of an earlier response. Returns None if the server answers 304 Not Modified, and otherwise (html-content, url, headers) like fetch. Never reads the cache, but a new response is stored in it."""
+    h = {}
+    if etag: h['If-None-Match'] = etag
+    if last_modified: h['If-Modified-Since'] = last_modified
+    return _fetch_network(url, user_agent, h)
+
+def _fetch_network(url, user_agent, headers):
+    host = urlparse.urlsplit(url).hostname
+    stats.incr(host, 'requests')
+    t = time()
+    try:
+        res = open_http(url,user_agent,True,True,headers)
+        try:
+            s = res.read()
+        finally:
+            res.close()
+    except:
+        stats.incr(host, 'errors')
+        raise
+    stats.observe(host, 'network', time() - t)
+    if res.getcode() == 304:
+        stats.incr(host, 'not_modified')
+        return None
+    stats.observe(host, 'bytes', len(s))
+    headers = dict(res.info().items())
+    if CACHE is not None:
+        CACHE.put(url, s, res.geturl(), headers)
+    if RECORDER is not None:
+        RECORDER.put(url, s, res.geturl(), headers)
+    if ARCHIVE is not None:
+        ARCHIVE.put(url, s)
+    return s, res.geturl(), headers
+
+def open_http(url,user_agent=settings.user_agent,raw=False,gzip=True,headers=None):
+    """Tries to open an http url. Raises an error if the request fails. With gzip, the server may compress the transfer and we decode it. Extra request headers only apply to raw requests, which bypass the cache."""
+    if not raw:
+        return fetch(url,user_agent)[:2]
+    h = dict(headers or {})
+    h['User-Agent'] = user_agent
+    return POOL.request(url, h, gzip)
+
+def head(url,user_agent=settings.user_agent):
+    """Makes a HEAD request for url and returns the headers of the response, without any body. Raises an error if the request fails."""
+    res = POOL.request(url, {'User-Agent': user_agent}, False, 'HEAD')
+    res.close()
+    return res.info()
 
 def open_http_raw(url):
     """Tries to open an http url. Raises an error if the request fails."""
     # url = urllib2.quote(url,':/') Don't use this. ADS does not handle equivalent URLs equivalently.
     # Can form POST requests and add headers here
-    req = urllib2.Request(url)
-    # Make request (request, data - do not use, timeout in seconds)
-    result = urllib2.urlopen(req, None, 10)
-    return result        
-    
+    return POOL.request(url, {}, False)
+